@@ -0,0 +1,77 @@
+'''
+SmaliDir加载耗时与进程数的关系
+
+python benchmarks/bench_load.py [smali_dir] -w 1 2 4 8
+
+不指定smali目录时，把tests/smali复制多份，生成一个测试目录。
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from smafile import SmaliDir  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(__file__), '..', 'tests', 'smali')
+
+
+def make_corpus(copies):
+    '''把tests/smali中的类复制到copies个不同的包中'''
+    root = tempfile.mkdtemp()
+    for parent, _, filenames in os.walk(CORPUS):
+        for filename in filenames:
+            with open(os.path.join(parent, filename), encoding='utf-8') as f:
+                content = f.read()
+            for i in range(copies):
+                pkg = 'com/test{}'.format(i)
+                new_dir = os.path.join(root, 'com', 'test{}'.format(i))
+                os.makedirs(new_dir, exist_ok=True)
+                with open(os.path.join(new_dir, filename), 'w',
+                          encoding='utf-8') as f:
+                    f.write(content.replace('com/test', pkg))
+    return root
+
+
+def bench(smali_dir, workers, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sd = SmaliDir(smali_dir, workers=workers)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(sd), best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('smali_dir', nargs='?')
+    parser.add_argument('-w', '--workers', nargs='+', type=int,
+                        default=[1, 2, 4, 8])
+    parser.add_argument('-c', '--copies', type=int, default=500,
+                        help='未指定目录时，测试目录中每个类的份数')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    smali_dir = args.smali_dir
+    tmp = None
+    if not smali_dir:
+        smali_dir = tmp = make_corpus(args.copies)
+
+    try:
+        base = None
+        for workers in args.workers:
+            count, elapsed = bench(smali_dir, workers, args.repeat)
+            base = base or elapsed
+            print('workers={:<3} files={} {:.3f}s speedup={:.2f}x'.format(
+                workers, count, elapsed, base / elapsed))
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
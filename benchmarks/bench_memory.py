@@ -0,0 +1,62 @@
+'''
+SmaliDir加载后的内存占用，按方法数平均
+
+python benchmarks/bench_memory.py [smali_dir]
+
+不指定smali目录时，把tests/smali复制多份，生成一个测试目录。
+统计的是SmaliDir对象本身分配的内存，包括文件代码、索引和所有模型对象。
+'''
+import argparse
+import gc
+import os
+import shutil
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from bench_load import make_corpus  # noqa: E402
+from smafile import SmaliDir  # noqa: E402
+
+
+def measure(smali_dir):
+    gc.collect()
+    tracemalloc.start()
+    sd = SmaliDir(smali_dir)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    methods = sum(len(sf.get_methods()) for sf in sd)
+    fields = sum(len(sf.get_fields()) for sf in sd)
+    content = sum(sys.getsizeof(sf.get_content()) for sf in sd)
+    return len(sd), methods, fields, size, content
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('smali_dir', nargs='?')
+    parser.add_argument('-c', '--copies', type=int, default=500,
+                        help='未指定目录时，测试目录中每个类的份数')
+    args = parser.parse_args()
+
+    smali_dir = args.smali_dir
+    tmp = None
+    if not smali_dir:
+        smali_dir = tmp = make_corpus(args.copies)
+
+    try:
+        files, methods, fields, size, content = measure(smali_dir)
+        print('files={} methods={} fields={}'.format(files, methods, fields))
+        print('total={:.1f}MB content={:.1f}MB'.format(
+            size / 2 ** 20, content / 2 ** 20))
+        print('bytes/method={:.0f} (without content {:.0f})'.format(
+            size / methods, (size - content) / methods))
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+'''
+基准测试：在合成的smali目录上，统计常用操作的耗时，结果输出为JSON
+
+python benchmarks/bench_suite.py --classes 2000 -o result.json
+
+每项测试重复多次，记录最短、平均耗时；ops为每次测试执行的操作数。
+update_desc、save会修改文件，每次都在新复制的目录上执行，复制不计入耗时；
+xref每次在新加载的目录上执行，加载不计入耗时。
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from corpus import CorpusGenerator, class_name, method_name  # noqa: E402
+from smafile import __VERSION__, SmaliDir  # noqa: E402
+
+
+def timeit(func, repeat, setup=None):
+    '''
+    :param setup: 每次执行前调用，返回值作为func的参数，不计入耗时
+    @return 结果统计、最后一次func的返回值（操作数）
+    '''
+    times = []
+    ops = None
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        ops = func(arg) if setup else func()
+        times.append(time.perf_counter() - start)
+    return {
+        'best': min(times),
+        'mean': sum(times) / len(times),
+        'repeat': repeat,
+        'ops': ops,
+    }
+
+
+class Suite:
+
+    # 每次执行前调用，返回值作为参数，不计入耗时
+    SETUP = {'xref': 'load', 'update_desc': 'copy', 'save': 'copy'}
+
+    def __init__(self, smali_dir, generator, workers=None):
+        self.smali_dir = smali_dir
+        self.generator = generator
+        self.workers = workers
+        self.sd = SmaliDir(smali_dir)
+        self.classes = [sf.get_class() for sf in self.sd]
+        self.methods = [(str(sf), mtd.get_name() + mtd.get_sign())
+                        for sf in self.sd for mtd in sf.get_methods()]
+        self.fields = [str(f) for sf in self.sd for f in sf.get_fields()]
+        self._tmp = []
+
+    def corpus(self):
+        size = 0
+        for parent, _, filenames in os.walk(self.smali_dir):
+            for filename in filenames:
+                size += os.path.getsize(os.path.join(parent, filename))
+        return {
+            'files': len(self.classes),
+            'methods': len(self.methods),
+            'fields': len(self.fields),
+            'bytes': size,
+        }
+
+    def copy(self):
+        tmp = tempfile.mkdtemp()
+        self._tmp.append(tmp)
+        path = os.path.join(tmp, 'smali')
+        shutil.copytree(self.smali_dir, path)
+        return SmaliDir(path)
+
+    def cleanup(self):
+        for tmp in self._tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self._tmp = []
+
+    def bench_load(self):
+        return len(SmaliDir(self.smali_dir))
+
+    def bench_load_parallel(self):
+        return len(SmaliDir(self.smali_dir, workers=self.workers))
+
+    def bench_load_lazy(self):
+        return len(SmaliDir(self.smali_dir, lazy=True))
+
+    def bench_get_smali_file(self):
+        for clz in self.classes:
+            self.sd.get_smali_file(clz)
+        return len(self.classes)
+
+    def bench_get_method(self):
+        for clz, mtd in self.methods:
+            self.sd.get_method(clz, mtd)
+        return len(self.methods)
+
+    def bench_get_field(self):
+        for field in self.fields:
+            self.sd.get_field(field)
+        return len(self.fields)
+
+    def load(self):
+        return SmaliDir(self.smali_dir)
+
+    def bench_xref(self, sd):
+        '''包括首次查询时建立索引的时间，不包括加载目录的时间'''
+        count = min(len(self.classes), 1000)
+        for index in range(count):
+            sd.xref(class_name(index % self.generator.classes,
+                               self.generator.packages) + '->' +
+                    method_name(0) + '(I)I')
+        return count
+
+    def bench_find(self):
+        '''按模式查找方法、字段；首次执行时包括建立属性表的时间'''
+        clz = class_name(0, self.generator.packages)
+        queries = [
+            lambda: self.sd.find_methods(return_type='I'),
+            lambda: self.sd.find_methods(name=method_name(1) + '*'),
+            lambda: self.sd.find_methods(access=['public', 'static']),
+            lambda: self.sd.find_methods(
+                desc=clz.rsplit('/', 1)[0] + '/*->*(I)I'),
+            lambda: self.sd.find_fields(field_type='Ljava/lang/String;'),
+        ]
+        count = 0
+        for query in queries:
+            count += sum(1 for _ in query())
+        return count
+
+    def bench_update_desc(self, sd):
+        '''重命名被大量引用的类和方法'''
+        clz = class_name(0, self.generator.packages)
+        sd.update_desc(clz + '->' + method_name(0) + '(I)I',
+                       clz + '->renamed(I)I')
+        sd.update_desc(clz, 'Lbench/Renamed;')
+        return 2
+
+    def bench_save(self, sd):
+        '''修改方法体后保存'''
+        count = min(len(sd), 500)
+        for sf in list(sd)[:count]:
+            mtd = sf.get_methods()[-1]
+            mtd.set_body(mtd.get_body().replace(
+                '    return v0', '    nop\n\n    return v0'))
+            sf.update()
+            sf.save()
+        return count
+
+    def run(self, names, repeat):
+        results = {}
+        for name in names:
+            func = getattr(self, 'bench_' + name)
+            setup = self.SETUP.get(name)
+            if setup:
+                setup = getattr(self, setup)
+            try:
+                results[name] = timeit(func, repeat, setup)
+            finally:
+                self.cleanup()
+            print('{:<16} {:.4f}s'.format(name, results[name]['best']),
+                  file=sys.stderr)
+        return results
+
+
+BENCHMARKS = ['load', 'load_parallel', 'load_lazy', 'get_smali_file',
+              'get_method', 'get_field', 'xref', 'find', 'update_desc',
+              'save']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--classes', type=int, default=2000)
+    parser.add_argument('--methods', type=int, default=10)
+    parser.add_argument('--body', type=int, default=30)
+    parser.add_argument('--inner', type=int, default=1)
+    parser.add_argument('--strings', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='load_parallel使用的进程数')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-b', '--bench', nargs='+', choices=BENCHMARKS,
+                        default=BENCHMARKS)
+    parser.add_argument('-o', '--output', help='JSON输出文件，默认输出到stdout')
+    args = parser.parse_args()
+
+    generator = CorpusGenerator(args.classes, args.methods, args.body,
+                                args.inner, args.strings, seed=args.seed)
+    tmp = tempfile.mkdtemp()
+    try:
+        smali_dir = os.path.join(tmp, 'smali')
+        generator.generate(smali_dir)
+        suite = Suite(smali_dir, generator, args.workers)
+        report = {
+            'version': __VERSION__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'params': generator.params(),
+            'corpus': suite.corpus(),
+            'results': suite.run(args.bench, args.repeat),
+        }
+    finally:
+        shutil.rmtree(tmp)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+'''
+生成合成的smali目录，用于基准测试
+
+python benchmarks/corpus.py out_dir --classes 1000 --methods 10 --body 30
+
+相同的参数、种子生成的目录完全相同。生成的代码包括：
+
+- 静态、实例字段，带初始值的字符串字段
+- 字符串较多的<clinit>
+- 调用其他类方法、读写字段、分支、new-instance的方法体
+- 内部类，带InnerClass注解
+'''
+import argparse
+import os
+import random
+
+HEADER = '''.class public {clz}
+.super {supper}
+.source "{source}"
+
+'''
+
+METHOD = '''.method public {name}(I{params})I
+    .registers 8
+
+{body}
+    return v0
+.end method
+
+'''
+
+CLINIT = '''.method static constructor <clinit>()V
+    .registers 2
+
+{body}
+    return-void
+.end method
+
+'''
+
+INNER_ANNOTATION = '''.annotation system Ldalvik/annotation/InnerClass;
+    accessFlags = 0x1
+    name = "{name}"
+.end annotation
+
+'''
+
+ENCLOSING_ANNOTATION = '''# annotations
+.annotation system Ldalvik/annotation/EnclosingClass;
+    value = {clz}
+.end annotation
+
+'''
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'key', 'value', 'http://',
+         'config', 'token', 'error', 'utf-8', 'AES/CBC/PKCS5Padding']
+
+
+def class_name(index, packages, inner=None):
+    name = 'Lbench/p{}/C{}'.format(index % packages, index)
+    if inner is not None:
+        name += '$I{}'.format(inner)
+    return name + ';'
+
+
+def method_name(index):
+    return 'm{}'.format(index)
+
+
+class CorpusGenerator:
+    '''
+    :param classes: 外部类的数量
+    :param methods: 每个类的方法数
+    :param body: 每个方法体的指令数
+    :param inner: 每个外部类的内部类数量
+    :param strings: 每个<clinit>中的字符串数量
+    :param fields: 每个类的字段数量
+    :param packages: 包的数量
+    :param seed: 随机数种子
+    '''
+
+    def __init__(self, classes=1000, methods=10, body=30, inner=1,
+                 strings=20, fields=4, packages=20, seed=0):
+        self.classes = classes
+        self.methods = methods
+        self.body = body
+        self.inner = inner
+        self.strings = strings
+        self.fields = fields
+        self.packages = packages
+        self.seed = seed
+
+    def params(self):
+        return dict(vars(self))
+
+    def all_classes(self):
+        for index in range(self.classes):
+            yield class_name(index, self.packages)
+            for inner in range(self.inner):
+                yield class_name(index, self.packages, inner)
+
+    def generate(self, out_dir):
+        '''
+        @return 生成的文件数
+        '''
+        rnd = random.Random(self.seed)
+        count = 0
+        for index in range(self.classes):
+            outer = class_name(index, self.packages)
+            items = [(outer, self._class(rnd, index, outer, None))]
+            for inner in range(self.inner):
+                clz = class_name(index, self.packages, inner)
+                items.append((clz, self._class(rnd, index, clz, outer)))
+
+            for clz, content in items:
+                path = os.path.join(out_dir, *clz[1:-1].split('/')) + '.smali'
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                count += 1
+        return count
+
+    def _class(self, rnd, index, clz, outer):
+        parts = [HEADER.format(
+            clz=clz, supper='Ljava/lang/Object;' if outer or index == 0 else
+            class_name(rnd.randrange(index), self.packages),
+            source='C{}.java'.format(index))]
+        if outer:
+            parts.append(ENCLOSING_ANNOTATION.format(clz=outer))
+            parts.append(
+                INNER_ANNOTATION.format(name=clz[clz.rindex('$') + 1:-1]))
+
+        parts.append('\n# static fields\n')
+        for i in range(self.fields):
+            if i % 2:
+                parts.append('.field public f{}:I\n\n'.format(i))
+            else:
+                parts.append(
+                    '.field public static s{}:Ljava/lang/String; = "{}"\n\n'
+                    .format(i, rnd.choice(WORDS)))
+
+        parts.append('\n# direct methods\n')
+        parts.append(CLINIT.format(body=self._clinit(rnd, clz)))
+        for i in range(self.methods):
+            parts.append(METHOD.format(
+                name=method_name(i), params='Ljava/lang/String;' * (i % 3),
+                body=self._body(rnd, clz)))
+        return ''.join(parts)
+
+    def _clinit(self, rnd, clz):
+        lines = []
+        for i in range(self.strings):
+            lines.append('    const-string v0, "{}_{}"\n'.format(
+                rnd.choice(WORDS), i))
+            lines.append('    sput-object v0, {}->s{}:Ljava/lang/String;\n'
+                         .format(clz, (i * 2) % max(self.fields, 1)))
+        return '\n'.join(lines)
+
+    def _body(self, rnd, clz):
+        lines = ['    const/4 v0, 0x0\n']
+        labels = 0
+        for _ in range(self.body):
+            kind = rnd.randrange(6)
+            target = class_name(rnd.randrange(self.classes), self.packages)
+            if kind == 0:
+                lines.append('    const-string v1, "{}"\n'.format(
+                    rnd.choice(WORDS)))
+            elif kind == 1:
+                lines.append(
+                    '    invoke-static {{v0}}, {}->{}(I)I\n'.format(
+                        target, method_name(0)))
+                lines.append('    move-result v0\n')
+            elif kind == 2 and self.fields > 1:
+                lines.append('    iget v1, p0, {}->f1:I\n'.format(clz))
+                lines.append('    add-int/2addr v0, v1\n')
+            elif kind == 3:
+                lines.append('    new-instance v2, {}\n'.format(target))
+                lines.append(
+                    '    invoke-direct {{v2}}, {}-><init>()V\n'.format(target))
+            elif kind == 4:
+                lines.append('    if-eqz v0, :cond_{}\n'.format(labels))
+                lines.append('    add-int/lit8 v0, v0, 0x1\n')
+                lines.append('    :cond_{}\n'.format(labels))
+                labels += 1
+            else:
+                lines.append(
+                    '    sget-object v1, {}->s0:Ljava/lang/String;\n'.format(
+                        target))
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('out_dir')
+    parser.add_argument('--classes', type=int, default=1000)
+    parser.add_argument('--methods', type=int, default=10)
+    parser.add_argument('--body', type=int, default=30)
+    parser.add_argument('--inner', type=int, default=1)
+    parser.add_argument('--strings', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generator = CorpusGenerator(args.classes, args.methods, args.body,
+                                args.inner, args.strings, seed=args.seed)
+    print(generator.generate(args.out_dir))
+
+
+if __name__ == '__main__':
+    main()
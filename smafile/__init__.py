@@ -1,5 +1,17 @@
+import array
+import bisect
+import collections
+import contextlib
+import functools
+import hashlib
+import heapq
+import itertools
+import json
 import os
 import re
+import sys
+import threading
+import time
 
 __VERSION__ = '0.4.3'
 
@@ -22,41 +34,165 @@ def java2smali(java_clz):
     return 'L{};'.format(java_clz.replace('.', '/'))
 
 
+def path2class(smali_dir, file_path):
+    '''
+    根据smali文件在目录中的相对路径，推导出类名
+
+    smali/a/b/c.smali -> La/b/c;
+    '''
+    rel_path = os.path.relpath(file_path, smali_dir)[:-len('.smali')]
+    return 'L{};'.format(rel_path.replace(os.sep, '/'))
+
+
+_DEX_DIR_PTN = re.compile(r'^smali(?:_classes(\d+))?$')
+
+
+def find_dex_dirs(root):
+    '''
+    找出apktool输出目录中每个dex对应的smali目录，按dex的顺序排列
+
+    smali、smali_classes2、... smali_classes10
+    '''
+    dex_dirs = []
+    for name in os.listdir(root):
+        m = _DEX_DIR_PTN.match(name)
+        path = os.path.join(root, name)
+        if m and os.path.isdir(path):
+            dex_dirs.append((int(m.group(1) or 1), path))
+    return [path for _, path in sorted(dex_dirs)]
+
+
+def escape_string(text):
+    '''
+    把字符串转换为smali代码中的写法，非ASCII字符、控制字符转义为\\uXXXX、\\n等
+    '''
+    return str(text.encode('unicode-escape'))[2:-1].replace('\\\\', '\\')
+
+
+def unescape_string(text):
+    '''
+    escape_string的逆过程，还原smali代码中的字符串
+    '''
+    if '\\' not in text:
+        return text
+    return text.encode('latin-1', 'backslashreplace').decode('unicode-escape')
+
+
+# 字符串常量：字符串、所在的类、方法（字段初始值则为字段）、寄存器（字段为None）
+StringRecord = collections.namedtuple(
+    'StringRecord', ['string', 'class_name', 'method', 'register'])
+
+
+def _intern(text):
+    '''
+    类名、类型、签名等描述在大量对象间重复，驻留后共享同一个字符串
+    '''
+    return text if text is None else sys.intern(text)
+
+
+# 一条指令解码后的结果：操作码、寄存器、引用（类、方法、字段、字符串、常量、标签）
+SmaliInstruction = collections.namedtuple(
+    'SmaliInstruction', ['opcode', 'registers', 'ref'])
+
+
 class SmaliLine:
     '''
     用于解析一行Smali代码
 
     按照opcode语法返回
     '''
+
+    # 正则在模块加载时编译
+    _FIELD_PTN = re.compile(
+        r'[is](?:get|put)(?:-[\w-]+)? (?P<rname>[vp]\d+), (?:[vp]\d+, )?'
+        r'(?P<cname>\S+?;)->(?P<fname>.*?):(?P<rtype>.*)')
+    _INVOKE_PTN = re.compile(
+        r'^invoke-[\w/-]+ *?{(?P<registers>.*?)}, (?P<cname>\S+?)'
+        r'->(?P<mname>.*?)\((?P<proto>.*?)\)(?P<rtype>.*?)\s*?$')
+    _STRING_INIT_PTN = re.compile(
+        r'invoke-direct {(?P<registers>.*?)}, '
+        r'Ljava/lang/String;-><init>\([\[BCI]+\)V')
+    _CONST_STRING_PTN = re.compile(
+        r'const-string(?:/jumbo)? (?P<rname>[vp]\d+), "(?P<string>.*)"$')
+    _PARAMETER_PTN = re.compile(r'(\[*(?:[BCDFIJSZ]|L[^;]+;))')
+    _WHITESPACE_PTN = re.compile(r'\s')
+    _REGISTER_PTN = re.compile(r'[vp]\d+$')
+    # 方法体中的指令行，以小写字母开头；标签、伪指令、注释除外
+    _INSTRUCTION_PTN = re.compile(
+        r'^[ \t]*([a-z][a-z0-9/-]*)(?:[ \t]+(.*?))?[ \t]*$', re.M)
+    # 解码方法体时，注解、数组数据、switch数据整块跳过
+    _BODY_PTN = re.compile(
+        r'^[ \t]*(?:\.(annotation|array-data|packed-switch|sparse-switch)\b'
+        r'.*?^[ \t]*\.end \1\b|([a-z][a-z0-9/-]*)(?:[ \t]+(.*?))?[ \t]*$)',
+        re.M | re.S)
+
+    # 操作码 -> 解析函数，在类定义之后填充
+    PARSERS = {}
+
     @staticmethod
     def parse(line):
         opcode = line.split()[0]
-        if 'invoke-static' in line:
-            return SmaliLine.parse_invoke_static(line)
+        parser = SmaliLine.PARSERS.get(opcode)
+        if parser:
+            return parser(line)
 
-        if 'invoke-virtual' in line:
-            return SmaliLine.parse_invoke_virtual(line)
+        result = SmaliLine.decode(line)
+        if result:
+            return result
 
-        if 'Ljava/lang/String;->' in line:
-            return SmaliLine.parse_string(line)
+        print('Could not parse: ' + line)
+        return
 
-        if 'move-result-object' in line:
-            return SmaliLine.parse_move(line)
+    @staticmethod
+    def decode(line):
+        '''
+        通用的指令解码，适用于所有的操作码
 
-        if 'iget' in opcode:
-            return SmaliLine.parse_iget(line)
+        @return SmaliInstruction，如果不是指令，返回None
+        '''
+        result = SmaliLine._INSTRUCTION_PTN.match(line)
+        if not result:
+            return
+        return SmaliLine._decode(*result.groups())
 
-        if 'sget-object' in line:
-            return SmaliLine.parse_sget_object(line)
+    @staticmethod
+    def decode_body(body):
+        '''
+        一次解码整个方法体，忽略标签、伪指令、注释
 
-        if 'const-string' in line:
-            return SmaliLine.parse_const_string(line)
+        @return [SmaliInstruction]
+        '''
+        decode = SmaliLine._decode
+        return [decode(opcode, operands)
+                for _, opcode, operands in SmaliLine._BODY_PTN.findall(body)
+                if opcode]
 
-        if 'sget ' in line:
-            return SmaliLine.parse_sget(line)
+    @staticmethod
+    def _decode(opcode, operands):
+        if not operands:
+            return SmaliInstruction(opcode, (), None)
+
+        if operands.startswith('{'):
+            # invoke-virtual {v0, v1}, La;->b(I)V
+            # invoke-virtual/range {v0 .. v5}, La;->b(IIIII)V
+            end = operands.index('}')
+            regs = operands[1:end]
+            if ' .. ' in regs:
+                registers = tuple(regs.split(' .. '))
+            else:
+                registers = tuple(
+                    r.strip() for r in regs.split(',') if r.strip())
+            return SmaliInstruction(
+                opcode, registers, operands[end + 3:] or None)
 
-        print('Could not parse: ' + line)
-        return
+        # 寄存器在前，最后是引用；字符串中的逗号需要还原
+        parts = operands.split(', ')
+        index = 0
+        match = SmaliLine._REGISTER_PTN.match
+        while index < len(parts) and match(parts[index]):
+            index += 1
+        ref = ', '.join(parts[index:]) or None
+        return SmaliInstruction(opcode, tuple(parts[:index]), ref)
 
     @staticmethod
     def parse_const_string(line):
@@ -65,10 +201,19 @@ class SmaliLine:
 
         Puts reference to a string constant identified by string_id into vx.
         '''
-        arrs = line.strip().split()
-        vx = arrs[1][:-1]
-        string_id = arrs[2][1:-1]
-        return (vx, string_id)
+        result = SmaliLine._CONST_STRING_PTN.match(line.strip())
+        return (result['rname'], result['string'])
+
+    @staticmethod
+    def parse_const(line):
+        '''
+        const/4 v0, 0x1
+        const-wide/16 v0, 0x64
+
+        @return 寄存器名、常量
+        '''
+        _, rname, value = line.split(None, 2)
+        return rname[:-1], value.strip()
 
     @staticmethod
     def parse_sget(line):
@@ -77,11 +222,29 @@ class SmaliLine:
 
         @return 类名、字段名、返回类型、寄存器名
         '''
-        REG = (
-            r'sget (?P<rname>.*?), '
-            r'(?P<cname>.*?;)->(?P<fname>.*?):(?P<rtype>.*)'
-        )
-        result = re.match(REG, line.strip())
+        return SmaliLine._parse_field(line)
+
+    @staticmethod
+    def parse_sput(line):
+        '''
+        sput-object v0, La/b;->c:Ljava/lang/String;
+
+        @return 类名、字段名、类型、寄存器名
+        '''
+        return SmaliLine._parse_field(line)
+
+    @staticmethod
+    def parse_iput(line):
+        '''
+        iput-boolean v0, p0, La/b;->c:Z
+
+        @return 类名、字段名、类型、寄存器名
+        '''
+        return SmaliLine._parse_field(line)
+
+    @staticmethod
+    def _parse_field(line):
+        result = SmaliLine._FIELD_PTN.match(line.strip())
         cname = smali2java(result['cname'])
         return cname, result['fname'], result['rtype'], result['rname']
 
@@ -92,16 +255,7 @@ class SmaliLine:
 
         @return 返回(调用类名、方法名、参数类型、返回值类型、寄存器的值)
         '''
-        INVOKE_STATIC_NORMAL = (
-            r'^invoke-static.*?{(?P<registers>.*?)}, (?P<cname>.*?;)'
-            r'->(?P<mname>.*?)\((?P<proto>.*?)\)(?P<rtype>.*?)\s*?$')
-        result = re.match(INVOKE_STATIC_NORMAL, line.strip())
-
-        cname = result['cname'].replace('/', '.')[1:-1]
-        ptypes = SmaliLine.parse_proto(result['proto'])
-        rnames = re.sub('\s', '', result['registers']).split(',')
-
-        return cname, result['mname'], ptypes, result['rtype'], rnames
+        return SmaliLine._parse_invoke(line, 0)
 
     @staticmethod
     def parse_invoke_virtual(line):
@@ -110,247 +264,2146 @@ class SmaliLine:
 
         @return 返回(调用类名、方法名、参数类型、返回值类型、寄存器的值)
         '''
-        INVOKE_STATIC_NORMAL = (
-            r'^invoke-virtual.*?{(?P<registers>.*?)}, (?P<cname>.*?;)'
-            r'->(?P<mname>.*?)\((?P<proto>.*?)\)(?P<rtype>.*?)\s*?$')
-        result = re.match(INVOKE_STATIC_NORMAL, line.strip())
+        return SmaliLine._parse_invoke(line, 1)
+
+    @staticmethod
+    def parse_invoke(line):
+        '''
+        解析invoke-super、invoke-interface等实例方法的调用，与invoke-virtual一致，
+        寄存器不包括this
+        '''
+        return SmaliLine._parse_invoke(line, 1)
 
-        cname = result['cname'].replace('/', '.')[1:-1]
+    @staticmethod
+    def parse_invoke_direct(line):
+        '''
+        解析invoke-direct语句，String的构造函数按照parse_string解析
+        '''
+        if 'Ljava/lang/String;-><init>' in line:
+            return SmaliLine.parse_string(line)
+        return SmaliLine._parse_invoke(line, 1)
+
+    @staticmethod
+    def _parse_invoke(line, skip):
+        result = SmaliLine._INVOKE_PTN.match(line.strip())
+
+        cname = result['cname']
+        if cname.startswith('L'):
+            cname = cname.replace('/', '.')[1:-1]
         ptypes = SmaliLine.parse_proto(result['proto'])
-        rnames = re.sub('\s', '', result['registers']).split(',')[1:]
+        rnames = SmaliLine._WHITESPACE_PTN.sub(
+            '', result['registers']).split(',')[skip:]
 
         return cname, result['mname'], ptypes, result['rtype'], rnames
 
     @staticmethod
     def parse_string(line):
         '''
-        解析字符串相关函数
+        解析字符串相关函数
+
+        @return 返回值类型、操作寄存器名
+        '''
+        result = SmaliLine._STRING_INIT_PTN.match(line.strip())
+
+        if result:
+            rnames = SmaliLine._WHITESPACE_PTN.sub(
+                '', result['registers']).split(',')
+            return rnames[0], rnames
+        else:
+            return None, None
+
+    @staticmethod
+    def parse_proto(proto):
+        '''
+        解析方法原型
+        '''
+        return SmaliLine._PARAMETER_PTN.findall(proto)
+
+    @staticmethod
+    def parse_move(line):
+        '''
+        move-result-object vx
+
+        @return 返回寄存器名 vx
+        '''
+        return line.strip().split()[1]
+
+    @staticmethod
+    def parse_type(line):
+        '''
+        new-instance v0, La/b;
+        check-cast v0, [La/b;
+        const-class v0, La/b;
+
+        @return 类名、寄存器名
+        '''
+        _, rname, clz = line.split(None, 2)
+        clz = clz.strip()
+        if clz.startswith('L'):
+            clz = smali2java(clz)
+        return clz, rname[:-1]
+
+    @staticmethod
+    def parse_iget(line):
+        '''
+        iget v0, p0, Lcom/a/b/c;->g:I
+        iget-object v0, p0, Lcom/android/unit/d;->a:Landroid/content/Context;
+
+        @return 类名、字段名、返回类型、寄存器名
+        '''
+        return SmaliLine._parse_field(line)
+
+    @staticmethod
+    def parse_sget_object(line):
+        '''
+        sget-object v0, Lcom/c/a/a/f;->b:[B
+
+        @return 类名、字段名、返回类型、寄存器名
+        '''
+        return SmaliLine._parse_field(line)
+
+
+def _init_line_parsers():
+    parsers = SmaliLine.PARSERS
+    for suffix in ('', '/range'):
+        parsers['invoke-static' + suffix] = SmaliLine.parse_invoke_static
+        parsers['invoke-virtual' + suffix] = SmaliLine.parse_invoke_virtual
+        parsers['invoke-direct' + suffix] = SmaliLine.parse_invoke_direct
+        parsers['invoke-super' + suffix] = SmaliLine.parse_invoke
+        parsers['invoke-interface' + suffix] = SmaliLine.parse_invoke
+
+    for suffix in ('', '-wide', '-object', '-boolean', '-byte', '-char',
+                   '-short'):
+        parsers['iget' + suffix] = SmaliLine.parse_iget
+        parsers['iput' + suffix] = SmaliLine.parse_iput
+        parsers['sget' + suffix] = SmaliLine.parse_sget
+        parsers['sput' + suffix] = SmaliLine.parse_sput
+    parsers['sget-object'] = SmaliLine.parse_sget_object
+
+    for opcode in ('move-result', 'move-result-wide', 'move-result-object',
+                   'move-exception'):
+        parsers[opcode] = SmaliLine.parse_move
+
+    for opcode in ('const-string', 'const-string/jumbo'):
+        parsers[opcode] = SmaliLine.parse_const_string
+
+    for opcode in ('const/4', 'const/16', 'const', 'const/high16',
+                   'const-wide/16', 'const-wide/32', 'const-wide',
+                   'const-wide/high16'):
+        parsers[opcode] = SmaliLine.parse_const
+
+    for opcode in ('new-instance', 'check-cast', 'const-class'):
+        parsers[opcode] = SmaliLine.parse_type
+
+
+_init_line_parsers()
+
+
+_CLASS_PTN = re.compile(r'\.class[a-z\s]+(.+)')
+
+
+class Profiler:
+    '''
+    统计各阶段的次数、累计耗时，以及耗时最长的文件
+
+    阶段包括：walk（遍历目录）、read（读取文件）、decode（去掉.line、解码）、
+    cache（读写缓存）、scan（扫描字段、方法）、build（生成字段、方法对象）、
+    index（建立索引）、save（写入文件）、reparse（保存后重新解析）、
+    xref_index、call_graph、hierarchy。
+    '''
+
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.counts = collections.Counter()
+        self.times = collections.Counter()
+        self.counters = collections.Counter()  # 事件计数，如缓存命中
+        self._files = []  # 最小堆：(耗时, 文件路径)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, elapsed, count=1):
+        self.counts[name] += count
+        self.times[name] += elapsed
+
+    def count(self, name, count=1):
+        self.counters[name] += count
+
+    def timed(self, iterable, name):
+        '''统计遍历iterable时，每次取下一项的耗时'''
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start, 0)
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def add_file(self, file_path, elapsed):
+        item = (elapsed, file_path)
+        if len(self._files) < self.slowest:
+            heapq.heappush(self._files, item)
+        elif item > self._files[0]:
+            heapq.heapreplace(self._files, item)
+
+    def merge(self, other):
+        '''合并子进程中的统计结果'''
+        self.counts.update(other.counts)
+        self.times.update(other.times)
+        self.counters.update(other.counters)
+        for elapsed, file_path in other._files:
+            self.add_file(file_path, elapsed)
+
+    def stats(self):
+        return {
+            'phases': {name: {'count': self.counts[name],
+                              'time': self.times[name]}
+                       for name in self.counts},
+            'counters': dict(self.counters),
+            'slowest_files': [{'file': file_path, 'time': elapsed}
+                              for elapsed, file_path in
+                              sorted(self._files, reverse=True)],
+        }
+
+
+_NO_PHASE = contextlib.nullcontext()
+
+
+def _phase(profiler, name):
+    '''
+    没有开启统计时，返回一个什么都不做的上下文，几乎没有额外开销
+    '''
+    return profiler.phase(name) if profiler else _NO_PHASE
+
+
+# .line语句，连同前面的空白一起去掉；统一换行符
+_LINE_PTN = re.compile(r'\s*?\.line \d+')
+_CR_PTN = re.compile(r'\r\n?')
+_LINE_CR_PTN = re.compile(r'(\s*?\.line \d+)|\r\n?')
+
+
+def _read_file(file_path, profiler=None):
+    '''
+    读取文件的原始内容，以及读取前的文件状态
+
+    先取状态再读取：读取时文件被修改，记录的状态会与磁盘不一致，refresh时重新解析。
+
+    @return (bytes, os.stat_result)
+    '''
+    with open(file_path, 'rb') as f:
+        with _phase(profiler, 'read'):
+            stat = os.fstat(f.fileno())
+            return f.read(), stat
+
+
+def _stat_key(stat):
+    '''
+    refresh用来判断文件是否变化的(修改时间, 大小)
+    '''
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _decode_smali(raw):
+    '''
+    解码，去掉.line语句、统一换行符，结果与文本模式读取后再去掉.line语句一致
+    '''
+    content = str(raw, 'utf-8')
+    has_cr = '\r' in content
+    if '.line ' in content:
+        if has_cr:
+            return _LINE_CR_PTN.sub(
+                lambda m: '' if m.group(1) else '\n', content)
+        return _LINE_PTN.sub('', content)
+    if has_cr:
+        return _CR_PTN.sub('\n', content)
+    return content
+
+
+def read_smali_file(file_path):
+    '''
+    读取smali文件，并去掉.line语句
+
+    @return 代码
+    '''
+    return _decode_smali(_read_file(file_path)[0])
+
+
+def parse_smali_file(file_path, cache=None, profiler=None):
+    '''
+    读取并解析smali文件，不依赖SmaliFile对象，可以在子进程中执行
+
+    只扫描一遍代码，找出类名、父类、字段以及每个方法的边界。
+
+    方法体只记录在代码中的起止位置，避免在进程间重复传递。
+
+    :param cache: ParseCache，如果缓存有效，则直接使用缓存的解析结果
+    :param profiler: Profiler，统计各阶段的耗时
+    @return 代码、类名、父类、接口列表、字段列表[(声明语句, 起始位置, 结束位置)]、方法列表[(方法声明, 方法体起始位置, 方法体结束位置)]
+    '''
+    return _parse_file(file_path, cache, profiler)[0]
+
+
+def _parse_file(file_path, cache=None, profiler=None):
+    '''
+    同parse_smali_file，同时返回读取时文件的(修改时间, 大小)，见_stat_key
+    '''
+    raw, stat = _read_file(file_path, profiler)
+    with _phase(profiler, 'decode'):
+        content = _decode_smali(raw)
+
+    if cache:
+        with _phase(profiler, 'cache'):
+            meta = cache.load(file_path, stat, raw)
+        if profiler:
+            profiler.count('cache_hits' if meta else 'cache_misses')
+        if meta:
+            return (content,) + meta, _stat_key(stat)
+
+    with _phase(profiler, 'scan'):
+        parsed = parse_smali_content(content)
+
+    if cache:
+        with _phase(profiler, 'cache'):
+            cache.store(file_path, stat, raw, parsed[1:])
+
+    return parsed, _stat_key(stat)
+
+
+def _child_parse(file_path, cache=None, profile=False):
+    '''
+    在子进程中解析文件；子进程中的缓存命中次数、各阶段的耗时不会同步到主进程，一并返回
+
+    代码由主进程保存，只能传回；字段的声明语句、方法声明都是代码的一部分，
+    只传回位置，由主进程截取，见_unpack_parsed。
+
+    @return 解析结果、读取时文件的(修改时间, 大小)、缓存的(命中, 未命中)次数、
+            Profiler（profile为False时为None）
+    '''
+    profiler = Profiler() if profile else None
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    start = time.perf_counter()
+    parsed, stat = _parse_file(file_path, cache, profiler)
+    if profiler:
+        profiler.add_file(file_path, time.perf_counter() - start)
+    if cache:
+        hits, misses = cache.hits - hits, cache.misses - misses
+
+    content, clz, supper, interfaces, fields, methods = parsed
+    fields = [(start, end) for _, start, end in fields]
+    # 方法声明在方法体之前的一行，以换行符结束
+    methods = [(start - 1 - len(mtd_sign), start, end)
+               for mtd_sign, start, end in methods]
+    return ((content, clz, supper, interfaces, fields, methods), stat,
+            (hits, misses), profiler)
+
+
+def _unpack_parsed(packed):
+    '''
+    根据_child_parse传回的位置，还原parse_smali_file的解析结果
+    '''
+    content, clz, supper, interfaces, fields, methods = packed
+    fields = [(content[start:end], start, end) for start, end in fields]
+    methods = [(content[sign_start:start - 1], start, end)
+               for sign_start, start, end in methods]
+    return content, clz, supper, interfaces, fields, methods
+
+
+def parse_smali_content(content):
+    '''
+    解析已经读入内存的smali代码，返回值与parse_smali_file一致
+    '''
+    return (content,) + _scan_smali(content)[:5]
+
+
+def _scan_smali(content, pos=0, stop=None):
+    '''
+    扫描代码中[pos, stop)的部分，pos必须是方法之外的某一行的行首
+
+    @return 类名、父类、接口列表、字段列表、方法列表、扫描结束的位置
+    '''
+    clz = None
+    supper = None
+    interfaces = []
+    fields = []
+    methods = []
+
+    # 逐行扫描方法体之外的语句；遇到方法时，直接跳到.end method
+    size = len(content)
+    if stop is None:
+        stop = size
+    while pos < stop:
+        eol = content.find('\n', pos)
+        if eol == -1:
+            eol = size
+        line = content[pos:eol].lstrip()
+
+        if not line.startswith('.'):
+            pass
+        elif line.startswith('.method ') and pos > 0:
+            start = eol + 1
+            end = content.find('.end method', start)
+            methods.append((line[8:], start, end))
+            eol = content.find('\n', end)
+            if end == -1 or eol == -1:
+                eol = size
+        elif line.startswith('.field '):
+            if eol < size:
+                fields.append((line, eol - len(line), eol))
+        elif line.startswith('.class') and clz is None:
+            clz = _CLASS_PTN.match(line).groups()[0]
+        elif line.startswith('.super ') and supper is None:
+            supper = line[7:]
+        elif line.startswith('.implements '):
+            interfaces.append(line[12:])
+
+        pos = eol + 1
+
+    return clz, supper, interfaces, fields, methods, pos
+
+
+def _common_prefix(a, b):
+    '''
+    a、b相同前缀的长度，按块比较，避免逐个字符比较
+    '''
+    size = min(len(a), len(b))
+    block = 4096
+    pos = 0
+    while pos < size and a[pos:pos + block] == b[pos:pos + block]:
+        pos += block
+    if pos >= size:
+        return size
+
+    lo, hi = pos, min(pos + block, size)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[pos:mid] == b[pos:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix(a, b, limit):
+    '''
+    a、b相同后缀的长度，不超过limit
+    '''
+    la, lb = len(a), len(b)
+    block = 4096
+    pos = 0
+    while pos < limit:
+        n = min(block, limit - pos)
+        if a[la - pos - n:la - pos] != b[lb - pos - n:lb - pos]:
+            break
+        pos += n
+    else:
+        return limit
+
+    lo, hi = pos, pos + n
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[la - mid:la - pos] == b[lb - mid:lb - pos]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def parse_class_name(content):
+    '''
+    仅解析类名，不扫描整个文件
+    '''
+    pos = 0
+    while True:
+        eol = content.find('\n', pos)
+        line = content[pos:eol if eol != -1 else len(content)].lstrip()
+        if line.startswith('.class'):
+            return _CLASS_PTN.match(line).groups()[0]
+        if eol == -1 or line.startswith('.method '):
+            return
+        pos = eol + 1
+
+
+def _scan_header(content):
+    '''
+    只扫描第一个字段、方法之前的部分
+
+    @return 父类、接口列表
+    '''
+    supper = None
+    interfaces = []
+    pos = 0
+    while True:
+        eol = content.find('\n', pos)
+        line = content[pos:eol if eol != -1 else len(content)].lstrip()
+        if line.startswith(('.field ', '.method ')):
+            break
+        if line.startswith('.super ') and supper is None:
+            supper = line[7:]
+        elif line.startswith('.implements '):
+            interfaces.append(line[12:])
+        if eol == -1:
+            break
+        pos = eol + 1
+    return supper, interfaces
+
+
+def _write_file(file_path, content):
+    '''
+    先写入临时文件，再替换，避免中断时留下写了一半的文件
+    '''
+    tmp_path = _write_temp_file(file_path, content)
+    os.replace(tmp_path, file_path)
+
+
+def _write_temp_file(file_path, content):
+    new_dir = os.path.dirname(file_path)
+    if new_dir and not os.path.exists(new_dir):
+        os.makedirs(new_dir)
+
+    tmp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    return tmp_path
+
+
+class ParseCache:
+    '''
+    smali文件解析结果的磁盘缓存
+
+    每个文件对应一个缓存项，记录文件路径、修改时间、大小、内容的哈希值，
+    以及类名、父类、接口、字段声明、方法声明和方法体的位置。
+    读取时，只要有一项不一致，缓存就会失效，并被新的解析结果覆盖。
+    '''
+
+    VERSION = 3
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, file_path):
+        key = hashlib.sha1(
+            os.path.abspath(file_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    @staticmethod
+    def _fingerprint(file_path, stat, raw):
+        return {
+            'version': ParseCache.VERSION,
+            'path': os.path.abspath(file_path),
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'hash': hashlib.sha1(raw).hexdigest(),
+        }
+
+    def load(self, file_path, stat, raw):
+        '''
+        @return 缓存的解析结果（不包含代码），如果缓存不存在或者已失效，返回None
+        '''
+        try:
+            with open(self._entry_path(file_path), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return
+
+        data = entry.pop('data', None)
+        if data is None or entry != self._fingerprint(file_path, stat, raw):
+            self.misses += 1
+            return
+
+        self.hits += 1
+        clz, supper, interfaces, fields, methods = data
+        return (clz, supper, interfaces, [tuple(f) for f in fields],
+                [tuple(m) for m in methods])
+
+    def store(self, file_path, stat, raw, data):
+        entry = self._fingerprint(file_path, stat, raw)
+        entry['data'] = data
+
+        _write_file(self._entry_path(file_path), json.dumps(entry))
+
+    def remove(self, file_path):
+        try:
+            os.remove(self._entry_path(file_path))
+        except OSError:
+            pass
+
+
+def _map_parallel(func, items, workers=None):
+    '''
+    使用进程池执行func，结果的顺序与items一致；workers小于等于1时，直接在当前进程执行
+    '''
+    if not workers or workers <= 1:
+        yield from map(func, items)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    chunksize = max(1, len(items) // (workers * 4))
+    with ProcessPoolExecutor(workers) as pool:
+        yield from pool.map(func, items, chunksize=chunksize)
+
+
+def _map_chunk(func, chunk):
+    return [func(item) for item in chunk]
+
+
+def _imap_parallel(func, items, workers, limit=None, chunksize=16):
+    '''
+    同_map_parallel，items可以是生成器：只创建一个进程池，每次提交chunksize项，
+    最多同时提交limit项（默认不限制），内存占用与items的数量无关
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    window = max(1, limit // chunksize) if limit else None
+    items = iter(items)
+    pending = collections.deque()
+    with ProcessPoolExecutor(workers) as pool:
+        try:
+            while True:
+                while window is None or len(pending) < window:
+                    chunk = list(itertools.islice(items, chunksize))
+                    if not chunk:
+                        break
+                    pending.append(pool.submit(_map_chunk, func, chunk))
+                if not pending:
+                    return
+                yield from pending.popleft().result()
+        finally:
+            # 提前结束遍历时，不再执行还没有开始的任务
+            for future in pending:
+                future.cancel()
+
+
+# 代码中引用类、方法、字段的语句，如：
+# invoke-virtual {p0}, La/b;->c()V
+# iget-object v0, p0, La/b;->c:Ljava/lang/String;
+# check-cast v0, [La/b;
+# 只匹配最后一个操作数，即->的所属类；数组只记录元素的类，基本类型的数组不记录
+_XREF_PTN = re.compile(
+    r'^[ \t]*(?:invoke-[\w/-]+|[is](?:get|put)[\w-]*|const-class|'
+    r'new-instance|check-cast)\s.*,[ \t]*'
+    r'(?:\[+(L[^;\s]+;)(?:->\S+)?|(L[^;\s]+;)(?:->(\S+))?)[ \t]*$', re.M)
+
+
+def _iter_xrefs(body):
+    '''
+    方法体引用的类、方法、字段
+
+    @return (类名, 方法或字段)，只引用了类时，方法或字段为None
+    '''
+    for array_clz, clz, member in _XREF_PTN.findall(body):
+        if array_clz:
+            yield array_clz, None
+        else:
+            yield clz, member or None
+
+
+def _scan_refs(bodies):
+    '''
+    找出方法体中引用的方法、字段
+
+    @return (方法描述的集合, 字段描述的集合)
+    '''
+    methods = set()
+    fields = set()
+    for body in bodies:
+        for clz, member in _iter_xrefs(body):
+            if not member:
+                continue
+            desc = clz + '->' + member
+            (methods if '(' in member else fields).add(desc)
+    return methods, fields
+
+
+# 方法调用语句，如：invoke-virtual/range {v0 .. v2}, La/b;->c(II)V
+_INVOKE_PTN = re.compile(
+    r'^[ \t]*invoke-(?:virtual|static|direct|super|interface)(?:/range)?'
+    r'\s+\{[^}]*\},\s*(\S+->\S+)[ \t]*$', re.M)
+
+
+def _scan_calls(bodies):
+    '''
+    找出每个方法体调用的方法，同一个方法只记录一次
+
+    @return [(被调用的方法描述, ...), ...]，与bodies的顺序一致
+    '''
+    return [tuple(dict.fromkeys(_INVOKE_PTN.findall(body))) for body in bodies]
+
+
+# const-string v0, "..."，字符串中的引号、反斜杠都已转义
+_STRING_PTN = re.compile(
+    r'^[ \t]*const-string(?:/jumbo)?[ \t]+([vp]\d+),[ \t]*'
+    r'"((?:[^"\\\n]|\\.)*)"[ \t]*$', re.M)
+
+
+def _scan_strings(bodies):
+    '''
+    找出每个方法体中的字符串常量
+
+    @return [[(字符串, 寄存器), ...], ...]，与bodies的顺序一致
+    '''
+    return [[(unescape_string(string), register)
+             for register, string in _STRING_PTN.findall(body)]
+            for body in bodies]
+
+
+def _string_records(sf, scanned, strings):
+    '''
+    :param scanned: _scan_strings对该文件所有方法体的扫描结果
+    :param strings: 已经出现过的字符串，相同的字符串只保留一个对象
+    @return StringRecord
+    '''
+    clz = sf.get_class()
+    for field in sf.get_fields():
+        value = field.get_value()
+        if value is None or field.get_type() != 'Ljava/lang/String;':
+            continue
+        value = unescape_string(value)
+        yield StringRecord(strings.setdefault(value, value), clz,
+                           field.get_reference_sm(), None)
+
+    for mtd, items in zip(sf.get_methods(), scanned):
+        desc = str(mtd)
+        for string, register in items:
+            yield StringRecord(strings.setdefault(string, string), clz, desc,
+                               register)
+
+
+class CallGraph:
+    '''
+    方法调用图，边使用CSR格式保存：
+
+    - 节点编号：先是已定义的方法，再是只被调用、没有定义的方法（如系统API）
+    - callees：offsets[i]到offsets[i + 1]之间的targets，是节点i调用的方法
+    - callers：同样的格式，保存反向的边
+    '''
+
+    def __init__(self, methods, calls):
+        '''
+        :param methods: 已定义的方法描述
+        :param calls: 每个方法调用的方法描述，与methods的顺序一致
+        '''
+        self._nodes = list(methods)
+        self._ids = {}
+        # 重复定义的方法，以第一个为准，与SmaliDir的索引一致
+        for i, desc in enumerate(self._nodes):
+            self._ids.setdefault(desc, i)
+
+        self._offsets = array.array('I', [0])
+        self._targets = array.array('I')
+        for callees in calls:
+            for desc in callees:
+                self._targets.append(self._node_id(desc))
+            self._offsets.append(len(self._targets))
+        # 没有定义的方法，没有出边
+        self._offsets.extend(
+            [len(self._targets)] * (len(self._nodes) + 1 - len(self._offsets)))
+
+        self._rev_offsets, self._rev_sources = self._reverse()
+
+    def _node_id(self, desc):
+        index = self._ids.get(desc)
+        if index is None:
+            index = self._ids[desc] = len(self._nodes)
+            self._nodes.append(desc)
+        return index
+
+    def _reverse(self):
+        '''计数排序，生成反向边'''
+        count = len(self._nodes)
+        offsets = array.array('I', [0]) * (count + 1)
+        for target in self._targets:
+            offsets[target + 1] += 1
+        for i in range(count):
+            offsets[i + 1] += offsets[i]
+
+        sources = array.array('I', [0]) * len(self._targets)
+        pos = offsets[:-1]
+        for source in range(count):
+            for i in range(self._offsets[source], self._offsets[source + 1]):
+                target = self._targets[i]
+                sources[pos[target]] = source
+                pos[target] += 1
+        return offsets, sources
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, desc):
+        return str(desc) in self._ids
+
+    def edge_count(self):
+        return len(self._targets)
+
+    def _neighbors(self, desc, offsets, targets):
+        index = self._ids.get(str(desc))
+        if index is None:
+            return []
+        return [self._nodes[i] for i in
+                targets[offsets[index]:offsets[index + 1]]]
+
+    def callees(self, desc):
+        '''该方法调用的方法描述'''
+        return self._neighbors(desc, self._offsets, self._targets)
+
+    def callers(self, desc):
+        '''调用了该方法的方法描述'''
+        return self._neighbors(desc, self._rev_offsets, self._rev_sources)
+
+    def reachable(self, desc, reverse=False):
+        '''
+        从该方法出发，直接或间接调用的所有方法，不包括自身（除非存在递归）
+
+        :param reverse: 为True时，返回直接或间接调用了该方法的所有方法
+        '''
+        index = self._ids.get(str(desc))
+        if index is None:
+            return []
+        if reverse:
+            offsets, targets = self._rev_offsets, self._rev_sources
+        else:
+            offsets, targets = self._offsets, self._targets
+
+        visited = bytearray(len(self._nodes))
+        result = []
+        stack = [index]
+        while stack:
+            node = stack.pop()
+            for i in targets[offsets[node]:offsets[node + 1]]:
+                if not visited[i]:
+                    visited[i] = 1
+                    result.append(self._nodes[i])
+                    stack.append(i)
+        return result
+
+
+class ClassHierarchy:
+    '''
+    类的继承关系，包括父类、接口；传递闭包在首次查询时计算，之后直接返回
+    '''
+
+    def __init__(self, classes):
+        '''
+        :param classes: 类名 -> (父类, 接口列表)
+        '''
+        self._supers = {}
+        self._interfaces = {}
+        self._children = {}  # 类名 -> 直接继承、实现它的类
+        for clz, (supper, interfaces) in classes.items():
+            self._supers[clz] = supper
+            self._interfaces[clz] = tuple(interfaces)
+            for parent in ([supper] if supper else []) + list(interfaces):
+                self._children.setdefault(parent, []).append(clz)
+
+        self._ancestors = {}
+        self._descendants = {}
+
+    def __contains__(self, clz):
+        return clz in self._supers
+
+    def get_super(self, clz):
+        return self._supers.get(clz)
+
+    def get_interfaces(self, clz):
+        return list(self._interfaces.get(clz, ()))
+
+    def superclasses(self, clz):
+        '''
+        父类链，从直接父类开始，到第一个不在目录中的类（如Ljava/lang/Object;）为止
+        '''
+        result = []
+        supper = self._supers.get(clz)
+        while supper and supper not in result:
+            result.append(supper)
+            supper = self._supers.get(supper)
+        return result
+
+    def ancestors(self, clz):
+        '''所有直接、间接的父类和接口'''
+        return list(self._closure(clz, self._ancestors, self._parents))
+
+    def descendants(self, clz):
+        '''所有直接、间接继承、实现了该类（接口）的类'''
+        return list(self._closure(clz, self._descendants,
+                                  lambda x: self._children.get(x, ())))
+
+    def implementers(self, interface):
+        '''
+        所有直接、间接实现了该接口的类，包括继承了该接口的接口和实现类的子类
+        '''
+        return self.descendants(interface)
+
+    def is_subtype(self, clz, parent):
+        return clz == parent or parent in self._closure(
+            clz, self._ancestors, self._parents)
+
+    def _parents(self, clz):
+        supper = self._supers.get(clz)
+        return ([supper] if supper else []) + list(self._interfaces.get(clz, ()))
+
+    @staticmethod
+    def _closure(clz, cache, edges):
+        '''
+        沿着edges计算传递闭包，结果按类名缓存，子节点的闭包也一并缓存
+        '''
+        result = cache.get(clz)
+        if result is not None:
+            return result
+
+        # 先占位，出现环时不会无限递归
+        cache[clz] = {}
+        closure = {}
+        for item in edges(clz):
+            closure[item] = None
+            closure.update(ClassHierarchy._closure(item, cache, edges))
+        closure.pop(clz, None)
+        cache[clz] = closure
+        return closure
+
+
+class MemberTable:
+    """
+    方法或字段的列式属性表，按类名、名字、返回类型、访问标志等条件查找
+
+    每一列只保存属性值的编号，相同的值只保存一次；每个值记录所在的行，
+    值按字符串排序，带通配符的条件先用固定的前缀二分查找，缩小匹配的范围。
+    查找时，只对不同的值做匹配，结果按行的顺序逐个返回。
+    """
+
+    def __init__(self, members, columns, multi=()):
+        """
+        :param members: SmaliMethod或SmaliField的列表
+        :type members: list
+        :param columns: 列名 -> 取值函数，如 {'name': SmaliMethod.get_name}
+        :type columns: dict
+        :param multi: 有多个值的列，如参数类型、访问标志，取值函数返回列表
+        :type multi: tuple
+        """
+        self._members = list(members)
+        self._multi = set(multi)
+        self._values = {}  # 列名 -> _Interner
+        self._ids = {}  # 列名 -> 每行的值编号；多值的列为CSR格式：(offsets, ids)
+        self._rows = {}  # 列名 -> {值编号: 所在的行}
+        self._sorted = {}  # 列名 -> 排序后的值，首次前缀查询时建立
+
+        for column, getter in columns.items():
+            values = self._values[column] = _Interner()
+            rows = self._rows[column] = {}
+            ids = array.array('I')
+            if column in self._multi:
+                offsets = array.array('I', [0])
+                for row, member in enumerate(self._members):
+                    for value in getter(member):
+                        index = values.intern(value)
+                        ids.append(index)
+                        rows.setdefault(index, array.array('I')).append(row)
+                    offsets.append(len(ids))
+                self._ids[column] = (offsets, ids)
+            else:
+                for row, member in enumerate(self._members):
+                    index = values.intern(getter(member))
+                    ids.append(index)
+                    rows.setdefault(index, array.array('I')).append(row)
+                self._ids[column] = ids
+
+    def __len__(self):
+        return len(self._members)
+
+    def columns(self):
+        return list(self._values)
+
+    def _sorted_values(self, column):
+        if column not in self._sorted:
+            values = self._values[column]
+            self._sorted[column] = sorted(
+                values.value(i) for i in range(1, len(values)))
+        return self._sorted[column]
+
+    def _match(self, column, pattern):
+        """
+        匹配的值编号
+
+        :param pattern: 字符串时，*匹配任意个字符，?匹配一个字符，其他字符原样匹配；
+            正则表达式（re.compile的结果）时，匹配值中的任意位置
+        """
+        values = self._values[column]
+        if isinstance(pattern, str) and '*' not in pattern and \
+                '?' not in pattern:
+            index = values.index(pattern)
+            return set() if index is None else {index}
+
+        if isinstance(pattern, str):
+            prefix = re.split(r'[*?]', pattern, maxsplit=1)[0]
+            regex = re.compile(''.join(
+                '.*' if part == '*' else '.' if part == '?' else re.escape(part)
+                for part in re.split(r'([*?])', pattern)), re.S)
+            match = regex.fullmatch
+            candidates = self._sorted_values(column)
+            if prefix:
+                # 以prefix开头的值在排序后连续
+                start = bisect.bisect_left(candidates, prefix)
+                stop = bisect.bisect_left(candidates, prefix + '\U0010ffff')
+                candidates = candidates[start:stop]
+        else:
+            match = pattern.search
+            candidates = (values.value(i) for i in range(1, len(values)))
+        return {values.index(value) for value in candidates if match(value)}
+
+    def _has(self, column, row, matched):
+        if column in self._multi:
+            offsets, ids = self._ids[column]
+            return any(index in matched
+                       for index in ids[offsets[row]:offsets[row + 1]])
+        return self._ids[column][row] in matched
+
+    def query(self, **criteria):
+        """
+        逐个返回满足所有条件的方法、字段，按行的顺序
+
+        table.query(return_type='Ljavax/crypto/Cipher;', access='native')
+
+        :param criteria: 列名 -> 匹配的模式，见_match；多值的列，
+            有一个值匹配即可；值为列表时，每一项都要匹配，如access=['public', 'static']
+        """
+        conditions = []
+        for column, patterns in criteria.items():
+            if patterns is None:
+                continue
+            if column not in self._values:
+                raise KeyError('unknown column: {}'.format(column))
+            if isinstance(patterns, (list, tuple)):
+                patterns = list(patterns)
+            else:
+                patterns = [patterns]
+            for pattern in patterns:
+                matched = self._match(column, pattern)
+                if not matched:
+                    return iter(())
+                rows = self._rows[column]
+                count = sum(len(rows[index]) for index in matched)
+                conditions.append((count, column, matched))
+        return self._iter_rows(sorted(conditions, key=lambda item: item[0]))
+
+    def _iter_rows(self, conditions):
+        if not conditions:
+            yield from self._members
+            return
+
+        # 行数最少的条件决定遍历的行，其余条件逐行检查
+        _, first, first_matched = conditions[0]
+        rows = self._rows[first]
+        last = None
+        for row in heapq.merge(*(rows[index] for index in first_matched)):
+            if row == last:
+                continue
+            last = row
+            if all(self._has(column, row, matched)
+                   for _, column, matched in conditions[1:]):
+                yield self._members[row]
+
+
+class _PathFilter:
+    '''
+    包、类过滤器，按路径分段建立前缀树，遍历目录时直接跳过不需要的子目录
+
+    过滤器从smali目录的根开始匹配，可以是包（com.a、com/a/）或者类
+    （com.a.B、com/a/B、Lcom/a/B;）；包包括所有子包，类包括它的内部类。
+    '''
+
+    _END = ''  # 前缀树中，标记某个过滤器在此结束
+
+    def __init__(self, filters):
+        self._root = {}
+        for item in filters:
+            node = self._root
+            for part in self._split(item):
+                node = node.setdefault(part, {})
+            node[self._END] = True
+
+    @staticmethod
+    def _split(item):
+        item = item.strip()
+        if item.startswith('L') and item.endswith(';'):
+            item = item[1:-1]
+        item = item.replace(os.sep, '/').replace('.', '/')
+        return [part for part in item.split('/') if part]
+
+    def _find(self, parts):
+        '''
+        @return 前缀树中对应的节点（不在树中为None）、是否已被某个过滤器包含
+        '''
+        node = self._root
+        for part in parts:
+            if self._END in node:
+                return node, True
+            node = node.get(part)
+            if node is None:
+                return None, False
+        return node, self._END in node
+
+    def visit(self, parts, opt):
+        '''
+        是否需要进入该目录：INCLUDE时，目录在某个过滤器的路径上，或者被包含；
+        EXCLUDE时，目录没有被整个排除
+        '''
+        node, covered = self._find(parts)
+        if opt == INCLUDE:
+            return covered or node is not None
+        return not covered
+
+    def match(self, parts):
+        '''
+        :param parts: 类的路径分段，最后一段为类名（不含.smali）
+        '''
+        node, covered = self._find(parts[:-1])
+        if covered:
+            return True
+        if node is None:
+            return False
+        name = parts[-1]
+        for key in (name, name.split('$', 1)[0]):
+            child = node.get(key)
+            if child is not None and self._END in child:
+                return True
+        return False
+
+
+INCLUDE = 2 # 包含操作
+EXCLUDE = 1 # 排除操作
+NO_OPT = 0 # 无操作
+
+
+class _Watcher(threading.Thread):
+    '''
+    后台轮询线程，定时调用SmaliDir.refresh，见SmaliDir.watch
+    '''
+
+    def __init__(self, sdx, interval, callback=None):
+        super().__init__(daemon=True)
+        self.sdx = sdx
+        self.interval = interval
+        self.callback = callback
+        self.error = None  # 最近一次refresh的异常，如文件写到一半
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                changes = self.sdx.refresh()
+            except Exception as e:
+                self.error = e
+                continue
+            self.error = None
+            if self.callback and any(changes):
+                self.callback(*changes)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class SmaliDir:
+
+    def __init__(self, smali_dirs: list, filters: list = None, opt: int = NO_OPT,
+                 lazy: bool = False, workers: int = None,
+                 cache_dir: str = None, profiler=None):
+        """初始化smali目录
+
+        :param smali_dirs: smali目录列表，也可以是单个目录
+        :type smali_dirs: list
+        :param filters: 过滤器，从smali目录的根开始匹配，包(a/b/、a.b)，类(a/b/c、a.b.c、La/b/c;)，都可以；包包括子包，类包括内部类
+        :type filters: list
+        :param opt: 如果值为2，那么仅初始化过滤器命中的文件；如果值为1，则初始化过滤器不命中的文件；如果为0，则全部初始化。
+        :type opt: int
+        :param lazy: 如果为True，仅记录文件路径，首次访问SmaliFile时才读取、解析
+        :type lazy: bool
+        :param workers: 解析文件使用的进程数，大于1时使用进程池并行解析
+        :type workers: int
+        :param cache_dir: 解析结果的缓存目录，文件没有变化时，直接使用缓存
+        :type cache_dir: str
+        :param profiler: 统计各阶段的耗时，默认不统计，见stats
+        :type profiler: Profiler
+        """
+        if isinstance(smali_dirs, str):
+            smali_dirs = [smali_dirs]
+
+        self._files = [] # 存放已解析的smali文件
+
+        # 索引，用于O(1)查找
+        self._class_index = {}  # 类名 -> SmaliFile
+        self._method_index = {}  # 方法描述 -> SmaliMethod
+        self._field_index = {}  # 字段描述 -> SmaliField
+        # 引用索引，首次调用xref时建立：描述 -> [(SmaliFile, SmaliMethod)]
+        self._xref_index = None
+        self._xref_keys = {}  # SmaliFile -> 该文件引用的描述
+        self._xref_pending = set()  # 还没有解析，未加入引用索引的文件
+        self._call_graph = None  # 调用图，首次调用get_call_graph时建立
+        self._hierarchy = None  # 继承关系，首次调用get_hierarchy时建立
+        self._member_tables = None  # 方法、字段的属性表，首次查找时建立
+        # 分片，每个smali目录（dex）一个：smali目录 -> {类名 -> SmaliFile}
+        self._shards = {}
+        self._file_shards = {}  # SmaliFile -> smali目录
+        # 读取、写入文件时的修改时间和大小，用于refresh：SmaliFile -> (mtime, size)
+        self._file_stats = {}
+        self.lock = threading.RLock()  # refresh时持有，见watch
+        # 事务中待写入的文件：SmaliFile -> 事务开始前的文件路径
+        self._transaction = None
+
+        self.filters = [item.replace('.', os.sep) for item in filters or []]
+        self.opt = opt
+        self._path_filter = _PathFilter(self.filters) \
+            if opt in (INCLUDE, EXCLUDE) else None
+        self.lazy = lazy
+        self.workers = workers
+        self.cache = ParseCache(cache_dir) if cache_dir else None
+        self.profiler = profiler
+
+        self._load_dirs(smali_dirs)
+
+    @classmethod
+    def from_apktool(cls, root, **kwargs):
+        """加载apktool反编译目录中的所有dex：smali、smali_classes2 ... smali_classesN
+
+        按dex的顺序加载，同名的类以前面的dex为准，与运行时的类加载顺序一致；
+        每个dex是一个分片，见get_shards。
+
+        :param root: apktool的输出目录
+        :type root: str
+        :param kwargs: 其他参数，同SmaliDir
+        """
+        return cls(find_dex_dirs(root), **kwargs)
+
+    def init_smali_dir(self, smali_dir):
+        self._load_dirs([smali_dir])
+
+    def _load_dirs(self, smali_dirs):
+        '''
+        加载多个smali目录，每个目录是一个分片；并行解析时，所有目录共用一个进程池
+        '''
+        for smali_dir in smali_dirs:
+            self._shards.setdefault(smali_dir, {})
+
+        if self.lazy:
+            for smali_dir, filepath, clz_name in self._timed_walk(smali_dirs):
+                self._add_file(SmaliFile(
+                    filepath, lazy=True, class_name=clz_name,
+                    cache=self.cache, profiler=self.profiler), smali_dir)
+            return
+
+        for smali_dir, sf in self._parse_files(smali_dirs):
+            self._add_file(sf, smali_dir)
+
+    def _walk_dirs(self, smali_dirs):
+        for smali_dir in smali_dirs:
+            for filepath, clz_name in self._walk(smali_dir):
+                yield smali_dir, filepath, clz_name
+
+    def _timed_walk(self, smali_dirs):
+        walk = self._walk_dirs(smali_dirs)
+        return self.profiler.timed(walk, 'walk') if self.profiler else walk
+
+    def _parse_files(self, smali_dirs, batch=None):
+        '''
+        解析目录中的文件，逐个返回(smali目录, SmaliFile)；设置了workers时，多进程解析
+
+        :param batch: 多进程解析时，最多同时提交的文件数，默认一次提交所有文件
+        '''
+        return self._parse_items(self._timed_walk(smali_dirs), batch)
+
+    def _parse_items(self, walk, batch=None):
+        '''
+        :param walk: (smali目录, 文件路径, 类名)
+        '''
+        profiler = self.profiler
+        if not self.workers or self.workers <= 1:
+            for smali_dir, filepath, clz_name in walk:
+                yield smali_dir, SmaliFile(filepath, class_name=clz_name,
+                                           cache=self.cache, profiler=profiler)
+            return
+
+        func = functools.partial(_child_parse, cache=self.cache,
+                                 profile=bool(profiler))
+        items = collections.deque()  # 已提交、还没有返回结果的文件
+
+        def paths():
+            for item in walk:
+                items.append(item)
+                yield item[1]
+
+        for packed, stat, counts, child in _imap_parallel(
+                func, paths(), self.workers, batch):
+            smali_dir, filepath, _ = items.popleft()
+            if self.cache:
+                self.cache.hits += counts[0]
+                self.cache.misses += counts[1]
+            if child:
+                profiler.merge(child)
+            sf = SmaliFile(filepath, parsed=_unpack_parsed(packed),
+                           cache=self.cache, profiler=profiler)
+            sf._stat = stat
+            yield smali_dir, sf
+
+    @classmethod
+    def stream(cls, smali_dirs, filters=None, opt=NO_OPT, workers=None,
+               cache_dir=None, profiler=None):
+        """逐个返回解析好的SmaliFile，不保存、不建立索引
+
+        返回的SmaliFile不再被引用时即可释放，内存占用与目录大小无关；
+        多进程解析时，整个过程共用一个进程池，同时只提交一批文件。
+
+        :param smali_dirs: smali目录列表，也可以是单个目录
+        :type smali_dirs: list
+        :param filters: 过滤的包名、类名，同SmaliDir
+        :type filters: list
+        :param opt: INCLUDE/EXCLUDE/NO_OPT，同SmaliDir
+        :type opt: int
+        :param workers: 解析文件的进程数
+        :type workers: int
+        :param cache_dir: 解析结果的缓存目录
+        :type cache_dir: str
+        :param profiler: 统计各阶段的耗时
+        :type profiler: Profiler
+        """
+        if isinstance(smali_dirs, str):
+            smali_dirs = [smali_dirs]
+        sdx = cls([], filters, opt, workers=workers, cache_dir=cache_dir,
+                  profiler=profiler)
+
+        for _, sf in sdx._parse_files(smali_dirs, (workers or 1) * 64):
+            yield sf
+
+    def _walk(self, smali_dir):
+        '''
+        遍历smali目录，返回过滤后的文件路径，以及根据路径推导出的类名
+
+        INCLUDE时只进入过滤器路径上的目录，EXCLUDE时跳过被整个排除的目录。
+        '''
+        path_filter = self._path_filter
+        include = self.opt == INCLUDE
+        for parent, dirnames, filenames in os.walk(smali_dir):
+            parts = []
+            if path_filter:
+                rel_dir = os.path.relpath(parent, smali_dir)
+                if rel_dir != os.curdir:
+                    parts = rel_dir.split(os.sep)
+                dirnames[:] = [d for d in dirnames
+                               if path_filter.visit(parts + [d], self.opt)]
+
+            for filename in filenames:
+                if not filename.endswith('.smali'):
+                    continue
+                if path_filter and include != path_filter.match(
+                        parts + [filename[:-len('.smali')]]):
+                    continue
+
+                filepath = os.path.join(parent, filename)
+                yield filepath, path2class(smali_dir, filepath)
+
+    def _add_file(self, sf, shard=None):
+        sf._owner = self
+        self._files.append(sf)
+        if shard is not None:
+            self._file_shards[sf] = shard
+            # 延迟解析的文件还没有读取，首次读取时再记录，见SmaliFile._load
+            if sf._stat:
+                self._track(sf, sf._stat)
+        with _phase(self.profiler, 'index'):
+            self._index_file(sf)
+
+    def _index_file(self, sf):
+        '''
+        把SmaliFile的类、方法、字段加入索引
+
+        同名的类只保留第一个，与原来线性查找的结果一致。
+        '''
+        self._call_graph = None
+        self._hierarchy = None
+        self._member_tables = None
+        self._class_index.setdefault(sf.get_class(), sf)
+        shard = self._file_shards.get(sf)
+        if shard is not None:
+            self._shards[shard].setdefault(sf.get_class(), sf)
+        # 还没有解析的文件，方法、字段会在解析后再加入索引
+        if sf._parsed:
+            for mtd in sf._methods:
+                self._method_index.setdefault(str(mtd), mtd)
+            for field in sf._fields:
+                self._field_index.setdefault(str(field), field)
+        if self._xref_index is not None:
+            if sf._parsed:
+                self._xref_pending.discard(sf)
+                self._index_refs(sf)
+            else:
+                self._xref_pending.add(sf)
+
+    def _unindex_file(self, sf):
+        '''
+        从索引中移除SmaliFile，需要在SmaliFile重新解析之前调用
+        '''
+        self._call_graph = None
+        self._hierarchy = None
+        self._member_tables = None
+        if self._class_index.get(sf.get_class()) is sf:
+            del self._class_index[sf.get_class()]
+        shard = self._shards.get(self._file_shards.get(sf))
+        if shard and shard.get(sf.get_class()) is sf:
+            del shard[sf.get_class()]
+        for mtd in sf._methods:
+            if self._method_index.get(str(mtd)) is mtd:
+                del self._method_index[str(mtd)]
+        for field in sf._fields:
+            if self._field_index.get(str(field)) is field:
+                del self._field_index[str(field)]
+        for key in self._xref_keys.pop(sf, ()):
+            refs = [item for item in self._xref_index[key] if item[0] is not sf]
+            if refs:
+                self._xref_index[key] = refs
+            else:
+                del self._xref_index[key]
+
+    def _track(self, sf, stat=None):
+        '''
+        记录文件的修改时间和大小；读取、写入文件后调用，refresh据此判断文件是否变化
+
+        :param stat: 读取文件时的(修改时间, 大小)，见_stat_key；默认重新获取
+        '''
+        if stat is None:
+            try:
+                stat = _stat_key(os.stat(sf._file_path))
+            except OSError:
+                self._file_stats.pop(sf, None)
+                return
+        self._file_stats[sf] = stat
+
+    def refresh(self):
+        '''
+        根据修改时间和大小，重新扫描所有分片（smali目录）：加入新增的文件，移除删除了的文件，
+        重新解析修改过的文件，并更新所有索引
+
+        磁盘上的修改会覆盖内存中还没有保存的修改；事务中不能调用。
+
+        @return (新增的SmaliFile, 删除的SmaliFile, 重新解析的SmaliFile)
+        '''
+        with self.lock:
+            if self._transaction is not None:
+                raise RuntimeError('refresh() in a transaction')
+
+            files = {os.path.normpath(sf._file_path): sf
+                     for sf in self._files if sf in self._file_shards}
+            new_items = []
+            changed = []
+            for smali_dir, filepath, clz_name in self._walk_dirs(
+                    list(self._shards)):
+                try:
+                    stat = _stat_key(os.stat(filepath))
+                except OSError:
+                    continue  # 遍历之后被删除
+                sf = files.pop(os.path.normpath(filepath), None)
+                if sf is None:
+                    new_items.append((smali_dir, filepath, clz_name))
+                # 还没有读取的文件，首次访问时读取的就是最新的内容
+                elif sf._parsed and self._file_stats.get(sf) != stat:
+                    changed.append((sf, stat))
+
+            # 先读取、解析，出错时不修改索引
+            if self.lazy:
+                added = [(smali_dir, SmaliFile(
+                    filepath, lazy=True, class_name=clz_name,
+                    cache=self.cache, profiler=self.profiler))
+                    for smali_dir, filepath, clz_name in new_items]
+            else:
+                added = list(self._parse_items(new_items))
+            contents = [read_smali_file(sf._file_path) for sf, _ in changed]
+
+            removed = list(files.values())
+            self._remove_files(removed)
+
+            for (sf, stat), content in zip(changed, contents):
+                self._unindex_file(sf)
+                sf._modified = False
+                sf._content = content
+                sf._reparse()
+                self._index_file(sf)
+                self._track(sf, stat)
+
+            for smali_dir, sf in added:
+                self._add_file(sf, smali_dir)
+
+        return ([sf for _, sf in added], removed, [sf for sf, _ in changed])
+
+    def _remove_files(self, removed):
+        '''
+        移除文件；同名的类在其他分片中还有定义时，由下一个分片中的类代替
+        '''
+        if not removed:
+            return
+
+        removed_set = set(removed)
+        self._files = [sf for sf in self._files if sf not in removed_set]
+        classes = set()
+        for sf in removed:
+            self._unindex_file(sf)
+            self._xref_pending.discard(sf)
+            shard = self._file_shards.pop(sf, None)
+            self._file_stats.pop(sf, None)
+            sf._owner = None
+            if shard is not None:
+                classes.add(sf.get_class())
+
+        for sf in self._files:
+            if sf.get_class() in classes and sf.get_class() not in \
+                    self._class_index:
+                self._index_file(sf)
+
+    def watch(self, interval=1.0, callback=None):
+        '''
+        启动后台线程，每隔interval秒调用一次refresh；有文件变化时，
+        调用callback(新增, 删除, 重新解析)
+
+        其他线程查询时，可以持有lock，避免与refresh同时进行。
+
+        @return _Watcher，调用stop()停止
+        '''
+        watcher = _Watcher(self, interval, callback)
+        watcher.start()
+        return watcher
+
+    def __len__(self):
+        return len(self._files)
+
+    def __getitem__(self, index):
+        return self._files[index]
+
+    def __setitem__(self, index, smali_file):
+        old = self._files[index]
+        self._unindex_file(old)
+        old._owner = None
+
+        smali_file._owner = self
+        self._files[index] = smali_file
+        shard = self._file_shards.pop(old, None)
+        if shard is not None:
+            self._file_shards[smali_file] = shard
+        self._index_file(smali_file)
+
+    def get_smali_file(self, clz_name, shard=None):
+        '''
+        :param shard: 只在该分片（smali目录）中查找，默认查找所有分片
+        '''
+        if shard is not None:
+            return self._shards.get(shard, {}).get(clz_name)
+        return self._class_index.get(clz_name)
+
+    def get_shards(self):
+        '''所有分片（smali目录），按加载顺序排列，前面的优先'''
+        return list(self._shards)
+
+    def get_shard_files(self, shard):
+        '''该分片（smali目录）中的所有SmaliFile'''
+        return [sf for sf in self._files if self._file_shards.get(sf) == shard]
+
+    def duplicate_classes(self):
+        '''
+        在多个分片中都定义了的类；全局查找时，使用第一个分片中的类
+
+        @return {类名: [分片, ...]}，分片按加载顺序排列，第一个即实际使用的
+        '''
+        shards = {}
+        for shard, classes in self._shards.items():
+            for clz_name in classes:
+                shards.setdefault(clz_name, []).append(shard)
+        return {clz_name: items for clz_name, items in shards.items()
+                if len(items) > 1}
+
+    def dex_stats(self):
+        '''
+        每个分片（dex）的类、方法、字段数量，用于估算64K方法数限制；
+        设置了workers时，多进程扫描
+
+        methods、fields为定义的数量；method_refs、field_refs为定义和
+        代码中引用的总数（去重），接近dex的method_ids、field_ids。
+
+        @return {分片: {'classes', 'methods', 'fields', 'method_refs',
+        'field_refs'}}
+        '''
+        result = {}
+        refs = {}
+        shards = []
+        bodies = []
+        for sf in self._files:
+            shard = self._file_shards.get(sf)
+            if shard is None:
+                continue
+            methods, fields = refs.setdefault(shard, (set(), set()))
+            methods.update(str(mtd) for mtd in sf.get_methods())
+            fields.update(str(field) for field in sf.get_fields())
+            shards.append(shard)
+            bodies.append([mtd.get_body() for mtd in sf.get_methods()])
+
+        for shard in self._shards:
+            methods, fields = refs.setdefault(shard, (set(), set()))
+            result[shard] = {'classes': len(self._shards[shard]),
+                             'methods': len(methods), 'fields': len(fields)}
+
+        # 所有分片共用一个进程池
+        for shard, (mtd_refs, field_refs) in zip(
+                shards, _map_parallel(_scan_refs, bodies, self.workers)):
+            refs[shard][0].update(mtd_refs)
+            refs[shard][1].update(field_refs)
+        for shard, (methods, fields) in refs.items():
+            result[shard]['method_refs'] = len(methods)
+            result[shard]['field_refs'] = len(fields)
+        return result
+
+    def get_method_from_desc(self, full_desc):
+        mtd = self._method_index.get(full_desc)
+        if mtd:
+            return mtd
+
+        clz_name, mtd_desc = full_desc.split('->')
+        sf = self.get_smali_file(clz_name)
+        if sf:
+            return sf.get_method(mtd_desc)
+
+    def get_method(self, clz_name, mtd_desc, shard=None):
+        '''
+        Lcom/android/mtp/rp/a;
+        a([B)Ljava/security/Key;
+
+        :param shard: 只在该分片（smali目录）中查找，默认查找所有分片
+        '''
+        mtd = None
+        if shard is None:
+            mtd = self._method_index.get(clz_name + '->' + mtd_desc)
+        if mtd:
+            return mtd
+
+        # 不完整的方法签名，或者指定了分片，在文件内查找
+        sf = self.get_smali_file(clz_name, shard)
+        if sf:
+            return sf.get_method(mtd_desc)
+
+    def get_field(self, field_desc, shard=None):
+        '''
+        :param shard: 只在该分片（smali目录）中查找，默认查找所有分片
+        '''
+        field = None
+        if shard is None:
+            field = self._field_index.get(field_desc)
+        if field:
+            return field
+
+        clz_name = field_desc.split('->')[0]
+        sf = self.get_smali_file(clz_name, shard)
+        if sf:
+            return sf.get_field(field_desc)
+
+    def _index_refs(self, sf):
+        '''
+        把SmaliFile中每个方法引用的类、方法、字段加入引用索引
+        '''
+        # 延迟解析的文件，解析后会通过_index_file加入引用索引
+        methods = sf.get_methods()
+        if sf in self._xref_keys:
+            return
+
+        keys = set()
+        for mtd in methods:
+            refs = set()
+            for clz, member in _iter_xrefs(mtd.get_body()):
+                refs.add(clz)
+                if member:
+                    refs.add(clz + '->' + member)
+            for ref in refs:
+                self._xref_index.setdefault(ref, []).append((sf, mtd))
+            keys |= refs
+        self._xref_keys[sf] = keys
+
+    def build_xref_index(self):
+        '''
+        遍历一次所有文件，建立引用索引
 
-        @return 返回值类型、操作寄存器名
+        只记录代码中的引用，即invoke-*、iget/iput、sget/sput、const-class、
+        new-instance、check-cast语句中的类、方法、字段。
         '''
-        STRING_INIT_REG = (
-            r'invoke-direct {(?P<registers>.*?)}, '
-            r'Ljava/lang/String;-><init>\([\[BCI]+\)V')
-        result = re.match(STRING_INIT_REG, line.strip())
+        self._xref_index = {}
+        self._xref_keys = {}
+        self._xref_pending = set()
+        with _phase(self.profiler, 'xref_index'):
+            for sf in self._files:
+                self._index_refs(sf)
 
-        if result:
-            rnames = re.sub('\s', '', result['registers']).split(',')
-            return rnames[0], rnames
-        else:
-            return None, None
+    def xref(self, desc):
+        '''找出所有引用了该类、方法、变量的SmaliFile'''
+        sfs = []
+        for sf, _ in self.xref_methods(desc):
+            if not sfs or sfs[-1] is not sf:
+                sfs.append(sf)
+        return sfs
 
-    @staticmethod
-    def parse_proto(proto):
-        '''
-        解析方法原型
+    def xref_methods(self, desc):
         '''
-        result = []
-        PARAMETER_INDIVIDUATOR = r'(\[*(?:[BCDFIJSZ]|L[^;]+;))'
-        pattern2 = re.compile(PARAMETER_INDIVIDUATOR)
-        for item in pattern2.finditer(proto):
-            result.append(item.group())
+        找出所有引用了该类、方法、变量的方法
 
-        return result
+        @return [(SmaliFile, SmaliMethod)]
+        '''
+        if self._xref_index is None:
+            self.build_xref_index()
+        while self._xref_pending:
+            self._xref_pending.pop()._load()
+        return list(self._xref_index.get(desc, ()))
 
-    @staticmethod
-    def parse_move(line):
+    def get_call_graph(self):
         '''
-        move-result-object vx
+        所有方法的调用图，只统计invoke-*语句；设置了workers时，多进程扫描
 
-        @return 返回寄存器名 vx
+        文件修改、重新解析后，调用图会重新建立。
         '''
-        return line.strip().split()[1]
+        if self._call_graph is not None:
+            return self._call_graph
 
-    @staticmethod
-    def parse_iget(line):
+        methods = []
+        bodies = []
+        for sf in self._files:
+            mtds = sf.get_methods()
+            methods.extend(str(mtd) for mtd in mtds)
+            bodies.append([mtd.get_body() for mtd in mtds])
+
+        with _phase(self.profiler, 'call_graph'):
+            calls = []
+            for item in _map_parallel(_scan_calls, bodies, self.workers):
+                calls.extend(item)
+            self._call_graph = CallGraph(methods, calls)
+        return self._call_graph
+
+    def iter_strings(self):
         '''
-        iget v0, p0, Lcom/a/b/c;->g:I
-        iget-object v0, p0, Lcom/android/unit/d;->a:Landroid/content/Context;
+        逐个文件返回所有字符串常量：const-string、const-string/jumbo，
+        以及字段的初始值；设置了workers时，多进程扫描
 
-        @return 类名、字段名、返回类型、寄存器名
+        相同的字符串只保留一个对象。
+
+        @return StringRecord
         '''
-        REG = (
-            r'iget(?:-object|) (?P<rname>.*?), \w+, '
-            r'(?P<cname>.*?;)->(?P<fname>.*?):(?P<rtype>.*)'
-        )
-        result = re.match(REG, line.strip())
-        cname = smali2java(result['cname'])
-        return cname, result['fname'], result['rtype'], result['rname']
+        def bodies():
+            for sf in self._files:
+                yield [mtd.get_body() for mtd in sf.get_methods()]
 
-    @staticmethod
-    def parse_sget_object(line):
+        jobs = bodies()
+        if self.workers and self.workers > 1:
+            jobs = list(jobs)
+
+        strings = {}
+        results = _map_parallel(_scan_strings, jobs, self.workers)
+        for sf, result in zip(self._files, results):
+            yield from _string_records(sf, result, strings)
+
+    def get_hierarchy(self):
         '''
-        sget-object v0, Lcom/c/a/a/f;->b:[B
+        所有类的继承关系，同名的类以第一个为准
 
-        @return 类名、字段名、返回类型、寄存器名
+        文件修改、重新解析后，继承关系会重新建立。
         '''
-        REG = (
-            r'sget-object (?P<rname>.*?), '
-            r'(?P<cname>.*?;)->(?P<fname>.*?):(?P<rtype>.*)'
-        )
-        result = re.match(REG, line.strip())
-        cname = smali2java(result['cname'])
-        return cname, result['fname'], result['rtype'], result['rname']
+        if self._hierarchy is None:
+            # 延迟解析的文件，解析时会更新类索引，先全部解析
+            for sf in list(self._class_index.values()):
+                sf.get_supper()
+            with _phase(self.profiler, 'hierarchy'):
+                self._hierarchy = ClassHierarchy({
+                    clz: (sf.get_supper(), sf.get_interfaces())
+                    for clz, sf in self._class_index.items()})
+        return self._hierarchy
+
+    def get_member_tables(self):
+        '''
+        方法、字段的列式属性表，同名的类以第一个为准；未解析的文件会先解析
 
+        文件修改、重新解析后，属性表会重新建立。
 
-INCLUDE = 2 # 包含操作
-EXCLUDE = 1 # 排除操作
-NO_OPT = 0 # 无操作
+        @return (方法的MemberTable, 字段的MemberTable)
+        '''
+        if self._member_tables is not None:
+            return self._member_tables
+
+        methods = []
+        fields = []
+        for sf in list(self._files):
+            sf_methods = sf.get_methods()
+            if self._class_index.get(sf.get_class()) is not sf:
+                continue
+            methods.extend(sf_methods)
+            fields.extend(sf.get_fields())
+
+        with _phase(self.profiler, 'member_table'):
+            self._member_tables = (
+                MemberTable(methods, {
+                    'desc': SmaliMethod.get_desc,
+                    'clz': SmaliMethod.get_class,
+                    'name': SmaliMethod.get_name,
+                    'proto': SmaliMethod.get_proto,
+                    'return_type': SmaliMethod.get_return_type,
+                    'access': SmaliMethod.get_access_flags,
+                    'params': SmaliMethod.get_params,
+                }, multi=('access', 'params')),
+                MemberTable(fields, {
+                    'desc': SmaliField.get_reference_sm,
+                    'clz': SmaliField.get_class,
+                    'name': SmaliField.get_name,
+                    'type': SmaliField.get_type,
+                    'access': SmaliField.get_modifier,
+                }, multi=('access',)))
+        return self._member_tables
+
+    def find_methods(self, desc=None, clz=None, name=None, proto=None,
+                     return_type=None, access=None, params=None):
+        """逐个返回满足所有条件的方法
+
+        字符串中*匹配任意个字符，?匹配一个字符；也可以是re.compile的正则表达式。
+
+        sd.find_methods(return_type='Ljavax/crypto/Cipher;')
+        sd.find_methods(access='native')
+        sd.find_methods(desc='Lcom/test/*;->get*()Ljava/lang/String;')
+
+        :param desc: 方法描述，如La/b;->c(I)V
+        :param clz: 类名
+        :param name: 方法名
+        :param proto: 参数类型，不包括括号，如I[B
+        :param return_type: 返回类型
+        :param access: 访问标志，如public、native；列表时，需要包含所有的标志
+        :param params: 某个参数的类型
+        """
+        return self.get_member_tables()[0].query(
+            desc=desc, clz=clz, name=name, proto=proto,
+            return_type=return_type, access=access, params=params)
 
-class SmaliDir:
+    def find_fields(self, desc=None, clz=None, name=None, field_type=None,
+                    access=None):
+        """逐个返回满足所有条件的字段，模式的写法同find_methods
 
-    def __init__(self, smali_dirs: list, filters: list, opt: int):
-        """初始化smali目录
+        sd.find_fields(field_type='[B')
 
-        :param smali_dirs: smali目录列表
-        :type smali_dirs: list
-        :param filters: 过滤器，包(a/b/)，类(a/b/c)，都可以
-        :type filters: list
-        :param opt: 如果值为2，那么仅初始化过滤器命中的文件；如果值为1，则初始化过滤器不命中的文件；如果为0，则全部初始化。
-        :type opt: int
-        """        
-        self._files = [] # 存放已解析的smali文件
+        :param desc: 字段描述，如La/b;->c:I
+        :param clz: 类名
+        :param name: 字段名
+        :param field_type: 字段类型
+        :param access: 修饰符，如private、static；列表时，需要包含所有的修饰符
+        """
+        return self.get_member_tables()[1].query(
+            desc=desc, clz=clz, name=name, type=field_type, access=access)
 
-        self.filters = filters
-        self.opt = opt
+    def stats(self):
+        '''
+        统计信息：文件数、缓存命中次数；开启统计（profiler）时，
+        还包括各阶段的次数、累计耗时，以及耗时最长的文件
+        '''
+        result = self.profiler.stats() if self.profiler else {}
+        result['files'] = len(self._files)
+        if self.cache:
+            result['cache'] = {'hits': self.cache.hits,
+                               'misses': self.cache.misses}
+        return result
 
-        counter = 0
-        for item in self.filters:
-            filters[counter] = item.replace('.', os.sep)
-            filters += 1
+    def resolve_method(self, clz_name, mtd_desc):
+        '''
+        查找调用clz_name->mtd_desc时实际执行的方法：先沿着父类链向上查找，
+        再查找接口中的默认方法；找不到（如系统API）时返回None
 
-        for smali_dir in smali_dirs:
-            self.init_smali_dir(smali_dir)     
+        :param clz_name: Lcom/test/Test;
+        :param mtd_desc: a([B)Ljava/security/Key;
+        '''
+        hierarchy = self.get_hierarchy()
+        for clz in [clz_name] + hierarchy.superclasses(clz_name):
+            mtd = self._method_index.get(clz + '->' + mtd_desc)
+            if mtd:
+                return mtd
+        for clz in hierarchy.ancestors(clz_name):
+            mtd = self._method_index.get(clz + '->' + mtd_desc)
+            if mtd:
+                return mtd
 
-    def init_smali_dir(self, smali_dir):
-        for parent, _, filenames in os.walk(smali_dir):
-            for filename in filenames:
-                if not filename.endswith('.smali'):
-                    continue
+    def virtual_targets(self, full_desc):
+        '''
+        invoke-virtual/interface可能执行的所有方法：静态类型解析出的方法，
+        以及所有子类中覆盖了它的方法
+        '''
+        clz_name, mtd_desc = full_desc.split('->')
+        targets = []
+        mtd = self.resolve_method(clz_name, mtd_desc)
+        if mtd:
+            targets.append(mtd)
+        for clz in self.get_hierarchy().descendants(clz_name):
+            mtd = self._method_index.get(clz + '->' + mtd_desc)
+            if mtd:
+                targets.append(mtd)
+        return targets
+
+    def begin(self):
+        '''
+        开始事务，之后SmaliFile.save、update只修改内存，直到commit才写入文件
+        '''
+        if self._transaction is None:
+            self._transaction = {}
 
-                filepath = os.path.join(parent, filename)
+    def commit(self):
+        '''
+        写入事务中修改过的文件
 
-                if self.opt == INCLUDE:
-                    for item in self.filters:
-                        if item in filepath:
-                            sf = SmaliFile(filepath)
-                            self._files.append(sf)
-                        break
-                elif self.opt == EXCLUDE:
-                    for item in self.filters:
-                        if item in filepath:
-                            break
-                    else:
-                        sf = SmaliFile(filepath)
-                        self._files.append(sf)
-                else:
-                    sf = SmaliFile(filepath)
-                    self._files.append(sf)
+        先把所有文件写入临时文件，全部成功后再逐个替换，最后删除移动前的旧文件。
+        写入临时文件时出错，原来的文件不会被修改。
 
-    def __len__(self):
-        return len(self._files)
+        替换不是跨文件的原子操作：替换到一半出错时，已经替换的文件保留新的内容，
+        并删除剩下的临时文件；没有替换的文件仍在事务中，可以再次commit，或者rollback。
+        '''
+        pending = self._transaction
+        if pending is None:
+            return
 
-    def __getitem__(self, index):
-        return self._files[index]
+        writes = []
+        try:
+            for sf in pending:
+                writes.append((_write_temp_file(sf._file_path, sf._content),
+                               sf._file_path))
+        except Exception:
+            for tmp_path, _ in writes:
+                os.remove(tmp_path)
+            raise
+
+        done = []
+        try:
+            for sf, (tmp_path, file_path) in zip(list(pending), writes):
+                os.replace(tmp_path, file_path)
+                done.append(sf)
+        except BaseException:
+            for tmp_path, _ in writes[len(done):]:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            self._finish_commit(done)
+            raise
+        self._finish_commit(done)
+
+    def _finish_commit(self, done):
+        '''
+        已经写入的文件移出事务，并删除移动前的旧文件；全部写入后结束事务
+        '''
+        pending = self._transaction
+        # 旧路径可能是另一个文件的新路径，不能删除
+        new_paths = {sf._file_path for sf in pending}
+        for sf in done:
+            old_path = pending.pop(sf)
+            self._track(sf)
+            if old_path in new_paths:
+                continue
+            if os.path.exists(old_path):
+                os.remove(old_path)
+            if sf._cache:
+                sf._cache.remove(old_path)
 
-    def __setitem__(self, index, smali_file):
-        self._files[index] = smali_file
+        if not pending:
+            self._transaction = None
 
-    def get_smali_file(self, clz_name):
-        for sf in self._files:
-            if clz_name == sf.get_class():
-                return sf
+    def rollback(self):
+        '''
+        放弃事务中的修改，从文件重新读取修改过的SmaliFile
+        '''
+        pending = self._transaction
+        if pending is None:
+            return
 
-    def get_method_from_desc(self, full_desc):
-        clz_name, mtd_desc = full_desc.split('->')
-        sf = self.get_smali_file(clz_name)
-        if sf:
-            return sf.get_method(mtd_desc)
+        self._transaction = None
+        for sf, old_path in pending.items():
+            self._unindex_file(sf)
+            sf._file_path = old_path
+            sf._dir = os.path.dirname(old_path)
+            sf._modified = False
+            sf._content = read_smali_file(old_path)
+            sf._reparse()
+            self._index_file(sf)
+            self._track(sf)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        with sd.transaction():
+            sd.update_desc(...)
 
-    def get_method(self, clz_name, mtd_desc):
+        正常结束时commit，出现异常时rollback
         '''
-        Lcom/android/mtp/rp/a;
-        a([B)Ljava/security/Key;
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def _defer_save(self, sf, file_path=None, reparse=True):
         '''
-        sf = self.get_smali_file(clz_name)
-        if sf:
-            return sf.get_method(mtd_desc)
+        事务中保存文件：记录修改过的文件，不写入。
 
-    def get_field(self, field_desc):
-        clz_name = field_desc.split('->')[0]
-        sf = self.get_smali_file(clz_name)
-        if sf:
-            return sf.get_field(field_desc)
+        如果代码被直接修改过，方法、字段会在下次访问时，根据内存中的代码重新解析。
+        '''
+        self._transaction.setdefault(sf, sf._file_path)
+        if not reparse and not file_path:
+            return
 
-    def xref(self, desc):
-        '''找出所有引用了该类、方法、变量的SmaliFile'''
-        sfs = []
-        for sf in self._files:
-            if desc in sf.get_content():
-                sfs.append(sfs)
+        self._unindex_file(sf)
+        if file_path:
+            sf._file_path = file_path
+            sf._dir = os.path.dirname(file_path)
+        if reparse:
+            sf._parsed = False
+            sf._class = _intern(parse_class_name(sf._content))
+        self._index_file(sf)
 
     def update_desc(self, desc, new_desc):
         """找出所有引用了该类、方法、变量的SmaliFile，并更新
 
-        :param desc: [description]
-        :type desc: [type]
-        :param new_desc: [description]
-        :type new_desc: [type]
+        :param desc: 旧的类、方法、变量描述
+        :type desc: str
+        :param new_desc: 新的描述
+        :type new_desc: str
         """
-        arrs = []
-        old = None
-        new = None
+        self.update_descs({desc: new_desc})
 
-        # 如果替换的方法、变化，则会带有->符号。
-        if '->' in desc:
-            arrs = desc.split('->')
-            old = ' ' + arrs[1]  # 旧类名
-            new = ' ' + new_desc.split('->')[1]  # 新的类名
+    def update_descs(self, mapping):
+        """批量更新类、方法、变量的描述，每个文件只替换一遍、保存一次
 
-        is_inner_class = '$' in desc
+        La/b/c; -> La/b/d; 修改类名，同时移动文件
+        La/b/c;->b:I -> La/b/c;->newb:I 修改变量名
+        La/b/c;->b()V -> La/b/c;->newb()V 修改方法名
 
-        for sf in self._files:
-            file_path = None
-            # 单纯替换类名
-            if old is not None:
-                if arrs and str(sf) == arrs[0] and old in sf.get_content():
-                    sf.set_content(sf.get_content().replace(old, new))
-                    sf.set_modified(True)
-
-            if desc in sf.get_content():
-                sf.set_content(sf.get_content().replace(desc, new_desc))
-                sf.set_modified(True)
+        :param mapping: 旧描述 -> 新描述
+        :type mapping: dict
+        :return: 修改过、保存了的SmaliFile
+        :rtype: list
+        """
+        class_map = {}
+        member_map = {}
+        decl_map = {}  # 类名 -> {旧的声明: 新的声明}
+        for desc, new_desc in mapping.items():
+            if '->' not in desc:
+                class_map[desc] = new_desc
+        class_ptn = SmaliDir._compile_alternation(class_map) \
+            if class_map else None
+
+        for desc, new_desc in mapping.items():
+            # 如果替换的方法、变化，则会带有->符号。
+            if '->' not in desc:
+                continue
+            clz, member = desc.split('->')
+            new_clz, new_member = new_desc.split('->')
+            decl_map.setdefault(clz, {})[' ' + member] = ' ' + new_member
+
+            # 同时修改了类名
+            if new_clz == clz:
+                new_clz = class_map.get(clz, clz)
+            # 参数、返回值、变量类型中的类名也可能被修改，引用处整体替换，需要一并修改
+            if class_ptn:
+                new_member = class_ptn.sub(
+                    lambda m: class_map[m.group()], new_member)
+            member_map[desc] = new_clz + '->' + new_member
+
+        replacements = dict(class_map)
+        replacements.update(member_map)
+        if not replacements:
+            return []
+        # 较长的描述优先匹配，La/b;->c()V 不会被当作 La/b; 替换
+        ptn = SmaliDir._compile_alternation(replacements)
+
+        def repl(m):
+            return replacements[m.group()]
+
+        saved = []
+        for sf in list(self._files):
+            clz = str(sf)
+            content = sf.get_content()
+            new_content = content
+
+            # 修改声明语句
+            decls = decl_map.get(clz)
+            if decls:
+                new_content = SmaliDir._compile_alternation(decls).sub(
+                    lambda m: decls[m.group()], new_content)
+
+            new_content = ptn.sub(repl, new_content)
 
-                if desc == str(sf):
-                    smali_dir = os.path.dirname(sf.get_file_path())
-                    file_path = os.path.join(
-                        smali_dir, *new_desc[1:-1].split('/')) + '.smali'
-
-            if is_inner_class and desc in str(sf):
-                # 如果更新的是内部类，还需要修改注解部分
-                # .annotation system Ldalvik/annotation/InnerClass;
-                #     accessFlags = 0x0
-                #     name = "NewInnerClassName"
-                # .end annotation
-                n = desc.split('$')[1][:-1]
-                native_str = str(n.encode('unicode-escape'), 'utf-8')
-                old_name_dsm = 'name = "{}"'.format(native_str)
-                new_name_dsm = 'name = "{}"'.format(
-                    new_desc.split('$')[1][:-1])
-                sf.set_content(sf.get_content().replace(
-                    old_name_dsm, new_name_dsm))
+            file_path = None
+            if clz in class_map:
+                new_clz = class_map[clz]
+                file_path = SmaliDir._class_file_path(sf, new_clz)
+
+                if '$' in clz:
+                    # 如果更新的是内部类，还需要修改注解部分
+                    # .annotation system Ldalvik/annotation/InnerClass;
+                    #     accessFlags = 0x0
+                    #     name = "NewInnerClassName"
+                    # .end annotation
+                    n = clz[clz.rindex('$') + 1:-1]
+                    native_str = str(n.encode('unicode-escape'), 'utf-8')
+                    old_name_dsm = 'name = "{}"'.format(native_str)
+                    new_name_dsm = 'name = "{}"'.format(
+                        new_clz[new_clz.rindex('$') + 1:-1])
+                    new_content = new_content.replace(
+                        old_name_dsm, new_name_dsm)
+
+            if new_content != content:
+                sf.set_content(new_content)
                 sf.set_modified(True)
 
             if sf.get_modified():
                 sf.save(file_path)
+                saved.append(sf)
+
+        return saved
+
+    @staticmethod
+    def _compile_alternation(words):
+        return re.compile('|'.join(
+            re.escape(word) for word in sorted(words, key=len, reverse=True)))
+
+    @staticmethod
+    def _class_file_path(sf, new_clz):
+        '''
+        类名修改后，文件的新路径
+        '''
+        file_path = sf.get_file_path()
+        rel_path = os.path.join(*str(sf)[1:-1].split('/')) + '.smali'
+        if file_path.endswith(os.sep + rel_path):
+            smali_dir = file_path[:-len(rel_path)]
+        else:
+            smali_dir = os.path.dirname(file_path)
+        return os.path.join(smali_dir, *new_clz[1:-1].split('/')) + '.smali'
 
 
 class SmaliFile:
 
-    def __init__(self, file_path):
+    __slots__ = ['_file_path', '_dir', 'source_file', '_modified', '_class',
+                 '_name', '_supper_class', '__package', '_interfaces',
+                 '_methods', '_fields', '_content', '_owner', '_cache',
+                 '_profiler', '_parsed', '_stat', '__weakref__']
+
+    def __init__(self, file_path, lazy=False, class_name=None, parsed=None,
+                 cache=None, profiler=None):
+        '''
+        :param lazy: 如果为True，则首次访问时才读取、解析文件
+        :param class_name: 延迟解析时使用的类名，一般由文件路径推导
+        :param parsed: parse_smali_file的解析结果，如果提供，则不再读取文件
+        :param cache: ParseCache，解析结果的缓存
+        :param profiler: Profiler，统计解析、保存的耗时
+        '''
         # smali文件路径，用于代码更新
         self._file_path = file_path
-        self._dir = None
+        self._dir = os.path.dirname(file_path)
         self.source_file = file_path
         # 是否编辑过，如果编辑过，则需要保存
         self._modified = False
@@ -370,13 +2423,32 @@ class SmaliFile:
         self._fields = []
         # 代码
         self._content = None
-
-        self.parse()
+        # 所属的SmaliDir，用于更新索引
+        self._owner = None
+        self._cache = cache
+        self._profiler = profiler
+        # 是否已经解析
+        self._parsed = False
+        # 最近一次读取文件时的(修改时间, 大小)，加入SmaliDir时用于refresh
+        self._stat = None
+
+        if parsed:
+            with _phase(profiler, 'build'):
+                self._apply(parsed)
+        elif lazy:
+            self._class = _intern(class_name)
+        else:
+            self.parse()
 
     def __str__(self):
         return self._class
 
+    @property
+    def sign(self):
+        return self._class
+
     def get_package(self):
+        self._load()
         return self.__package
 
     def get_file_path(self):
@@ -397,32 +2469,51 @@ class SmaliFile:
         field，method的类？
         自动修改文件名
         '''
-        self._class = clz
+        self._class = _intern(clz)
 
     def get_supper(self):
+        self._load()
         return self._supper_class
 
     def get_interfaces(self):
+        self._load()
         return self._interfaces
 
+    def iter_strings(self, strings=None):
+        '''
+        文件中的字符串常量，同SmaliDir.iter_strings
+
+        :param strings: 多个文件共用时，相同的字符串只保留一个对象
+        '''
+        scanned = _scan_strings([mtd.get_body() for mtd in self.get_methods()])
+        return _string_records(self, scanned, {} if strings is None else strings)
+
     def get_fields(self):
+        self._load()
         return self._fields
 
     def get_methods(self):
+        self._load()
         return self._methods
 
     def get_content(self):
+        if self._content is None:
+            self._load()
         return self._content
 
     def set_content(self, content):
+        if self._content is None:
+            self._load()
         self._content = content
 
     def get_method(self, mtd_sign):
+        self._load()
         for mtd in self._methods:
             if mtd_sign in str(mtd):
                 return mtd
 
     def get_field(self, field_desc):
+        self._load()
         for field in self._fields:
             if field_desc == str(field):
                 return field
@@ -430,61 +2521,201 @@ class SmaliFile:
     def get_dir(self):
         return self._dir
 
+    def _load(self):
+        '''
+        延迟解析的文件，在首次访问时解析，并更新所属SmaliDir的索引
+        '''
+        if self._parsed:
+            return
+
+        if self._owner:
+            self._owner._unindex_file(self)
+        if self._content is None:
+            self.parse()
+            if self._owner and self in self._owner._file_shards:
+                self._owner._track(self, self._stat)
+        else:
+            # 事务中修改过的代码，还没有写入文件
+            self._reparse()
+        if self._owner:
+            self._owner._index_file(self)
+
     def parse(self):
+        profiler = self._profiler
+        if not profiler:
+            parsed, self._stat = _parse_file(self._file_path, self._cache)
+            self._apply(parsed)
+            return
+
+        start = time.perf_counter()
+        parsed, self._stat = _parse_file(
+            self._file_path, self._cache, profiler)
+        with profiler.phase('build'):
+            self._apply(parsed)
+        profiler.add_file(self._file_path, time.perf_counter() - start)
+
+    def _apply(self, parsed):
+        '''
+        根据parse_smali_file的解析结果，生成字段、方法
+        '''
+        self._parsed = True
         self._dir = os.path.dirname(self._file_path)
-        with open(self._file_path, 'r', encoding='utf-8') as f:
-            self._content = re.sub(r'\s*?\.line \d+', '', f.read())
-
-        p = re.compile(r'^\.class[a-z\s]+(.+)')
-        line = p.search(self._content).groups()
-        self._class = line[0]
-        self.sign = line[0]
-
-        p = re.compile(r'\.super (.+)')
-        line = p.search(self._content).groups()
-        self._supper_class = line[0]
-
-        # interfaces_regex = '\.implements (L[^;]+;)'
-        # p = re.compile(interfaces_regex)
-        # for i in p.finditer(self.content):
-        #     self.interfaces.append(i.group().replace('.implements ', ''))
-
-        field_regex = r'\.field .*?(?=\n)'
-        p = re.compile(field_regex)
-
-        p1 = re.compile(r'\.field[\w| |]*(?=\s)\s(.+):(.+)')
-        p2 = re.compile(r'\.field[\w| |]*(?=\s)\s(.+):(.+) = (.+)')
-        for i in p.finditer(self._content):
-            line = i.group()
-            field_name = None
-            field_type = None
-            field_value = None
-
-            if '=' in line:
-                field_name, field_type, field_value = p2.match(line).groups()
-            else:
-                try:
-                    field_name, field_type = p1.match(line).groups()
-                except AttributeError as e:
-                    print(self._file_path)
-                    print(line, e)
 
+        content, clz, supper, interfaces, fields, methods = parsed
+        self._content = content
+        self._class = _intern(clz)
+        self._supper_class = _intern(supper)
+        self._interfaces = [_intern(item) for item in interfaces]
+
+        for line, start, end in fields:
             sf = SmaliField(class_name=self._class)
             sf.set_declaration_sm(line)
+            sf._source, sf._start, sf._end = content, start, end
             self._fields.append(sf)
 
-        mtd_ptn = r'\n\.method (.*)'
-        mtd_prog = re.compile(mtd_ptn)
-        for item in mtd_prog.finditer(self._content, re.M):
-            line = item.group()
+        # 方法体不复制，需要时从代码中截取
+        for mtd_sign, start, end in methods:
+            sm = SmaliMethod(self._class, mtd_sign,
+                             source=content, start=start, end=end)
+            self._methods.append(sm)
 
-            escape_line = re.escape(line)
-            mbody_ptn = r'%s\n(.*?)\.end method' % escape_line
-            mbody_prog = re.compile(mbody_ptn, re.DOTALL)
-            body = mbody_prog.search(self._content).groups()[0]
+    def _reparse(self):
+        '''
+        根据内存中的代码重新解析，只重新分析修改过的部分。
 
-            sm = SmaliMethod(self._class, item.groups()[0], body)
-            self._methods.append(sm)
+        与解析时的代码对比，找出发生变化的区域：区域之外的字段、方法只调整位置，
+        保持原来的对象；区域内的重新扫描，描述不变的字段、方法也沿用原来的对象。
+        '''
+        content = self._content
+        items = self._fields + self._methods
+        old = items[0]._source if items else None
+        if old is None or any(item._source is not old for item in items):
+            old = None
+        self._parsed = True
+        if old is content:
+            return
+
+        before, overlapped, after = [], [], []
+        start, stop, delta = 0, len(content), 0
+        if old is not None:
+            prefix = _common_prefix(old, content)
+            suffix = _common_suffix(
+                old, content, min(len(old), len(content)) - prefix)
+            old_stop = len(old) - suffix
+            delta = len(content) - len(old)
+
+            start = old.rfind('\n', 0, prefix) + 1
+            stop = old_stop
+            for item in items:
+                a, b = SmaliFile._extent(old, item)
+                if b <= prefix:
+                    before.append(item)
+                elif a >= old_stop:
+                    after.append(item)
+                else:
+                    overlapped.append(item)
+                    start = min(start, a)
+                    stop = max(stop, b)
+            stop += delta
+        else:
+            overlapped = items
+
+        clz, supper, interfaces, fields, methods, _ = _scan_smali(
+            content, start, stop)
+        if after and any(end == -1 or end >= stop for _, _, end in methods):
+            # 修改破坏了后面方法的边界，只能全部重新扫描
+            before, overlapped, after = [], items, []
+            clz, supper, interfaces, fields, methods, _ = _scan_smali(content)
+
+        # 类名可能在重新解析前就被修改过，以代码中的为准
+        clz = parse_class_name(content)
+        self._class = _intern(clz)
+        for item in before + after:
+            if item.get_class() != clz:
+                item.set_class(clz)
+        # 父类、接口只在文件开头声明，不一定在重新扫描的区域内
+        supper, interfaces = _scan_header(content)
+        self._supper_class = _intern(supper)
+        self._interfaces = [_intern(item) for item in interfaces]
+
+        for item in before:
+            item._source = content
+        for item in after:
+            item._source = content
+            item._start += delta
+            item._end += delta
+
+        self._fields[:] = (
+            [f for f in before if isinstance(f, SmaliField)] +
+            self._new_fields(fields, overlapped) +
+            [f for f in after if isinstance(f, SmaliField)])
+        self._methods[:] = (
+            [m for m in before if isinstance(m, SmaliMethod)] +
+            self._new_methods(methods, overlapped) +
+            [m for m in after if isinstance(m, SmaliMethod)])
+
+    @staticmethod
+    def _extent(content, item):
+        '''
+        字段、方法在代码中占据的完整行：[起始位置, 结束位置)
+        '''
+        if isinstance(item, SmaliField):
+            start, end = item._start, item._end
+        else:
+            # 从方法声明所在行开始，到.end method所在行结束
+            start, end = item._start - 1, item._end
+        start = content.rfind('\n', 0, start) + 1
+        end = content.find('\n', end)
+        return start, (len(content) if end == -1 else end + 1)
+
+    def _new_fields(self, fields, overlapped):
+        olds = {str(f): f for f in overlapped if isinstance(f, SmaliField)}
+        result = []
+        for line, start, end in fields:
+            sf = SmaliField(class_name=self._class)
+            sf.set_declaration_sm(line)
+            sf._source, sf._start, sf._end = self._content, start, end
+            result.append(_reuse(olds.pop(str(sf), None), sf))
+        return result
+
+    def _new_methods(self, methods, overlapped):
+        olds = {str(m): m for m in overlapped if isinstance(m, SmaliMethod)}
+        result = []
+        for mtd_sign, start, end in methods:
+            sm = SmaliMethod(self._class, mtd_sign,
+                             source=self._content, start=start, end=end)
+            result.append(_reuse(olds.pop(str(sm), None), sm))
+        return result
+
+    def _store_cache(self):
+        '''
+        根据当前的字段、方法更新缓存，不需要重新解析
+        '''
+        fields = [(self._content[f._start:f._end], f._start, f._end)
+                  for f in self._fields]
+        methods = [(' '.join(m._access_flags + [m._name + m._sign]),
+                    m._start, m._end) for m in self._methods]
+        raw, stat = _read_file(self._file_path)
+        self._cache.store(
+            self._file_path, stat, raw,
+            (self._class, self._supper_class, self._interfaces, fields,
+             methods))
+
+    def _splice(self, start, end, text):
+        '''
+        用text替换代码中[start, end)的内容，并调整之后的字段、方法的位置
+        '''
+        old_content = self._content
+        self._content = old_content[:start] + text + old_content[end:]
+        delta = len(text) - (end - start)
+
+        for item in self._fields + self._methods:
+            if item._source is not old_content:
+                continue
+            item._source = self._content
+            if item._start >= end:
+                item._start += delta
+                item._end += delta
 
     # @staticmethod
     # def get_mbody_ptn(mtd_line):
@@ -495,31 +2726,48 @@ class SmaliFile:
     #     (re.escape(mtd_ptn))
 
     def save(self, file_path=None):
-        new_path = file_path if file_path else self._file_path
+        if self._content is None:
+            self._load()
+        if self._owner and self._owner._transaction is not None:
+            self._modified = False
+            self._owner._defer_save(self, file_path)
+            return
+
+        self._load()
+        if self._owner:
+            self._owner._unindex_file(self)
 
-        new_dir = os.path.dirname(new_path)
-        if not os.path.exists(new_dir):
-            os.makedirs(new_dir)
+        new_path = file_path if file_path else self._file_path
 
         # 写入新文件
-        with open(new_path, 'w', encoding='utf-8') as f:
-            f.write(self._content)
+        with _phase(self._profiler, 'save'):
+            _write_file(new_path, self._content)
         self._modified = False
 
         # 删除旧文件
         if new_path != self._file_path:
             os.remove(self._file_path)
+            if self._cache:
+                self._cache.remove(self._file_path)
             self._file_path = file_path
+            self._dir = os.path.dirname(file_path)
+
+        with _phase(self._profiler, 'reparse'):
+            self._reparse()
+        if self._cache:
+            with _phase(self._profiler, 'cache'):
+                self._store_cache()
 
-        self._fields.clear()
-        self._methods.clear()
-        self.parse()
+        if self._owner:
+            self._owner._index_file(self)
+            self._owner._track(self)
 
     def update(self):
         '''
         update smali file.
         把内存的Smali文件内容，写入到文件
         '''
+        self._load()
         for f in self._fields:
             if not f.get_modified():
                 continue
@@ -532,8 +2780,17 @@ class SmaliFile:
             self._update_method(mtd)
             mtd.set_modified(False)
 
-        with open(self._file_path, 'w', encoding='utf-8') as f:
-            f.write(self._content)
+        if self._owner:
+            # 方法体变了，重新建立引用索引、调用图
+            self._owner._unindex_file(self)
+            self._owner._index_file(self)
+            if self._owner._transaction is not None:
+                self._owner._defer_save(self, reparse=False)
+                return
+
+        _write_file(self._file_path, self._content)
+        if self._owner:
+            self._owner._track(self)
 
     def _update_field(self, sfield):
         '''
@@ -550,9 +2807,14 @@ class SmaliFile:
 
         # 下面则是更新字符串
         # 更新声明语句
-        old_sm = sfield.get_old_declaration_sm()
         sm = sfield.get_declaration_sm()
-        self._content = self._content.replace(old_sm, sm)
+        if sfield._source is self._content:
+            self._splice(sfield._start, sfield._end, sm)
+            sfield._end = sfield._start + len(sm)
+        else:
+            # 代码已被替换，位置失效
+            old_sm = sfield.get_old_declaration_sm()
+            self._content = self._content.replace(old_sm, sm)
 
         # 更新方法
         # 删除所有对该Field赋值的语句，避免反编译失败
@@ -588,9 +2850,7 @@ class SmaliFile:
         '''
         index = 0
         for item in str_arr:
-            smali_str = str(item.encode('unicode-escape')
-                            )[2:-1].replace('\\\\', '\\')
-            snippet += part.format(hex(index), smali_str)
+            snippet += part.format(hex(index), escape_string(item))
             index += 1
 
         snippet += '''
@@ -603,6 +2863,14 @@ class SmaliFile:
         '''
         更新Smali文件的指定方法，仅在内存中更新
         '''
+        body = mtd.get_body()
+        if mtd._source is self._content:
+            self._splice(mtd._start, mtd._end, body)
+            mtd._end = mtd._start + len(body)
+            mtd._body = None
+            return
+
+        # 方法不是从当前的代码中解析的，只能根据方法签名查找
         mbody_ptn = (
             r'\.method.*? %s((?!\.end method)[.\s\S])*?'
             r'\.end method') % re.escape(mtd.get_name() + mtd.get_sign())
@@ -614,7 +2882,19 @@ class SmaliFile:
         start = result.index('\n')
         old_body = result[start + 1:-11]
         if old_body in self._content:
-            self._content = self._content.replace(old_body, mtd.get_body())
+            self._content = self._content.replace(old_body, body)
+
+
+def _reuse(old, new):
+    '''
+    重新解析时，沿用原来的对象，保证外部的引用仍然有效
+    '''
+    if old is None:
+        return new
+    for name in type(new).__slots__:
+        if name != '__weakref__':
+            setattr(old, name, getattr(new, name))
+    return old
 
 
 class SmaliField:
@@ -629,6 +2909,10 @@ class SmaliField:
     如果要给instance fields赋值，那边必须把其声明为static，否则，smali回编译会报错。
     '''
 
+    __slots__ = ['_modifier', '_is_static', '_is_final', '_class', '_name',
+                 '_type', '_value', '_old_declaration_sm', '_modified',
+                 '_desc', '_source', '_start', '_end', '__weakref__']
+
     def __init__(self, dsm=None, class_name=None, field_name=None, field_type=None, field_value=None):
         # _modifier，修饰符，包含了访问修饰符和非访问修饰符；为了方便，直接放一起。
         # - 访问修饰符，private、protect等
@@ -637,18 +2921,24 @@ class SmaliField:
         self._is_static = False  # 用于修改静态属性
         self._is_final = False
 
-        self._class = class_name
+        self._class = _intern(class_name)
         self._name = field_name
-        self._type = field_type
+        self._type = _intern(field_type)
         self._value = field_value
 
-        self._declaration_sm = dsm  # 声明语句
-        self._reference_sm = None  # 引用语句，其他引用该field的语句
-
         self._old_declaration_sm = None  # 存放旧的声明语句，为方便将修改后内容写回文件
         self._modified = False
         self._desc = None
 
+        # 声明语句在文件代码中的位置
+        self._source = None
+        self._start = None
+        self._end = None
+
+        # 声明语句，如 .field private a:I
+        if dsm:
+            self.set_declaration_sm(dsm)
+
     def get_desc(self):
         return self.get_reference_sm()
 
@@ -658,11 +2948,12 @@ class SmaliField:
         .field protected static final z:Ljava/lang/String; = "Action"
         '''
 
-        self._declaration_sm = sm
         items = sm.split(' = ')
         parts = items[0].split()
-        self._modifier = parts[1:-1]
-        self._name, self._type = parts[-1].split(':')
+        self._modifier = [_intern(item) for item in parts[1:-1]]
+        name, mtype = parts[-1].split(':')
+        self._name = _intern(name)
+        self._type = _intern(mtype)
         self._is_static = 'static' in self._modifier
         self._is_final = 'final' in self._modifier
         if len(items) == 2:
@@ -685,6 +2976,9 @@ class SmaliField:
     def get_old_declaration_sm(self):
         return self._old_declaration_sm
 
+    def get_modifier(self):
+        return self._modifier
+
     def get_is_static(self):
         return self._is_static
 
@@ -709,7 +3003,7 @@ class SmaliField:
         return self._class
 
     def set_class(self, clz):
-        self._class = clz
+        self._class = _intern(clz)
 
     def get_name(self):
         return self._name
@@ -722,7 +3016,7 @@ class SmaliField:
         return self._type
 
     def set_type(self, mtype):
-        self._type = mtype
+        self._type = _intern(mtype)
         self._modified = True
 
     def get_value(self):
@@ -759,29 +3053,44 @@ class SmaliMethod:
     return_type : Z\n
     '''
 
-    def __init__(self, class_name, mtd_sign, body=None):
-        self._class = class_name
+    __slots__ = ['_class', '_modified', '_access_flags', '_name', '_proto',
+                 '_return_type', '_body', '_code', '_source', '_start', '_end',
+                 '_sign', '_desc', '_params', '__weakref__']
+
+    def __init__(self, class_name, mtd_sign, body=None, source=None,
+                 start=None, end=None):
+        '''
+        :param body: 方法体
+        :param source: 文件代码，如果没有提供方法体，则从source[start:end]截取
+        '''
+        self._class = _intern(class_name)
         self._modified = False
 
-        self._access_flags = mtd_sign.split(' ')
+        self._access_flags = [_intern(flag) for flag in mtd_sign.split(' ')]
 
         result = re.match(r'^(.*?)\((.*?)\)(.*?)$',
                           self._access_flags[-1]).groups()
-        self._name = result[0]
-        self._proto = result[1]
-        self._return_type = result[2]
+        self._name = _intern(result[0])
+        self._proto = _intern(result[1])
+        self._return_type = _intern(result[2])
 
         del self._access_flags[-1]
 
         self._body = body
+        # 解码后的方法体，见get_code
+        self._code = None
+        # 方法体在文件代码中的位置
+        self._source = source
+        self._start = start
+        self._end = end
         # signature
-        self._sign = '(' + self._proto + ')' + self._return_type
+        self._sign = _intern('(' + self._proto + ')' + self._return_type)
 
         # description
         self._desc = self._class + '->' + self._name + self._sign
 
         # parameters
-        self._params = SmaliLine.parse_proto(self._proto)
+        self._params = [_intern(p) for p in SmaliLine.parse_proto(self._proto)]
 
     def get_access_flags(self):
         return self._access_flags
@@ -795,6 +3104,10 @@ class SmaliMethod:
     def get_class(self):
         return self._class
 
+    def set_class(self, clz):
+        self._class = _intern(clz)
+        self._desc = self._class + '->' + self._name + self._sign
+
     def get_name(self):
         return self._name
 
@@ -816,12 +3129,30 @@ class SmaliMethod:
         return self._return_type
 
     def get_body(self):
+        if self._body is None and self._source is not None:
+            return self._source[self._start:self._end]
         return self._body
 
     def set_body(self, new_body):
         self._body = new_body
+        self._code = None
         self._modified = True
 
+    def get_code(self):
+        '''
+        方法体解码后的SmaliCode，首次调用时解码，之后共享同一个结果
+        '''
+        if self._code is None:
+            self._code = SmaliCode.from_body(self.get_body())
+        return self._code
+
+    def set_code(self, code):
+        '''
+        用修改后的SmaliCode更新方法体
+        '''
+        self.set_body(code.to_smali())
+        self._code = code
+
     def get_params(self):
         return self._params
 
@@ -833,3 +3164,225 @@ class SmaliMethod:
 
     def __str__(self):
         return self._desc
+
+
+class _Interner:
+    '''
+    字符串驻留表，字符串 <-> 编号；0号保留，表示无
+    '''
+
+    def __init__(self, reserved=(None,)):
+        self._values = list(reserved)
+        self._ids = {value: i for i, value in enumerate(self._values)}
+
+    def intern(self, value):
+        index = self._ids.get(value)
+        if index is None:
+            index = len(self._values)
+            self._values.append(value)
+            self._ids[value] = index
+        return index
+
+    def value(self, index):
+        return self._values[index]
+
+    def index(self, value):
+        '''字符串的编号，不存在时返回None'''
+        return self._ids.get(value)
+
+    def __len__(self):
+        return len(self._values)
+
+
+class SmaliCode:
+    '''
+    方法体的紧凑表示，每一行对应一项：
+
+    - opcodes: 操作码编号，BLANK表示空行，RAW表示原样保存的行（标签、伪指令、注解等）
+    - reg_offsets: 每一行的寄存器在registers中的起始位置
+    - registers: 寄存器编号（0~65535），p寄存器加上P_REGISTER标记
+    - refs: 引用（类、方法、字段、字符串、常量、标签）的编号；RAW行保存整行内容
+
+    操作码、引用的编号来自strings，每个SmaliCode一张驻留表，随SmaliCode一起释放，
+    不会在整个进程中一直增长。
+    '''
+
+    __slots__ = ['opcodes', 'reg_offsets', 'registers', 'refs', 'strings']
+
+    BLANK = 0
+    RAW = 1
+    P_REGISTER = 0x10000
+    MAX_REGISTER = 0xffff
+    INDENT = '    '
+
+    def __init__(self, strings=None):
+        '''
+        :param strings: 共用的驻留表，默认新建；0、1号保留，与BLANK、RAW对应
+        '''
+        self.opcodes = array.array('I')
+        self.reg_offsets = array.array('I', [0])
+        self.registers = array.array('I')
+        self.refs = array.array('I')
+        self.strings = strings or _Interner((None, None))
+
+    @staticmethod
+    def from_body(body):
+        '''
+        解码方法体，无法按照标准格式还原的行，原样保存
+        '''
+        code = SmaliCode()
+        match = SmaliLine._INSTRUCTION_PTN.match
+        in_block = None
+        for line in body.split('\n'):
+            if not line:
+                code._append_raw(None)
+                continue
+
+            result = None if in_block else match(line)
+            if result:
+                ins = SmaliLine._decode(*result.groups())
+                if SmaliCode._render(ins) == line:
+                    try:
+                        code.append(ins)
+                        continue
+                    except ValueError:
+                        pass  # 寄存器编号超出范围
+            elif in_block:
+                if line.strip().startswith('.end ' + in_block):
+                    in_block = None
+            else:
+                # 注解、数组数据、switch数据中的行，不是指令
+                directive = line.strip().split(None, 1)[0]
+                if directive in ('.annotation', '.array-data',
+                                 '.packed-switch', '.sparse-switch'):
+                    in_block = directive[1:]
+            code._append_raw(line)
+        return code
+
+    def _append_raw(self, line):
+        self.opcodes.append(self.BLANK if line is None else self.RAW)
+        self.reg_offsets.append(len(self.registers))
+        self.refs.append(self.strings.intern(line))
+
+    def append(self, ins):
+        '''添加一条SmaliInstruction'''
+        registers = [self._encode_register(r) for r in ins.registers]
+        self.opcodes.append(self.strings.intern(ins.opcode))
+        self.registers.extend(registers)
+        self.reg_offsets.append(len(self.registers))
+        self.refs.append(self.strings.intern(ins.ref))
+
+    @staticmethod
+    def _encode_register(name):
+        value = int(name[1:])
+        if value > SmaliCode.MAX_REGISTER:
+            raise ValueError('register out of range: {}'.format(name))
+        if name[0] == 'p':
+            return value | SmaliCode.P_REGISTER
+        return value
+
+    @staticmethod
+    def _decode_register(value):
+        if value & SmaliCode.P_REGISTER:
+            return 'p' + str(value & ~SmaliCode.P_REGISTER)
+        return 'v' + str(value)
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __getitem__(self, index):
+        '''
+        @return SmaliInstruction；空行、原样保存的行返回None
+        '''
+        opcode = self.opcodes[index]
+        if opcode <= self.RAW:
+            return
+        registers = tuple(
+            self._decode_register(r) for r in
+            self.registers[self.reg_offsets[index]:
+                           self.reg_offsets[index + 1]])
+        return SmaliInstruction(self.strings.value(opcode), registers,
+                                self.strings.value(self.refs[index]))
+
+    def __setitem__(self, index, ins):
+        '''替换一条指令'''
+        tail = SmaliCode(self.strings)
+        for i in range(index + 1, len(self)):
+            tail._copy_line(self, i)
+        self._truncate(index)
+        self.append(ins)
+        for i in range(len(tail)):
+            self._copy_line(tail, i)
+
+    def insert(self, index, ins):
+        '''在index处插入一条指令'''
+        tail = SmaliCode(self.strings)
+        for i in range(index, len(self)):
+            tail._copy_line(self, i)
+        self._truncate(index)
+        self.append(ins)
+        for i in range(len(tail)):
+            self._copy_line(tail, i)
+
+    def __delitem__(self, index):
+        tail = SmaliCode(self.strings)
+        for i in range(index + 1, len(self)):
+            tail._copy_line(self, i)
+        self._truncate(index)
+        for i in range(len(tail)):
+            self._copy_line(tail, i)
+
+    def _truncate(self, index):
+        del self.opcodes[index:]
+        del self.refs[index:]
+        del self.registers[self.reg_offsets[index]:]
+        del self.reg_offsets[index + 1:]
+
+    def _copy_line(self, code, index):
+        self.opcodes.append(code.opcodes[index])
+        self.registers.extend(
+            code.registers[code.reg_offsets[index]:
+                           code.reg_offsets[index + 1]])
+        self.reg_offsets.append(len(self.registers))
+        self.refs.append(code.refs[index])
+
+    def instructions(self):
+        '''
+        遍历所有指令
+
+        @return (行号, SmaliInstruction)
+        '''
+        for index, opcode in enumerate(self.opcodes):
+            if opcode > self.RAW:
+                yield index, self[index]
+
+    @staticmethod
+    def _render(ins):
+        text = SmaliCode.INDENT + ins.opcode
+        if ins.opcode.startswith(('invoke-', 'filled-new-array')):
+            sep = ' .. ' if ins.opcode.endswith('/range') else ', '
+            text += ' {' + sep.join(ins.registers) + '}'
+            if ins.ref is not None:
+                text += ', ' + ins.ref
+            return text
+
+        operands = list(ins.registers)
+        if ins.ref is not None:
+            operands.append(ins.ref)
+        if operands:
+            text += ' ' + ', '.join(operands)
+        return text
+
+    def to_smali(self):
+        '''
+        还原为smali代码
+        '''
+        lines = []
+        for index, opcode in enumerate(self.opcodes):
+            if opcode == self.BLANK:
+                lines.append('')
+            elif opcode == self.RAW:
+                lines.append(self.strings.value(self.refs[index]))
+            else:
+                lines.append(self._render(self[index]))
+        return '\n'.join(lines)
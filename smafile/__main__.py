@@ -1,23 +1,196 @@
-from smafile import __VERSION__, SmaliDir
+'''
+python -m smafile <命令> smali目录... [选项]
 
+命令：
+    index/load  解析所有文件，每个类输出一行，并把解析结果保存到缓存目录
+                （--cache，默认.smafile_cache）
+    dump        输出每个类的父类、接口、字段、方法
+    xref        找出引用了某个类、方法、变量的方法
+    rename      根据映射文件，批量修改类、方法、变量的名字
+    strings     输出所有字符串常量
 
-def main(args):
-    sdx = SmaliDir(args.p, args.include)
-    for item in sdx:
-        print(item)
-        for mtd in item.get_methods():
-            print(mtd)
+所有命令都以JSON Lines格式输出，每处理完一项就输出一行，可以直接接到管道中处理。
 
+index保存的是每个文件的解析结果：类名、父类、接口、字段声明、方法声明和方法体的位置，
+以文件的路径、修改时间、大小、内容的哈希校验；其他命令指定同一个--cache时，
+没有变化的文件不再重新扫描。类、方法、字段索引和引用索引不保存，加载时根据解析结果重新建立。
+'''
+import argparse
+import json
+import os
+import sys
 
-if __name__ == '__main__':
+from smafile import (__VERSION__, EXCLUDE, INCLUDE, NO_OPT, Profiler,
+                     SmaliDir)
+
+
+# index默认的缓存目录
+DEFAULT_CACHE = '.smafile_cache'
+
+
+def write(record):
+    sys.stdout.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def _options(args):
+    if args.include:
+        filters, opt = args.include, INCLUDE
+    elif args.exclude:
+        filters, opt = args.exclude, EXCLUDE
+    else:
+        filters, opt = None, NO_OPT
+    return dict(filters=filters, opt=opt, workers=args.jobs,
+                cache_dir=args.cache, profiler=args.profiler)
+
+
+def load(args):
+    '''整个目录都需要的命令，如xref、rename'''
+    return SmaliDir(args.p, **_options(args))
+
+
+def stream(args):
+    '''逐个文件处理的命令，如index、dump、strings，不保留已处理的文件'''
+    return SmaliDir.stream(args.p, **_options(args))
+
+
+def cmd_index(args):
+    # --cache在各命令间共用，不能用set_defaults，否则其他命令也会使用默认目录
+    if args.cache is None:
+        args.cache = DEFAULT_CACHE
+    for sf in stream(args):
+        write({
+            'class': sf.get_class(),
+            'file': sf.get_file_path(),
+            'super': sf.get_supper(),
+            'interfaces': sf.get_interfaces(),
+            'fields': len(sf.get_fields()),
+            'methods': len(sf.get_methods()),
+        })
+
+
+def cmd_dump(args):
+    for sf in stream(args):
+        write({
+            'class': sf.get_class(),
+            'super': sf.get_supper(),
+            'interfaces': sf.get_interfaces(),
+            'fields': [str(field) for field in sf.get_fields()],
+            'methods': [str(mtd) for mtd in sf.get_methods()],
+        })
+
+
+def cmd_xref(args):
+    sdx = load(args)
+    for sf, mtd in sdx.xref_methods(args.desc):
+        write({'class': sf.get_class(), 'method': str(mtd)})
+    return sdx
 
-    import argparse
-    parser = argparse.ArgumentParser(prog='smafile', description=None)
-    parser.add_argument('p', help='path')
-    parser.add_argument('-i', '--include', nargs='+', type=str)
 
+def read_mapping(path):
+    '''
+    映射文件，每行一项：旧描述 新描述；空行、#开头的行忽略
+    '''
+    mapping = {}
+    with open(path, encoding='utf-8') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            items = line.split()
+            if len(items) != 2:
+                raise SystemExit('{}:{}: expected "old new", got {!r}'.format(
+                    path, lineno, line))
+            mapping[items[0]] = items[1]
+    return mapping
+
+
+def cmd_rename(args):
+    mapping = read_mapping(args.map)
+    sdx = load(args)
+    # 全部修改完才写入文件，中途出错时不会留下改了一半的目录
+    with sdx.transaction():
+        saved = sdx.update_descs(mapping)
+    for sf in saved:
+        write({'class': sf.get_class(), 'file': sf.get_file_path()})
+    return sdx
+
+
+def cmd_strings(args):
+    strings = {}
+    for sf in stream(args):
+        for record in sf.iter_strings(strings):
+            write(record._asdict())
+
+
+COMMANDS = {
+    'index': cmd_index,
+    'load': cmd_index,
+    'dump': cmd_dump,
+    'xref': cmd_xref,
+    'rename': cmd_rename,
+    'strings': cmd_strings,
+}
+
+
+def parse_args(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    group = common.add_mutually_exclusive_group()
+    group.add_argument('-i', '--include', nargs='+', type=str,
+                       help='只处理这些包、类')
+    group.add_argument('-e', '--exclude', nargs='+', type=str,
+                       help='不处理这些包、类')
+    common.add_argument('-j', '--jobs', type=int, help='解析文件的进程数')
+    common.add_argument('--cache', help='解析结果的缓存目录')
+    common.add_argument('--profile', action='store_true',
+                        help='统计各阶段的耗时，以JSON格式输出到stderr')
+
+    parser = argparse.ArgumentParser(
+        prog='smafile', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('-V', '--version', action='version',
                         version=__VERSION__)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    index = commands.add_parser(
+        'index', parents=[common], aliases=['load'],
+        help='解析所有文件，把每个文件的解析结果保存到--cache（默认{}）'
+             .format(DEFAULT_CACHE))
+    dump = commands.add_parser('dump', parents=[common],
+                               help='输出每个类的父类、接口、字段、方法')
+    xref = commands.add_parser('xref', parents=[common],
+                               help='找出引用了某个类、方法、变量的方法')
+    xref.add_argument('desc', help='类、方法、变量的描述，如La/b;->c()V')
+    rename = commands.add_parser('rename', parents=[common],
+                                 help='根据映射文件，批量重命名')
+    rename.add_argument('--map', required=True,
+                        help='映射文件，每行一项：旧描述 新描述')
+    strings = commands.add_parser('strings', parents=[common],
+                                  help='输出所有字符串常量')
+    for item in (index, dump, xref, rename, strings):
+        item.add_argument('p', nargs='+', help='smali目录')
+
+    return parser.parse_args(argv)
+
 
-    args = parser.parse_args()
-    main(args)
+def main(argv=None):
+    args = parse_args(argv)
+    args.profiler = Profiler() if args.profile else None
+    try:
+        sdx = COMMANDS[args.command](args)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # 下游的管道已经关闭，如 | head；避免退出时flush再次报错
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return
+
+    if args.profiler:
+        # 统计结果输出到stderr，不影响正常的输出
+        stats = sdx.stats() if sdx else args.profiler.stats()
+        json.dump(stats, sys.stderr, indent=2)
+        sys.stderr.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,23 @@
 import unittest
+import unittest.mock
+import contextlib
+import io
+import json
 import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import weakref
 
-from smafile import SmaliDir, SmaliMethod
+from smafile import (EXCLUDE, INCLUDE, ParseCache, Profiler, SmaliCode,
+                     SmaliDir, SmaliFile, SmaliInstruction, SmaliLine,
+                     SmaliField, SmaliMethod, StringRecord, escape_string,
+                     find_dex_dirs, parse_smali_file, read_smali_file,
+                     unescape_string, _imap_parallel)
+from smafile import __main__ as cli
 
 sd = SmaliDir('smali')
 test_class_name = 'Lcom/test/Test;'
@@ -14,6 +30,14 @@ for item in sdx:
     print(item)
 
 
+def copy_smali_dir():
+    '''复制测试用的smali目录，避免修改原文件'''
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'smali')
+    shutil.copytree('smali', path)
+    return path
+
+
 class Test(unittest.TestCase):
 
     def test_SmaliDir(self):
@@ -65,6 +89,1479 @@ class Test(unittest.TestCase):
         self.assertEqual(f.get_value(), 'Test')
         self.assertEqual(str(f), field_desc)
 
+
+class TestIndex(unittest.TestCase):
+
+    def test_lookup(self):
+        mtd = sd.get_method_from_desc(test_class_name + '->' + test_mtd)
+        self.assertIs(mtd, sd.get_method(test_class_name, test_mtd))
+
+        field_desc = 'Lcom/test/MyService;->a:Ljava/lang/String;'
+        self.assertIs(sd.get_field(field_desc),
+                      sd.get_smali_file('Lcom/test/MyService;').get_field(
+                          field_desc))
+        self.assertIsNone(sd.get_smali_file('Lcom/test/NotExists;'))
+
+    def test_update_desc(self):
+        path = copy_smali_dir()
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        sdx = SmaliDir(path)
+        new_class_name = 'Lcom/test/Renamed;'
+        sdx.update_desc(test_class_name, new_class_name)
+
+        self.assertIsNone(sdx.get_smali_file(test_class_name))
+        sf = sdx.get_smali_file(new_class_name)
+        self.assertEqual(sf.get_class(), new_class_name)
+        self.assertIsNone(sdx.get_method(test_class_name, test_mtd))
+        self.assertIsInstance(
+            sdx.get_method(new_class_name, test_mtd), SmaliMethod)
+
+        sdx.update_desc(new_class_name + '->a([B)Ljava/lang/String;',
+                        new_class_name + '->b([B)Ljava/lang/String;')
+        self.assertIsNone(
+            sdx.get_method(new_class_name, 'a([B)Ljava/lang/String;'))
+        self.assertIsNotNone(
+            sdx.get_method(new_class_name, 'b([B)Ljava/lang/String;'))
+
+    def test_setitem(self):
+        path = copy_smali_dir()
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        sdx = SmaliDir(path)
+        index = [sf.get_class() for sf in sdx].index(test_class_name)
+        sf = SmaliFile(sdx[index].get_file_path())
+        sdx[index] = sf
+        self.assertIs(sdx.get_smali_file(test_class_name), sf)
+        self.assertIs(sdx.get_method(test_class_name, test_mtd),
+                      sf.get_method(test_mtd))
+
+
+class TestLazy(unittest.TestCase):
+
+    def test_lazy(self):
+        profiler = Profiler()
+        sdl = SmaliDir('smali', lazy=True, profiler=profiler)
+
+        def files_read():
+            return profiler.stats()['phases'].get('read', {}).get('count', 0)
+
+        self.assertEqual(len(sdl), 6)
+        self.assertEqual([sf.get_class() for sf in sdl],
+                         [sf.get_class() for sf in SmaliDir('smali')])
+        self.assertEqual(files_read(), 0)
+
+        sf = sdl.get_smali_file(test_class_name)
+        self.assertEqual(sf.get_file_path(), test_class_file)
+        self.assertEqual(files_read(), 0)
+
+        mtd = sdl.get_method(test_class_name, test_mtd)
+        self.assertEqual(files_read(), 1)
+        self.assertEqual(str(mtd), test_class_name + '->' + test_mtd)
+        self.assertEqual(sf.get_supper(), 'Ljava/lang/Object;')
+        self.assertEqual(files_read(), 1)
+
+        field_desc = 'Lcom/test/MyService;->a:Ljava/lang/String;'
+        self.assertEqual(str(sdl.get_field(field_desc)), field_desc)
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_workers(self):
+        sdp = SmaliDir('smali', workers=2)
+        self.assertEqual([sf.get_file_path() for sf in sdp],
+                         [sf.get_file_path() for sf in sd])
+        for sf1, sf2 in zip(sdp, sd):
+            self.assertEqual(sf1.get_class(), sf2.get_class())
+            self.assertEqual([str(f) for f in sf1.get_fields()],
+                             [str(f) for f in sf2.get_fields()])
+            self.assertEqual([str(m) for m in sf1.get_methods()],
+                             [str(m) for m in sf2.get_methods()])
+        # 其他测试会修改sd中的方法体，与重新加载的结果对比
+        for sf1, sf2 in zip(sdp, SmaliDir('smali')):
+            self.assertEqual(sf1.get_content(), sf2.get_content())
+            self.assertEqual([m.get_body() for m in sf1.get_methods()],
+                             [m.get_body() for m in sf2.get_methods()])
+        self.assertIsInstance(
+            sdp.get_method(test_class_name, test_mtd), SmaliMethod)
+
+
+def legacy_parse_smali_file(file_path):
+    '''原来基于正则的解析方式，用于对比单次扫描的解析结果'''
+    with open(file_path, 'r', encoding='utf-8') as f:
+        content = re.sub(r'\s*?\.line \d+', '', f.read())
+
+    clz = re.compile(r'^\.class[a-z\s]+(.+)').search(content).groups()[0]
+    supper = re.compile(r'\.super (.+)').search(content).groups()[0]
+    fields = [i.group()
+              for i in re.compile(r'\.field .*?(?=\n)').finditer(content)]
+
+    methods = []
+    for item in re.compile(r'\n\.method (.*)').finditer(content, re.M):
+        mbody_ptn = r'%s\n(.*?)\.end method' % re.escape(item.group())
+        body = re.compile(mbody_ptn, re.DOTALL).search(content).groups()[0]
+        methods.append((item.groups()[0], body))
+
+    return content, clz, supper, fields, methods
+
+
+class TestParser(unittest.TestCase):
+
+    def test_same_as_legacy_parser(self):
+        paths = [sf.get_file_path() for sf in sd] + ['test.smali']
+        for path in paths:
+            content, clz, supper, _, fields, methods = parse_smali_file(path)
+            for line, start, end in fields:
+                self.assertEqual(content[start:end], line)
+            fields = [line for line, _, _ in fields]
+            methods = [(sign, content[start:end])
+                       for sign, start, end in methods]
+            self.assertEqual((content, clz, supper, fields, methods),
+                             legacy_parse_smali_file(path), path)
+
+    def test_line_directives(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'A.smali')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('.class public La;\n.super Ljava/lang/Object;\n'
+                    '.field a:I\n\n.method public b()V\n    .registers 1\n'
+                    '\n    .line 12\n    return-void\n.end method\n')
+        content, _, _, _, fields, methods = parse_smali_file(path)
+        self.assertEqual(fields, [('.field a:I', 44, 54)])
+        self.assertEqual(legacy_parse_smali_file(path)[4],
+                         [(sign, content[start:end])
+                          for sign, start, end in methods])
+
+    def test_crlf(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'A.smali')
+        with open(path, 'wb') as f:
+            f.write('.class public La;\r\n.super Ljava/lang/Object;\r\n'
+                    '.field a:Ljava/lang/String; = "\u4e2d"\r\n\r\n'
+                    '.method public b()V\r\n    .registers 1\r\n'
+                    '\r\n    .line 12\r\n    return-void\r'
+                    '    .line 13\n.end method\n'.encode('utf-8'))
+
+        paths = [sf.get_file_path() for sf in sd] + ['test.smali', path]
+        for item in paths:
+            content, clz, supper, _, fields, methods = \
+                parse_smali_file(item)
+            self.assertEqual(content, read_smali_file(item))
+            fields = [line for line, _, _ in fields]
+            methods = [(sign, content[start:end])
+                       for sign, start, end in methods]
+            self.assertEqual((content, clz, supper, fields, methods),
+                             legacy_parse_smali_file(item), item)
+
+        cache = ParseCache(os.path.join(tmp, 'cache'))
+        parsed = parse_smali_file(path, cache)
+        self.assertEqual(parse_smali_file(path, cache), parsed)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+class TestParseCache(unittest.TestCase):
+
+    def test_cache(self):
+        path = copy_smali_dir()
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        cache_dir = os.path.join(os.path.dirname(path), 'cache')
+
+        sdx = SmaliDir(path, cache_dir=cache_dir)
+        self.assertEqual((sdx.cache.hits, sdx.cache.misses), (0, 6))
+
+        sdx = SmaliDir(path, cache_dir=cache_dir)
+        self.assertEqual((sdx.cache.hits, sdx.cache.misses), (6, 0))
+        sf = sdx.get_smali_file(test_class_name)
+        self.assertEqual([str(m) for m in sf.get_methods()],
+                         [str(m) for m in sd.get_smali_file(
+                             test_class_name).get_methods()])
+
+        # 修改后的文件，缓存失效
+        with open(sf.get_file_path(), 'a', encoding='utf-8') as f:
+            f.write('\n.method public added()V\n    return-void\n.end method\n')
+        sdx = SmaliDir(path, cache_dir=cache_dir)
+        self.assertEqual((sdx.cache.hits, sdx.cache.misses), (5, 1))
+        self.assertIsNotNone(sdx.get_method(test_class_name, 'added()V'))
+
+        # save之后，缓存被更新
+        sf = sdx.get_smali_file(test_class_name)
+        sf.set_content(sf.get_content().replace('added()V', 'saved()V'))
+        sf.save()
+        sdx = SmaliDir(path, cache_dir=cache_dir)
+        self.assertEqual((sdx.cache.hits, sdx.cache.misses), (6, 0))
+        self.assertIsNotNone(sdx.get_method(test_class_name, 'saved()V'))
+
+    def test_parallel_stats(self):
+        path = copy_smali_dir()
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        cache_dir = os.path.join(os.path.dirname(path), 'cache')
+
+        # 子进程中的命中次数，汇总到主进程
+        sdx = SmaliDir(path, workers=2, cache_dir=cache_dir)
+        self.assertEqual(sdx.stats()['cache'], {'hits': 0, 'misses': 6})
+        sdx = SmaliDir(path, workers=2, cache_dir=cache_dir)
+        self.assertEqual(sdx.stats()['cache'], {'hits': 6, 'misses': 0})
+
+
+class TestXref(unittest.TestCase):
+
+    def test_xref(self):
+        sdx = SmaliDir('smali')
+        desc = 'La/a/e/e;->a(Ljava/lang/String;Ljava/lang/String;)V'
+        self.assertEqual(
+            sorted(str(sf) for sf in sdx.xref(desc)),
+            ['Lcom/test/MyReceiver;', 'Lcom/test/MyService;',
+             'Lcom/test/NewB;', 'Lcom/test/NewC;', test_class_name])
+        self.assertIn(sdx.get_method(test_class_name, test_mtd),
+                      [mtd for _, mtd in sdx.xref_methods(desc)])
+        self.assertEqual(len(sdx.xref('La/a/e/e;')), 6)
+
+        # const-class
+        self.assertIn('Lcom/test/MyReceiver;',
+                      [str(sf) for sf in sdx.xref('Lcom/test/MyService;')])
+        self.assertEqual(sdx.xref('Lcom/test/NotExists;'), [])
+
+    def test_array_owner(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        write_class(tmp, 'La/A;', ''.join(
+            '    {}\n'.format(line) for line in [
+                'invoke-virtual {v0}, [I->clone()Ljava/lang/Object;',
+                'invoke-virtual {v0}, [La/B;->clone()Ljava/lang/Object;',
+                'check-cast v0, [[La/C;']))
+        sdx = SmaliDir(tmp)
+        # 返回类型不是引用
+        self.assertEqual(sdx.xref('Ljava/lang/Object;'), [])
+        self.assertEqual(sdx.xref('La/B;->clone()Ljava/lang/Object;'), [])
+        self.assertEqual([str(sf) for sf in sdx.xref('La/B;')], ['La/A;'])
+        self.assertEqual([str(sf) for sf in sdx.xref('La/C;')], ['La/A;'])
+
+    def test_lazy(self):
+        desc = 'La/a/e/e;->a(Ljava/lang/String;Ljava/lang/String;)V'
+        expected = [(str(sf), str(mtd)) for sf, mtd in
+                    SmaliDir('smali').xref_methods(desc)]
+        lazy = [(str(sf), str(mtd)) for sf, mtd in
+                SmaliDir('smali', lazy=True).xref_methods(desc)]
+        self.assertEqual(sorted(lazy), sorted(expected))
+        self.assertEqual(len(lazy), len(set(lazy)))
+
+    def test_xref_after_update(self):
+        path = copy_smali_dir()
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        sdx = SmaliDir(path)
+        sdx.update_desc('Lcom/test/MyService;', 'Lcom/test/NewService;')
+        self.assertEqual(sdx.xref('Lcom/test/MyService;'), [])
+        self.assertEqual(
+            sorted(str(sf) for sf in sdx.xref('Lcom/test/NewService;')),
+            ['Lcom/test/MyReceiver;', 'Lcom/test/NewService;'])
+
+
+INNER_CLASS = '''.class Lcom/test/Test$Inner;
+.super Ljava/lang/Object;
+
+.annotation system Ldalvik/annotation/InnerClass;
+    accessFlags = 0x0
+    name = "Inner"
+.end annotation
+
+.method public constructor <init>()V
+    .registers 1
+
+    invoke-static {}, Lcom/test/Test;->a([B)Ljava/lang/String;
+
+    return-void
+.end method
+'''
+
+
+class TestUpdateDescs(unittest.TestCase):
+
+    def test_update_descs(self):
+        path = copy_smali_dir()
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(os.path.join(path, 'com', 'test', 'Test$Inner.smali'), 'w',
+                  encoding='utf-8') as f:
+            f.write(INNER_CLASS)
+        sdx = SmaliDir(path)
+
+        mapping = {
+            test_class_name: 'Lcom/test/Renamed;',
+            test_class_name + '->a([B)Ljava/lang/String;':
+                test_class_name + '->decode([B)Ljava/lang/String;',
+            'Lcom/test/MyService;->a:Ljava/lang/String;':
+                'Lcom/test/MyService;->name:Ljava/lang/String;',
+            'Lcom/test/Test$Inner;': 'Lcom/test/Test$Named;',
+        }
+        with unittest.mock.patch.object(
+                SmaliFile, 'save', autospec=True,
+                side_effect=SmaliFile.save) as save:
+            sdx.update_descs(mapping)
+        saved = [call.args[0].get_file_path() for call in save.mock_calls]
+        self.assertEqual(len(saved), len(set(saved)))
+
+        sf = sdx.get_smali_file('Lcom/test/Renamed;')
+        self.assertEqual(sf.get_file_path(),
+                         os.path.join(path, 'com', 'test', 'Renamed.smali'))
+        self.assertFalse(os.path.exists(os.path.join(
+            path, 'com', 'test', 'Test.smali')))
+        self.assertIsNotNone(sdx.get_method(
+            'Lcom/test/Renamed;', 'decode([B)Ljava/lang/String;'))
+        self.assertIsNotNone(sdx.get_field(
+            'Lcom/test/MyService;->name:Ljava/lang/String;'))
+        self.assertIsNone(sdx.get_field(
+            'Lcom/test/MyService;->a:Ljava/lang/String;'))
+
+        inner = sdx.get_smali_file('Lcom/test/Test$Named;')
+        self.assertIn('name = "Named"', inner.get_content())
+        self.assertIn('Lcom/test/Renamed;->decode([B)Ljava/lang/String;',
+                      inner.get_content())
+        for sf in sdx:
+            self.assertNotIn('Lcom/test/Test;', sf.get_content())
+            self.assertNotIn('MyService;->a:', sf.get_content())
+
+    def test_class_in_signature(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        os.makedirs(os.path.join(tmp, 'p'))
+        with open(os.path.join(tmp, 'p', 'A.smali'), 'w',
+                  encoding='utf-8') as f:
+            f.write('.class public Lp/A;\n.super Ljava/lang/Object;\n\n'
+                    '.field public g:Lp/B;\n\n'
+                    '.method public static f(Lp/B;)V\n'
+                    '    .registers 1\n    return-void\n.end method\n')
+        with open(os.path.join(tmp, 'p', 'B.smali'), 'w',
+                  encoding='utf-8') as f:
+            f.write('.class public Lp/B;\n.super Ljava/lang/Object;\n\n'
+                    '.method public run(Lp/A;)V\n    .registers 2\n'
+                    '    invoke-static {p0}, Lp/A;->f(Lp/B;)V\n'
+                    '    iget-object v0, p1, Lp/A;->g:Lp/B;\n'
+                    '    return-void\n.end method\n')
+        sdx = SmaliDir(tmp)
+        sdx.update_descs({
+            'Lp/B;': 'Lp/C;',
+            'Lp/A;->f(Lp/B;)V': 'Lp/A;->h(Lp/B;)V',
+            'Lp/A;->g:Lp/B;': 'Lp/A;->k:Lp/B;',
+        })
+
+        self.assertIsNotNone(sdx.get_method('Lp/A;', 'h(Lp/C;)V'))
+        self.assertIsNotNone(sdx.get_field('Lp/A;->k:Lp/C;'))
+        body = sdx.get_method('Lp/C;', 'run(Lp/A;)V').get_body()
+        self.assertIn('invoke-static {p0}, Lp/A;->h(Lp/C;)V', body)
+        self.assertIn('iget-object v0, p1, Lp/A;->k:Lp/C;', body)
+        for sf in sdx:
+            self.assertNotIn('Lp/B;', sf.get_content())
+
+
+class TestTransaction(unittest.TestCase):
+
+    def test_commit(self):
+        path = copy_smali_dir()
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        old_path = os.path.join(path, 'com', 'test', 'Test.smali')
+        new_path = os.path.join(path, 'com', 'test', 'Renamed.smali')
+        sdx = SmaliDir(path)
+
+        sdx.begin()
+        sdx.update_desc(test_class_name, 'Lcom/test/Renamed;')
+        sdx.update_desc('Lcom/test/MyService;', 'Lcom/test/NewService;')
+        self.assertTrue(os.path.exists(old_path))
+        self.assertFalse(os.path.exists(new_path))
+
+        # 内存中的数据已经更新
+        self.assertIsNone(sdx.get_smali_file(test_class_name))
+        self.assertIsInstance(
+            sdx.get_method('Lcom/test/Renamed;', test_mtd), SmaliMethod)
+        self.assertEqual(
+            sorted(str(sf) for sf in sdx.xref('Lcom/test/NewService;')),
+            ['Lcom/test/MyReceiver;', 'Lcom/test/NewService;'])
+
+        sdx.commit()
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(new_path))
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(path, 'com', 'test'))),
+            ['Hello.smali', 'MyReceiver.smali', 'NewB.smali', 'NewC.smali',
+             'NewService.smali', 'Renamed.smali'])
+
+        sdy = SmaliDir(path)
+        self.assertIsInstance(
+            sdy.get_method('Lcom/test/Renamed;', test_mtd), SmaliMethod)
+
+    def test_commit_error(self):
+        path = copy_smali_dir()
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        sdx = SmaliDir(path)
+        sdx.begin()
+        sdx.update_desc(test_class_name, 'Lcom/test/Renamed;')
+        sdx.update_desc('Lcom/test/MyService;', 'Lcom/test/NewService;')
+
+        replace = os.replace
+        calls = []
+
+        def fail_second(src, dst):
+            calls.append(dst)
+            if len(calls) == 2:
+                raise OSError(28, 'No space left on device')
+            replace(src, dst)
+
+        with unittest.mock.patch('smafile.os.replace', fail_second):
+            with self.assertRaises(OSError):
+                sdx.commit()
+        # 不留下临时文件，没有写入的文件仍在事务中
+        for parent, _, filenames in os.walk(path):
+            self.assertEqual([f for f in filenames if f.endswith('.tmp')], [])
+        failed = next(sf for sf in sdx if sf.get_file_path() == calls[1])
+        self.assertNotEqual(read_smali_file(calls[1]), failed.get_content())
+
+        sdx.commit()
+        self.assertEqual(read_smali_file(calls[1]), failed.get_content())
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(path, 'com', 'test'))),
+            ['Hello.smali', 'MyReceiver.smali', 'NewB.smali', 'NewC.smali',
+             'NewService.smali', 'Renamed.smali'])
+        # 事务已经结束，之后的保存直接写入文件
+        sf = sdx.get_smali_file('Lcom/test/Renamed;')
+        sf.set_content(sf.get_content() + '\n')
+        sf.save()
+        self.assertEqual(read_smali_file(sf.get_file_path()),
+                         sf.get_content())
+
+    def test_rollback(self):
+        path = copy_smali_dir()
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        sdx = SmaliDir(path)
+        with self.assertRaises(RuntimeError):
+            with sdx.transaction():
+                sdx.update_desc(test_class_name, 'Lcom/test/Renamed;')
+                raise RuntimeError()
+
+        self.assertIsNone(sdx.get_smali_file('Lcom/test/Renamed;'))
+        sf = sdx.get_smali_file(test_class_name)
+        self.assertEqual(sf.get_file_path(),
+                         os.path.join(path, 'com', 'test', 'Test.smali'))
+        self.assertIn(test_class_name, sf.get_content())
+        self.assertFalse(os.path.exists(
+            os.path.join(path, 'com', 'test', 'Renamed.smali')))
+
+
+SAME_BODIES = '''.class public La;
+.super Ljava/lang/Object;
+
+.field public static s:Ljava/lang/String;
+
+.method public a()V
+    .registers 1
+
+    return-void
+.end method
+
+.method public b()V
+    .registers 1
+
+    return-void
+.end method
+'''
+
+
+class TestSpans(unittest.TestCase):
+
+    def test_update_same_bodies(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'a.smali')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(SAME_BODIES)
+
+        sf = SmaliFile(path)
+        mtd_a, mtd_b = sf.get_methods()
+        self.assertEqual(mtd_a.get_body(), mtd_b.get_body())
+
+        body = '    .registers 1\n\n    nop\n\n    return-void\n'
+        mtd_b.set_body(body)
+        field = sf.get_field('La;->s:Ljava/lang/String;')
+        field.set_value('abc')
+        sf.update()
+
+        saved_a, saved_b = SmaliFile(path).get_methods()
+        self.assertEqual(mtd_a.get_body(), saved_a.get_body())
+        self.assertEqual(mtd_b.get_body(), body)
+        self.assertEqual(saved_b.get_body(), body)
+        with open(path, encoding='utf-8') as f:
+            content = f.read()
+        self.assertIn('.field public static s:Ljava/lang/String; = "abc"\n',
+                      content)
+        self.assertEqual(content.count('nop'), 1)
+
+
+class TestReparse(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'NewC.smali')
+        shutil.copy(os.path.join('smali', 'com', 'test', 'NewC.smali'),
+                    self.path)
+        self.sf = SmaliFile(self.path)
+
+    def assertSameAsFresh(self):
+        fresh = SmaliFile(self.path)
+        self.assertEqual(self.sf.get_class(), fresh.get_class())
+        self.assertEqual(
+            [(str(m), m.get_access_flags(), m.get_body())
+             for m in self.sf.get_methods()],
+            [(str(m), m.get_access_flags(), m.get_body())
+             for m in fresh.get_methods()])
+        self.assertEqual(
+            [f.get_declaration_sm() for f in self.sf.get_fields()],
+            [f.get_declaration_sm() for f in fresh.get_fields()])
+
+    def edit(self, old, new):
+        content = self.sf.get_content()
+        self.assertIn(old, content)
+        self.sf.set_content(content.replace(old, new, 1))
+        self.sf.save()
+        self.assertSameAsFresh()
+
+    def test_edit_method_body(self):
+        methods = list(self.sf.get_methods())
+        fields = list(self.sf.get_fields())
+        mtd = methods[5]
+        body = mtd.get_body()
+        self.edit(body, body.replace('    return', '    nop\n\n    return'))
+
+        self.assertIn('nop', mtd.get_body())
+        for old, new in zip(methods, self.sf.get_methods()):
+            self.assertIs(old, new)
+        for old, new in zip(fields, self.sf.get_fields()):
+            self.assertIs(old, new)
+
+    def test_add_remove_methods(self):
+        methods = list(self.sf.get_methods())
+        added = '.method public added()V\n    return-void\n.end method\n\n'
+        header = '.method ' + ' '.join(methods[3].get_access_flags() + [
+            methods[3].get_name() + methods[3].get_sign()])
+        self.edit(header, added + header)
+        self.assertEqual(len(self.sf.get_methods()), len(methods) + 1)
+        self.assertIs(self.sf.get_methods()[4], methods[3])
+
+        # 删除方法
+        mtd = methods[6]
+        text = '.method ' + ' '.join(mtd.get_access_flags() + [
+            mtd.get_name() + mtd.get_sign()]) + '\n' + mtd.get_body()
+        self.edit(text + '.end method\n', '')
+        self.assertNotIn(mtd, self.sf.get_methods())
+        self.assertIs(self.sf.get_methods()[-1], methods[-1])
+
+        # 修改方法名
+        name = methods[7].get_name() + methods[7].get_sign()
+        self.edit(' ' + name, ' renamed' + methods[7].get_sign())
+        self.assertNotIn(methods[7], self.sf.get_methods())
+        self.assertIs(self.sf.get_methods()[-1], methods[-1])
+
+    def test_edit_field_and_class(self):
+        methods = list(self.sf.get_methods())
+        field = self.sf.get_fields()[0]
+        decl = field.get_declaration_sm()
+        self.edit(decl, decl.replace(field.get_name() + ':', 'newname:'))
+        self.assertEqual(self.sf.get_fields()[0].get_name(), 'newname')
+
+        self.edit('.class public Lcom/test/NewC;', '.class public La/NewC;')
+        self.assertEqual(self.sf.get_class(), 'La/NewC;')
+        self.assertIs(self.sf.get_methods()[1], methods[1])
+        self.assertEqual(str(methods[1]).split('->')[0], 'La/NewC;')
+
+    def test_broken_method_boundary(self):
+        mtd = self.sf.get_methods()[2]
+        self.edit(mtd.get_body() + '.end method',
+                  mtd.get_body() + '.end methox')
+
+
+class TestSmaliLine(unittest.TestCase):
+
+    def test_parse(self):
+        parse = SmaliLine.parse
+        self.assertEqual(
+            parse('invoke-static {v0, v1}, La/b;->c(I[B)V'),
+            ('a.b', 'c', ['I', '[B'], 'V', ['v0', 'v1']))
+        self.assertEqual(
+            parse('invoke-interface {p0, v1}, La/b;->c(I)Z'),
+            ('a.b', 'c', ['I'], 'Z', ['v1']))
+        self.assertEqual(
+            parse('invoke-super {p0}, Landroid/app/Service;->onCreate()V'),
+            ('android.app.Service', 'onCreate', [], 'V', []))
+        self.assertEqual(
+            parse('invoke-direct {v0, v1}, Ljava/lang/String;-><init>([B)V'),
+            ('v0', ['v0', 'v1']))
+        self.assertEqual(
+            parse('invoke-direct {p0}, La/b;-><init>()V'),
+            ('a.b', '<init>', [], 'V', []))
+        self.assertEqual(
+            parse('iput-boolean v0, p0, La/b;->c:Z'), ('a.b', 'c', 'Z', 'v0'))
+        self.assertEqual(
+            parse('iget-wide v0, p0, La/b;->c:J'), ('a.b', 'c', 'J', 'v0'))
+        self.assertEqual(
+            parse('sput-object v0, La/b;->c:[B'), ('a.b', 'c', '[B', 'v0'))
+        self.assertEqual(
+            parse('sget-boolean v0, La/b;->c:Z'), ('a.b', 'c', 'Z', 'v0'))
+        self.assertEqual(parse('move-result v0'), 'v0')
+        self.assertEqual(parse('new-instance v0, La/b;'), ('a.b', 'v0'))
+        self.assertEqual(parse('check-cast v0, [La/b;'), ('[La/b;', 'v0'))
+        self.assertEqual(parse('const/4 v1, 0x1'), ('v1', '0x1'))
+        self.assertEqual(parse('const-string v1, "a, b c"'), ('v1', 'a, b c'))
+        self.assertEqual(parse('return-void'),
+                         SmaliInstruction('return-void', (), None))
+        self.assertEqual(parse('if-eqz v0, :cond_0'),
+                         SmaliInstruction('if-eqz', ('v0',), ':cond_0'))
+
+    def test_decode_body(self):
+        body = sd.get_smali_file('Lcom/test/MyReceiver;').get_methods()[1]
+        instructions = SmaliLine.decode_body(body.get_body())
+        self.assertTrue(instructions)
+        for item in instructions:
+            self.assertIsInstance(item, SmaliInstruction)
+
+        body = '''    .registers 3
+    .annotation system Ldalvik/annotation/Throws;
+        value = {
+            Ljava/lang/Exception;
+        }
+    .end annotation
+
+    invoke-virtual/range {v0 .. v2}, La;->b(II)V
+
+    packed-switch v0, :pswitch_data_0
+
+    :pswitch_0
+    return-void
+
+    :pswitch_data_0
+    .packed-switch 0x0
+        :pswitch_0
+    .end packed-switch
+'''
+        self.assertEqual(SmaliLine.decode_body(body), [
+            SmaliInstruction(
+                'invoke-virtual/range', ('v0', 'v2'), 'La;->b(II)V'),
+            SmaliInstruction('packed-switch', ('v0',), ':pswitch_data_0'),
+            SmaliInstruction('return-void', (), None),
+        ])
+
+
+class TestSmaliCode(unittest.TestCase):
+
+    def test_round_trip(self):
+        for sf in SmaliDir('smali'):
+            for mtd in sf.get_methods():
+                code = mtd.get_code()
+                self.assertEqual(code.to_smali(), mtd.get_body())
+                self.assertIs(mtd.get_code(), code)
+
+        body = SmaliCode.INDENT.join([
+            '', '.registers 3\n\n',
+            'invoke-virtual/range {v0 .. v2}, La;->b(II)V\n',
+            'invoke-static {}, La;->c()V\n',
+            'filled-new-array {v0, p1}, [I\n',
+            '\tiput v0, p0, La;->d:I\n'])
+        code = SmaliCode.from_body(body)
+        self.assertEqual(code.to_smali(), body)
+        self.assertEqual([ins for _, ins in code.instructions()], [
+            SmaliInstruction(
+                'invoke-virtual/range', ('v0', 'v2'), 'La;->b(II)V'),
+            SmaliInstruction('invoke-static', (), 'La;->c()V'),
+            SmaliInstruction('filled-new-array', ('v0', 'p1'), '[I'),
+        ])
+        # 格式不标准的行原样保存
+        self.assertIsNone(code[5])
+
+    def test_wide_registers(self):
+        for body in ('    move/16 v40000, v1', '    move/16 v65535, p32768'):
+            code = SmaliCode.from_body(body)
+            self.assertEqual(code.to_smali(), body)
+            self.assertIsNotNone(code[0])
+        # 超出范围的寄存器原样保存
+        code = SmaliCode.from_body('    move/16 v70000, v1')
+        self.assertEqual(code.to_smali(), '    move/16 v70000, v1')
+        self.assertIsNone(code[0])
+        with self.assertRaises(ValueError):
+            code.append(SmaliInstruction('move/16', ('v70000', 'v1'), None))
+        self.assertEqual(len(code), 1)
+
+    def test_strings_scope(self):
+        first = SmaliCode.from_body(
+            '    :label_unique_1\n    goto :label_unique_1')
+        second = SmaliCode.from_body('    return-void')
+        # 每个SmaliCode有自己的驻留表，释放后不会留下引用
+        self.assertIsNot(first.strings, second.strings)
+        self.assertEqual(len(second.strings), 3)
+        self.assertEqual(second.to_smali(), '    return-void')
+        self.assertEqual(first[1].ref, ':label_unique_1')
+
+    def test_edit(self):
+        path = copy_smali_dir()
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        sdx = SmaliDir(path)
+        sf = sdx.get_smali_file('Lcom/test/MyReceiver;')
+        mtd = sf.get_methods()[1]
+        code = mtd.get_code()
+        index, ins = next(
+            item for item in code.instructions()
+            if item[1].opcode.startswith('invoke-'))
+        code[index] = ins._replace(ref='La;->b()V')
+        code.insert(index, SmaliInstruction('nop', (), None))
+        mtd.set_code(code)
+        self.assertIs(mtd.get_code(), code)
+        sf.update()
+
+        body = SmaliFile(sf.get_file_path()).get_methods()[1].get_body()
+        self.assertIn('    nop\n', body)
+        self.assertIn('}, La;->b()V', body)
+        self.assertEqual(body, code.to_smali())
+
+        del code[index]
+        self.assertEqual(code[index].ref, 'La;->b()V')
+        mtd.set_body(mtd.get_body())
+        self.assertIsNot(mtd.get_code(), code)
+
+
+class TestCallGraph(unittest.TestCase):
+
+    def test_call_graph(self):
+        sdx = SmaliDir('smali')
+        graph = sdx.get_call_graph()
+        self.assertIs(sdx.get_call_graph(), graph)
+
+        desc = 'Lcom/test/MyService;->onCreate()V'
+        callees = graph.callees(desc)
+        self.assertIn('Landroid/app/Service;->onCreate()V', callees)
+        self.assertEqual(len(callees), len(set(callees)))
+        for callee in callees:
+            self.assertIn(desc, graph.callers(callee))
+
+        # 与逐行解析的结果一致
+        for sf in sdx:
+            for mtd in sf.get_methods():
+                expected = set()
+                for ins in SmaliLine.decode_body(mtd.get_body()):
+                    if ins.opcode.startswith('invoke-'):
+                        expected.add(ins.ref)
+                self.assertEqual(set(graph.callees(mtd)), expected)
+
+        reachable = graph.reachable(desc)
+        self.assertTrue(set(callees) <= set(reachable))
+        self.assertIn(desc, graph.reachable(callees[0], reverse=True))
+        self.assertEqual(graph.callers('La;->none()V'), [])
+        self.assertEqual(graph.reachable('La;->none()V'), [])
+
+    def test_range_and_rebuild(self):
+        path = copy_smali_dir()
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        sdx = SmaliDir(path)
+        graph = sdx.get_call_graph()
+        sf = sdx.get_smali_file('Lcom/test/Hello;')
+        mtd = sf.get_methods()[0]
+        mtd.set_body(mtd.get_body().replace(
+            '    return-void',
+            '    invoke-static/range {v0 .. v1}, La;->b(II)V\n\n'
+            '    return-void', 1))
+        sf.update()
+
+        new_graph = sdx.get_call_graph()
+        self.assertIsNot(new_graph, graph)
+        self.assertIn('La;->b(II)V', new_graph.callees(mtd))
+        self.assertEqual(new_graph.callers('La;->b(II)V'), [str(mtd)])
+
+    def test_parallel(self):
+        sdx = SmaliDir('smali')
+        serial = sdx.get_call_graph()
+        parallel = SmaliDir('smali', workers=2).get_call_graph()
+        self.assertEqual(len(parallel), len(serial))
+        self.assertEqual(parallel.edge_count(), serial.edge_count())
+        for sf in sdx:
+            for mtd in sf.get_methods():
+                callees = serial.callees(mtd)
+                self.assertEqual(parallel.callees(mtd), callees)
+                for desc in callees:
+                    self.assertEqual(parallel.callers(desc),
+                                     serial.callers(desc))
+
+
+HIERARCHY = {
+    'J': '.class public interface abstract Lp/J;\n'
+         '.super Ljava/lang/Object;\n\n'
+         '.method public d()V\n    .registers 1\n\n    return-void\n'
+         '.end method\n',
+    'I': '.class public interface abstract Lp/I;\n'
+         '.super Ljava/lang/Object;\n\n# interfaces\n.implements Lp/J;\n',
+    'A': '.class public Lp/A;\n.super Ljava/lang/Object;\n\n'
+         '# interfaces\n.implements Lp/I;\n.implements Ljava/io/Closeable;\n\n'
+         '.method public m()V\n    .registers 1\n\n    return-void\n'
+         '.end method\n',
+    'B': '.class public Lp/B;\n.super Lp/A;\n',
+    'C': '.class public Lp/C;\n.super Lp/B;\n\n'
+         '.method public m()V\n    .registers 1\n\n    return-void\n'
+         '.end method\n',
+}
+
+
+class TestHierarchy(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        os.makedirs(os.path.join(self.tmp, 'p'))
+        for name, content in HIERARCHY.items():
+            path = os.path.join(self.tmp, 'p', name + '.smali')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+        self.sd = SmaliDir(self.tmp)
+
+    def test_interfaces(self):
+        sf = self.sd.get_smali_file('Lp/A;')
+        self.assertEqual(sf.get_interfaces(), ['Lp/I;', 'Ljava/io/Closeable;'])
+        self.assertEqual(parse_smali_file(sf.get_file_path())[3],
+                         ['Lp/I;', 'Ljava/io/Closeable;'])
+
+        # 只修改方法，增量解析后接口不变
+        mtd = sf.get_methods()[0]
+        mtd.set_body(mtd.get_body().replace('return-void', 'nop\n    return-void'))
+        sf.update()
+        sf.save()
+        self.assertEqual(sf.get_interfaces(), ['Lp/I;', 'Ljava/io/Closeable;'])
+
+        sf.set_content(sf.get_content().replace('.implements Lp/I;\n', ''))
+        sf.save()
+        self.assertEqual(sf.get_interfaces(), ['Ljava/io/Closeable;'])
+        self.assertNotIn('Lp/A;', self.sd.get_hierarchy().implementers('Lp/I;'))
+
+    def test_lazy(self):
+        sd = SmaliDir(self.tmp, lazy=True)
+        hierarchy = sd.get_hierarchy()
+        for clz in ('Lp/A;', 'Lp/B;', 'Lp/C;', 'Lp/I;', 'Lp/J;'):
+            self.assertIn(clz, hierarchy)
+        self.assertEqual(hierarchy.descendants('Lp/A;'), ['Lp/B;', 'Lp/C;'])
+        self.assertEqual(str(sd.resolve_method('Lp/B;', 'm()V')),
+                         'Lp/A;->m()V')
+
+    def test_queries(self):
+        hierarchy = self.sd.get_hierarchy()
+        self.assertIs(self.sd.get_hierarchy(), hierarchy)
+        self.assertEqual(hierarchy.superclasses('Lp/C;'),
+                         ['Lp/B;', 'Lp/A;', 'Ljava/lang/Object;'])
+        self.assertEqual(
+            sorted(hierarchy.ancestors('Lp/C;')),
+            ['Ljava/io/Closeable;', 'Ljava/lang/Object;', 'Lp/A;', 'Lp/B;',
+             'Lp/I;', 'Lp/J;'])
+        self.assertEqual(sorted(hierarchy.descendants('Lp/A;')),
+                         ['Lp/B;', 'Lp/C;'])
+        self.assertEqual(sorted(hierarchy.implementers('Lp/J;')),
+                         ['Lp/A;', 'Lp/B;', 'Lp/C;', 'Lp/I;'])
+        self.assertTrue(hierarchy.is_subtype('Lp/B;', 'Lp/J;'))
+        self.assertFalse(hierarchy.is_subtype('Lp/A;', 'Lp/B;'))
+        self.assertEqual(hierarchy.descendants('Lp/none;'), [])
+
+    def test_resolve(self):
+        sd = self.sd
+        self.assertEqual(str(sd.resolve_method('Lp/B;', 'm()V')), 'Lp/A;->m()V')
+        self.assertEqual(str(sd.resolve_method('Lp/C;', 'm()V')), 'Lp/C;->m()V')
+        self.assertEqual(str(sd.resolve_method('Lp/C;', 'd()V')), 'Lp/J;->d()V')
+        self.assertIsNone(sd.resolve_method('Lp/C;', 'toString()Ljava/lang/String;'))
+        self.assertEqual([str(m) for m in sd.virtual_targets('Lp/B;->m()V')],
+                         ['Lp/A;->m()V', 'Lp/C;->m()V'])
+
+
+class TestStrings(unittest.TestCase):
+
+    def test_iter_strings(self):
+        sdx = SmaliDir('smali')
+        expected = []
+        for sf in sdx:
+            for mtd in sf.get_methods():
+                for line in mtd.get_body().split('\n'):
+                    if line.strip().startswith('const-string'):
+                        register, string = SmaliLine.parse_const_string(line)
+                        expected.append(StringRecord(
+                            unescape_string(string), sf.get_class(), str(mtd),
+                            register))
+
+        records = list(sdx.iter_strings())
+        self.assertEqual(records, expected)
+        self.assertEqual(
+            list(SmaliDir('smali', workers=2).iter_strings()), records)
+
+        # 相同的字符串是同一个对象
+        strings = [r.string for r in records if r.string == 'DES']
+        self.assertGreater(len(strings), 1)
+        for string in strings:
+            self.assertIs(string, strings[0])
+
+    def test_escape(self):
+        for text in ['a\nb', "it's", 'x\\y', '\u4e2d\u6587\t', '']:
+            self.assertEqual(unescape_string(escape_string(text)), text)
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        with open(os.path.join(tmp, 'A.smali'), 'w', encoding='utf-8') as f:
+            f.write('.class public La;\n.super Ljava/lang/Object;\n\n'
+                    '.field public static final b:Ljava/lang/String; = "x\\ty"\n'
+                    '.field public static final c:I = 0x1\n\n'
+                    '.method public d()V\n    .registers 1\n\n'
+                    '    const-string/jumbo v0, "\\u4e2d \\"q\\" \\\\"\n\n'
+                    '    return-void\n.end method\n')
+        self.assertEqual(list(SmaliDir(tmp).iter_strings()), [
+            StringRecord('x\ty', 'La;', 'La;->b:Ljava/lang/String;', None),
+            StringRecord('\u4e2d "q" \\', 'La;', 'La;->d()V', 'v0'),
+        ])
+
+
+class TestStream(unittest.TestCase):
+
+    def test_stream(self):
+        files = SmaliDir('smali')
+        classes = [sf.get_class() for sf in files]
+
+        streamed = []
+        previous = None
+        for sf in SmaliDir.stream('smali'):
+            # 上一个文件不再被引用，已经释放
+            if previous is not None:
+                self.assertIsNone(previous())
+            self.assertIsNone(sf._owner)
+            expected = files.get_smali_file(sf.get_class())
+            self.assertEqual(sf.get_content(), expected.get_content())
+            self.assertEqual([str(m) for m in sf.get_methods()],
+                             [str(m) for m in expected.get_methods()])
+            streamed.append(sf.get_class())
+            previous = weakref.ref(sf)
+            del sf
+        self.assertEqual(streamed, classes)
+
+        self.assertEqual(
+            [sf.get_class() for sf in SmaliDir.stream(['smali'], workers=2)],
+            classes)
+        self.assertEqual(
+            [sf.get_class() for sf in SmaliDir.stream(
+                'smali', ['com.test.Hello'], INCLUDE)],
+            ['Lcom/test/Hello;'])
+
+    def test_single_pool(self):
+        from concurrent.futures import ProcessPoolExecutor
+        pulled = []
+
+        def items():
+            for i in range(100):
+                pulled.append(i)
+                yield -i
+
+        with unittest.mock.patch('concurrent.futures.ProcessPoolExecutor',
+                                 wraps=ProcessPoolExecutor) as pool:
+            results = _imap_parallel(abs, items(), 2, limit=8, chunksize=2)
+            self.assertEqual(next(results), 0)
+            # 同时最多提交limit项
+            self.assertLessEqual(len(pulled), 10)
+            self.assertEqual(list(results), list(range(1, 100)))
+        self.assertEqual(pool.call_count, 1)
+
+    def test_cli(self):
+        env = dict(os.environ, PYTHONPATH=os.path.abspath('..'))
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'smafile', 'dump', 'smali'],
+            env=env, universal_newlines=True)
+        record = json.loads(output.split('\n')[0])
+        self.assertEqual(record['class'], 'Lcom/test/Hello;')
+        self.assertEqual(record['methods'][0], 'Lcom/test/Hello;-><init>()V')
+
+
+class TestCompactModel(unittest.TestCase):
+
+    def test_slots(self):
+        sf = SmaliDir('smali').get_smali_file('Lcom/test/MyService;')
+        for item in [sf] + sf.get_methods() + sf.get_fields():
+            self.assertFalse(hasattr(item, '__dict__'))
+        self.assertEqual(sf.sign, sf.get_class())
+
+    def test_interned(self):
+        a = SmaliFile(os.path.join('smali', 'com', 'test', 'MyService.smali'))
+        b = SmaliFile(os.path.join('smali', 'com', 'test', 'MyService.smali'))
+        self.assertIs(a.get_class(), b.get_class())
+        self.assertIs(a.get_supper(), b.get_supper())
+        for x, y in zip(a.get_methods(), b.get_methods()):
+            self.assertIs(x.get_class(), a.get_class())
+            self.assertIs(x.get_sign(), y.get_sign())
+            self.assertIs(x.get_return_type(), y.get_return_type())
+        for x, y in zip(a.get_fields(), b.get_fields()):
+            self.assertIs(x.get_type(), y.get_type())
+
+    def test_field_declaration(self):
+        field = SmaliField(
+            '.field private static final a:[B = "x"', class_name='La;')
+        self.assertEqual(str(field), 'La;->a:[B')
+        self.assertEqual(field.get_modifier(), ['private', 'static', 'final'])
+        self.assertTrue(field.get_is_static())
+        self.assertEqual(field.get_value(), 'x')
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_stats(self):
+        sdx = SmaliDir('smali')
+        self.assertIsNone(sdx.profiler)
+        self.assertEqual(sdx.stats(), {'files': 6})
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        for workers in (None, 2):
+            sdx = SmaliDir('smali', workers=workers, cache_dir=tmp,
+                           profiler=Profiler(slowest=2))
+            sdx.xref('Lcom/test/MyService;')
+            stats = sdx.stats()
+            for name in ('walk', 'read', 'decode', 'cache', 'build', 'index'):
+                self.assertGreater(stats['phases'][name]['time'], 0)
+            self.assertEqual(stats['phases']['read']['count'], 6)
+            self.assertEqual(stats['phases']['xref_index']['count'], 1)
+            self.assertEqual(len(stats['slowest_files']), 2)
+            self.assertGreaterEqual(stats['slowest_files'][0]['time'],
+                                    stats['slowest_files'][1]['time'])
+            self.assertEqual(sum(stats['counters'].values()), 6)
+        # 第二次加载时，子进程中的缓存命中也被统计
+        self.assertEqual(stats['counters'], {'cache_hits': 6})
+
+    def test_save(self):
+        path = copy_smali_dir()
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        profiler = Profiler()
+        sdx = SmaliDir(path, lazy=True, profiler=profiler)
+        self.assertNotIn('read', profiler.counts)
+        sf = sdx.get_smali_file('Lcom/test/Hello;')
+        sf.save()
+        self.assertEqual(profiler.counts['read'], 1)
+        self.assertEqual(profiler.counts['save'], 1)
+        self.assertEqual(profiler.counts['reparse'], 1)
+
+    def test_cli(self):
+        env = dict(os.environ, PYTHONPATH=os.path.abspath('..'))
+        result = subprocess.run(
+            [sys.executable, '-m', 'smafile', 'xref', 'La;', 'smali',
+             '--profile'], env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        self.assertEqual(json.loads(result.stderr)['files'], 6)
+
+
+class TestCli(unittest.TestCase):
+
+    def run_cli(self, *argv):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            cli.main(list(argv))
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_index(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        records = self.run_cli('index', 'smali', '--cache', tmp, '-j', '2')
+        self.assertEqual([r['class'] for r in records],
+                         [sf.get_class() for sf in sd])
+        self.assertEqual(records[2]['super'], 'Landroid/app/Service;')
+
+        # 第二次使用缓存
+        sdx = SmaliDir('smali', cache_dir=tmp)
+        self.assertEqual(sdx.stats()['cache'], {'hits': 6, 'misses': 0})
+
+    def test_dump(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        self.addCleanup(os.chdir, cwd)
+        records = self.run_cli('load', os.path.join(cwd, 'smali'),
+                               '-i', 'com.test.Hello')
+        self.assertEqual(len(records), 1)
+        # 没有指定--cache时，保存到默认的缓存目录
+        self.assertTrue(os.path.isdir(cli.DEFAULT_CACHE))
+        os.chdir(cwd)
+        records = self.run_cli('dump', 'smali', '-e', 'com.test.Hello')
+        self.assertEqual(len(records), 5)
+        sf = sd.get_smali_file(records[0]['class'])
+        self.assertEqual(records[0]['fields'],
+                         [str(f) for f in sf.get_fields()])
+
+    def test_xref(self):
+        desc = 'Lcom/test/MyService;'
+        records = self.run_cli('xref', desc, 'smali')
+        self.assertEqual(
+            [(r['class'], r['method']) for r in records],
+            [(str(sf), str(mtd))
+             for sf, mtd in SmaliDir('smali').xref_methods(desc)])
+
+    def test_strings(self):
+        records = self.run_cli('strings', 'smali')
+        self.assertEqual(
+            records,
+            [r._asdict() for r in SmaliDir('smali').iter_strings()])
+
+    def test_rename(self):
+        path = copy_smali_dir()
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        mapping = os.path.join(os.path.dirname(path), 'mapping.txt')
+        with open(mapping, 'w', encoding='utf-8') as f:
+            f.write('# 类名\nLcom/test/Hello; Lcom/test/Hi;\n\n'
+                    'Lcom/test/MyService;->a:Ljava/lang/String; '
+                    'Lcom/test/MyService;->name:Ljava/lang/String;\n')
+        records = self.run_cli('rename', '--map', mapping, path)
+        self.assertIn('Lcom/test/Hi;', [r['class'] for r in records])
+        for record in records:
+            self.assertTrue(os.path.exists(record['file']))
+
+        sdx = SmaliDir(path)
+        self.assertIsNone(sdx.get_smali_file('Lcom/test/Hello;'))
+        self.assertIsNotNone(
+            sdx.get_field('Lcom/test/MyService;->name:Ljava/lang/String;'))
+
+
+FILTER_TREE = ['com/app/A', 'com/app/A$1', 'com/app/sub/B', 'com/apple/C',
+               'com/other/D', 'org/E']
+
+
+class TestFilters(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        for clz in FILTER_TREE:
+            path = os.path.join(self.tmp, *clz.split('/')) + '.smali'
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('.class public L{};\n.super Ljava/lang/Object;\n'
+                        .format(clz))
+
+    def load(self, filters, opt):
+        visited = []
+        walk = os.walk
+
+        def record(top):
+            for item in walk(top):
+                visited.append(
+                    os.path.relpath(item[0], top).replace(os.sep, '/'))
+                yield item
+
+        with unittest.mock.patch('smafile.os.walk', record):
+            classes = sorted(sf.get_class()[1:-1]
+                             for sf in SmaliDir(self.tmp, filters, opt))
+        return classes, sorted(visited)
+
+    def test_include(self):
+        classes, visited = self.load(['com.app'], INCLUDE)
+        self.assertEqual(classes, ['com/app/A', 'com/app/A$1', 'com/app/sub/B'])
+        # 只进入过滤器路径上的目录
+        self.assertEqual(visited, ['.', 'com', 'com/app', 'com/app/sub'])
+
+        classes, visited = self.load(['com/app/A'], INCLUDE)
+        self.assertEqual(classes, ['com/app/A', 'com/app/A$1'])
+        self.assertEqual(visited, ['.', 'com', 'com/app'])
+
+        classes, _ = self.load(['com.app.sub', 'Lorg/E;', 'com/other/'],
+                               INCLUDE)
+        self.assertEqual(classes, ['com/app/sub/B', 'com/other/D', 'org/E'])
+
+        self.assertEqual(self.load([], INCLUDE), ([], ['.']))
+
+    def test_exclude(self):
+        classes, visited = self.load(['com.app'], EXCLUDE)
+        self.assertEqual(classes, ['com/apple/C', 'com/other/D', 'org/E'])
+        self.assertNotIn('com/app', visited)
+
+        classes, visited = self.load(['com/app/A'], EXCLUDE)
+        self.assertEqual(classes, ['com/app/sub/B', 'com/apple/C',
+                                   'com/other/D', 'org/E'])
+        self.assertIn('com/app', visited)
+
+        classes, _ = self.load(['com.app.sub', 'Lorg/E;', 'com/other/'],
+                               EXCLUDE)
+        self.assertEqual(classes, ['com/app/A', 'com/app/A$1', 'com/apple/C'])
+
+        self.assertEqual(self.load([], EXCLUDE)[0], sorted(FILTER_TREE))
+
+    def test_lazy_and_stream(self):
+        sdx = SmaliDir(self.tmp, ['com.app'], INCLUDE, lazy=True)
+        self.assertEqual(len(sdx), 3)
+        self.assertEqual(
+            len(list(SmaliDir.stream(self.tmp, ['com.app'], EXCLUDE))), 3)
+
+
+# apktool的输出目录：dex目录 -> {类名: 方法体}
+DEX_TREE = {
+    'smali': {
+        'a/A': 'invoke-static {}, Lb/B;->run()V',
+        'a/Dup': '',
+    },
+    'smali_classes2': {
+        'b/B': 'sget-object v0, La/A;->TAG:Ljava/lang/String;',
+        'a/Dup': '',
+    },
+    'smali_classes10': {
+        'c/C': '',
+    },
+}
+
+
+class TestMultiDex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        os.makedirs(os.path.join(self.tmp, 'original'))
+        for dex_dir, classes in DEX_TREE.items():
+            for clz, body in classes.items():
+                path = os.path.join(self.tmp, dex_dir, *clz.split('/'))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.smali', 'w', encoding='utf-8') as f:
+                    f.write('.class public L{};\n.super Ljava/lang/Object;\n\n'
+                            '.method public static run()V\n'
+                            '    .registers 1\n    {}\n    return-void\n'
+                            '.end method\n'.format(clz, body))
+        self.dex = [os.path.join(self.tmp, name) for name in
+                    ('smali', 'smali_classes2', 'smali_classes10')]
+
+    def test_discover(self):
+        self.assertEqual(find_dex_dirs(self.tmp), self.dex)
+        sdx = SmaliDir.from_apktool(self.tmp)
+        self.assertEqual(sdx.get_shards(), self.dex)
+        self.assertEqual(len(sdx), 5)
+        self.assertEqual(
+            [sf.get_class() for sf in sdx.get_shard_files(self.dex[2])],
+            ['Lc/C;'])
+
+    def test_query(self):
+        sdx = SmaliDir.from_apktool(self.tmp)
+        self.assertIs(sdx.get_smali_file('Lb/B;', self.dex[1]),
+                      sdx.get_smali_file('Lb/B;'))
+        self.assertIsNone(sdx.get_smali_file('Lb/B;', self.dex[0]))
+        self.assertIsNotNone(sdx.get_method('Lb/B;', 'run()V', self.dex[1]))
+        self.assertIsNone(sdx.get_method('Lb/B;', 'run()V', self.dex[0]))
+
+    def test_duplicates(self):
+        sdx = SmaliDir.from_apktool(self.tmp)
+        self.assertEqual(sdx.duplicate_classes(),
+                         {'La/Dup;': self.dex[:2]})
+        # 全局查找使用第一个dex中的类
+        self.assertIs(sdx.get_smali_file('La/Dup;'),
+                      sdx.get_smali_file('La/Dup;', self.dex[0]))
+        second = sdx.get_smali_file('La/Dup;', self.dex[1])
+        self.assertIsNot(second, sdx.get_smali_file('La/Dup;'))
+        self.assertIs(sdx.get_method('La/Dup;', 'run()V', self.dex[1]),
+                      second.get_method('run()V'))
+
+    def test_dex_stats(self):
+        for workers in (None, 2):
+            stats = SmaliDir.from_apktool(self.tmp, workers=workers).dex_stats()
+            self.assertEqual(stats[self.dex[0]], {
+                'classes': 2, 'methods': 2, 'fields': 0,
+                'method_refs': 3, 'field_refs': 0})
+            self.assertEqual(stats[self.dex[1]], {
+                'classes': 2, 'methods': 2, 'fields': 0,
+                'method_refs': 2, 'field_refs': 1})
+            self.assertEqual(stats[self.dex[2]]['method_refs'], 1)
+
+    def test_rename_keeps_shard(self):
+        sdx = SmaliDir.from_apktool(self.tmp)
+        sdx.update_desc('Lc/C;', 'Lc/D;')
+        self.assertIsNone(sdx.get_smali_file('Lc/C;', self.dex[2]))
+        self.assertEqual(sdx.get_smali_file('Lc/D;', self.dex[2]).get_class(),
+                         'Lc/D;')
+
+
+def write_class(smali_dir, clz, body=''):
+    path = os.path.join(smali_dir, *clz[1:-1].split('/')) + '.smali'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('.class public {}\n.super Ljava/lang/Object;\n\n'
+                '.method public run()V\n    .registers 1\n{}'
+                '    return-void\n.end method\n'.format(clz, body))
+    return path
+
+
+class TestRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.a = write_class(self.tmp, 'La/A;')
+        self.b = write_class(self.tmp, 'La/B;')
+
+    def test_refresh(self):
+        sdx = SmaliDir(self.tmp)
+        self.assertEqual(sdx.refresh(), ([], [], []))
+        run = sdx.get_method('La/A;', 'run()V')
+        self.assertEqual(sdx.xref('La/B;->run()V'), [])
+
+        write_class(self.tmp, 'La/A;',
+                    '    invoke-virtual {p0}, La/B;->run()V\n')
+        os.remove(self.b)
+        write_class(self.tmp, 'La/C;')
+        added, removed, changed = sdx.refresh()
+
+        self.assertEqual([sf.get_class() for sf in added], ['La/C;'])
+        self.assertEqual([sf.get_class() for sf in removed], ['La/B;'])
+        self.assertEqual([sf.get_class() for sf in changed], ['La/A;'])
+        self.assertEqual(len(sdx), 2)
+        self.assertIsNone(sdx.get_smali_file('La/B;'))
+        self.assertIsNone(sdx.get_method('La/B;', 'run()V'))
+        self.assertIsNotNone(sdx.get_method('La/C;', 'run()V'))
+        self.assertIs(sdx.get_method('La/A;', 'run()V'), run)
+        self.assertIn('invoke-virtual', run.get_body())
+        self.assertEqual([str(sf) for sf in sdx.xref('La/B;->run()V')],
+                         ['La/A;'])
+        self.assertEqual(sdx.refresh(), ([], [], []))
+
+    def test_own_writes(self):
+        sdx = SmaliDir(self.tmp)
+        sdx.update_desc('La/B;', 'La/D;')
+        self.assertEqual(sdx.refresh(), ([], [], []))
+        self.assertEqual(sdx.get_smali_file('La/D;').get_class(), 'La/D;')
+
+    def test_lazy(self):
+        sdx = SmaliDir(self.tmp, lazy=True)
+        write_class(self.tmp, 'La/A;', '    nop\n')
+        write_class(self.tmp, 'La/C;')
+        added, _, _ = sdx.refresh()
+        self.assertEqual([sf.get_class() for sf in added], ['La/C;'])
+        self.assertIn('nop', sdx.get_method('La/A;', 'run()V').get_body())
+
+    def test_load_stat(self):
+        # 加载时使用读取文件时的状态，不再逐个获取
+        with unittest.mock.patch('smafile.os.stat') as stat:
+            sdx = SmaliDir(self.tmp)
+            lazy = SmaliDir(self.tmp, lazy=True)
+        stat.assert_not_called()
+        self.assertEqual(sdx.refresh(), ([], [], []))
+
+        # 还没有读取的文件修改后，首次访问时读取的就是新内容
+        write_class(self.tmp, 'La/A;', '    nop\n')
+        self.assertEqual(lazy.refresh(), ([], [], []))
+        self.assertIn('nop', lazy.get_method('La/A;', 'run()V').get_body())
+        self.assertEqual(lazy.refresh(), ([], [], []))
+
+        write_class(self.tmp, 'La/A;', '    nop\n    nop\n')
+        _, _, changed = lazy.refresh()
+        self.assertEqual([sf.get_class() for sf in changed], ['La/A;'])
+
+    def test_duplicate_removed(self):
+        other = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other)
+        write_class(other, 'La/A;', '    nop\n')
+        sdx = SmaliDir([self.tmp, other])
+        os.remove(self.a)
+        sdx.refresh()
+        # 第一个目录中的类删除后，使用第二个目录中的类
+        self.assertEqual(sdx.get_smali_file('La/A;').get_file_path(),
+                         os.path.join(other, 'a', 'A.smali'))
+        self.assertIn('nop', sdx.get_method('La/A;', 'run()V').get_body())
+
+    def test_watch(self):
+        sdx = SmaliDir(self.tmp)
+        changes = []
+        watcher = sdx.watch(0.01, lambda *items: changes.append(items))
+        try:
+            write_class(self.tmp, 'La/C;')
+            for _ in range(500):
+                if changes:
+                    break
+                time.sleep(0.01)
+        finally:
+            watcher.stop()
+        self.assertEqual([sf.get_class() for sf in changes[0][0]], ['La/C;'])
+        self.assertIsNotNone(sdx.get_smali_file('La/C;'))
+
+
+QUERY_CLASS = """.class public Lq/Crypto;
+.super Ljava/lang/Object;
+
+.field private key:[B
+
+.field public static final NAME:Ljava/lang/String; = "crypto"
+
+.method public static native decrypt([BI)[B
+.end method
+
+.method public getCipher()Ljavax/crypto/Cipher;
+    .registers 2
+    const/4 v0, 0x0
+    return-object v0
+.end method
+
+.method public getKey()[B
+    .registers 2
+    iget-object v0, p0, Lq/Crypto;->key:[B
+    return-object v0
+.end method
+"""
+
+
+class TestQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        os.makedirs(os.path.join(self.tmp, 'q'))
+        with open(os.path.join(self.tmp, 'q', 'Crypto.smali'), 'w',
+                  encoding='utf-8') as f:
+            f.write(QUERY_CLASS)
+        write_class(self.tmp, 'Lq/Other;')
+        self.sdx = SmaliDir(self.tmp)
+
+    def find(self, **criteria):
+        return [str(item) for item in self.sdx.find_methods(**criteria)]
+
+    def test_exact(self):
+        self.assertEqual(self.find(return_type='Ljavax/crypto/Cipher;'),
+                         ['Lq/Crypto;->getCipher()Ljavax/crypto/Cipher;'])
+        self.assertEqual(self.find(access='native'),
+                         ['Lq/Crypto;->decrypt([BI)[B'])
+        self.assertEqual(self.find(params='[B'), self.find(access='native'))
+        self.assertEqual(self.find(name='missing'), [])
+
+    def test_pattern(self):
+        self.assertEqual(self.find(name='get*'), [
+            'Lq/Crypto;->getCipher()Ljavax/crypto/Cipher;',
+            'Lq/Crypto;->getKey()[B'])
+        # [是类型的一部分，不是通配符
+        self.assertEqual(self.find(desc='Lq/*;->*()[B'),
+                         ['Lq/Crypto;->getKey()[B'])
+        self.assertEqual(self.find(clz='Lq/?ther;'), ['Lq/Other;->run()V'])
+        self.assertEqual(self.find(name=re.compile('crypt')),
+                         ['Lq/Crypto;->decrypt([BI)[B'])
+
+    def test_combined(self):
+        self.assertEqual(self.find(access=['public', 'static']),
+                         ['Lq/Crypto;->decrypt([BI)[B'])
+        self.assertEqual(self.find(clz='Lq/Crypto;', return_type='[B',
+                                   access='native'),
+                         ['Lq/Crypto;->decrypt([BI)[B'])
+        self.assertEqual(len(self.find()), 4)
+        with self.assertRaises(KeyError):
+            self.sdx.get_member_tables()[0].query(size=1)
+
+    def test_fields(self):
+        self.assertEqual([str(f) for f in self.sdx.find_fields(
+            field_type='[B')], ['Lq/Crypto;->key:[B'])
+        self.assertEqual([str(f) for f in self.sdx.find_fields(
+            access=['static', 'final'], name='N*')],
+            ['Lq/Crypto;->NAME:Ljava/lang/String;'])
+
+    def test_lazy(self):
+        sdx = SmaliDir(self.tmp, lazy=True)
+        result = sdx.find_methods(access='native')
+        self.assertFalse(isinstance(result, list))
+        self.assertEqual(str(next(result)), 'Lq/Crypto;->decrypt([BI)[B')
+
+    def test_rebuild(self):
+        tables = self.sdx.get_member_tables()
+        self.assertIs(self.sdx.get_member_tables(), tables)
+        self.sdx.update_desc('Lq/Crypto;->getKey()[B', 'Lq/Crypto;->key()[B')
+        self.assertIsNot(self.sdx.get_member_tables(), tables)
+        self.assertEqual(self.find(return_type='[B', access='public',
+                                   name='key'), ['Lq/Crypto;->key()[B'])
+
+
 if __name__ == '__main__':
     test = Test()
     test.test_SmaliDir()